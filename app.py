@@ -9,13 +9,42 @@ import re
 import time
 import urllib.parse
 import json
+import atexit
+import csv
+import io
+import math
+from array import array
+import mmap
+import hashlib
+import struct
+import base64
+import bisect
+import heapq
+import difflib
+import unicodedata
+import ctypes
+import ctypes.util
+import asyncio
+import httpx
+import numpy as np
 from queue import Queue
-from flask import Flask, render_template, request, jsonify
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoAtrasado
 from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from flask_socketio import SocketIO, emit
 from datetime import timezone
 from datetime import datetime
+from datetime import timedelta
+
+try:
+    import websocket  # websocket-client (assinaturas do Moonraker)
+except ImportError:
+    websocket = None
 
 def log(ip, etapa, msg):
     agora = datetime.now().strftime("%H:%M:%S")
@@ -38,6 +67,9 @@ def set_busy(ip: str, on: bool):
 
 app = Flask(__name__)
 
+# Push de status para os dashboards (substitui o polling de 3s do script.js)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+
 
 # --- CONFIGURAÇÕES ---
 PASTA_RAIZ = os.path.abspath(r'/app/gcodes') 
@@ -45,6 +77,10 @@ PASTA_RAIZ = os.path.abspath(r'/app/gcodes')
 basedir = os.path.abspath(os.path.dirname(__file__))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'farm_supertech.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Fila de jobs em arquivo próprio (WAL): escrita do worker não trava o resto do app
+app.config['SQLALCHEMY_BINDS'] = {
+    'fila': 'sqlite:///' + os.path.join(basedir, 'fila_jobs.db'),
+}
 
 db = SQLAlchemy(app)
 
@@ -53,56 +89,260 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 os.makedirs(BASE_DIR, exist_ok=True)
 TOKENS_PATH = os.path.join(BASE_DIR, "tokens.json")
 
-UPLOAD_FILAS = {}          # ip -> Queue()
-UPLOAD_WORKERS = {}        # ip -> Thread
-UPLOAD_LOCK = threading.Lock()
-MAX_UPLOADS_SIMULTANEOS = 1  # 1 = fila total (um upload por vez no sistema)
-UPLOAD_SEM = threading.Semaphore(MAX_UPLOADS_SIMULTANEOS)
+
+# Agendador de uploads: concorrência e banda por grupo de rede (AP / sub-rede)
+UPLOAD_CONCORRENCIA_TOTAL = int(os.getenv("UPLOAD_CONCORRENCIA_TOTAL", "6"))   # teto da farm
+UPLOAD_CONCORRENCIA_GRUPO = int(os.getenv("UPLOAD_CONCORRENCIA_GRUPO", "2"))   # por AP/sub-rede
+UPLOAD_MBPS_GRUPO = float(os.getenv("UPLOAD_MBPS_GRUPO", "0"))                 # 0 = sem limite
+# Ajuste fino por grupo: {"AP-GALPAO": {"concorrencia": 3, "mbps": 4}}
+UPLOAD_GRUPOS_CONFIG = json.loads(os.getenv("UPLOAD_GRUPOS_CONFIG", "{}") or "{}")
+# Campo "checksum" (sha256) no upload: o Moonraker confere e recusa (422) antes de gravar/imprimir
+UPLOAD_CHECKSUM = os.getenv("UPLOAD_CHECKSUM", "1") != "0"
+# Upload com print=true: o Moonraker inicia a impressão ao terminar de gravar.
+# Só vale com checksum: sem ele o tamanho seria conferido com a peça já imprimindo.
+UPLOAD_INICIO_RAPIDO = os.getenv("UPLOAD_INICIO_RAPIDO", "1") != "0" and UPLOAD_CHECKSUM
 
 BLING_API_KEY = "seu_token_aqui"
 
-# Configurações do Cache
-cache_estoque = {
-    "dados": None,
-    "expira_em": 0
-}
+# Cache do estoque Bling: fresco por ESTOQUE_TTL; depois serve o velho e revalida
+ESTOQUE_TTL = int(os.getenv("ESTOQUE_TTL", "300"))
+ESTOQUE_LIMITE_PAGINA = 100       # máximo aceito pelo /produtos do Bling v3
+ESTOQUE_INTERVALO_S = 0.4         # Bling v3: até 3 requisições/s por conta
+# Token Bling: renova quem pede a menos de 5 min do vencimento; o fundo renova antes
+TOKEN_RENOVAR_ANTES_S = 300
+TOKEN_FOLGA_FUNDO_S = 300
+TOKEN_ESPERA_FALHA_S = 30
 load_dotenv(dotenv_path='.env')
 
 CLIENT_ID = os.getenv("BLING_CLIENT_ID")
 CLIENT_SECRET = os.getenv("BLING_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 
+# --- Inicio Estado Versionado da Farm ---
+class StatusImpressora:
+    """Registro compacto do card de uma impressora (slots, sem dict por instância)."""
+    __slots__ = ("ip", "nome", "status", "cor", "msg", "progresso", "arquivo", "versao")
+
+    imagem = "n4max.png"   # igual para todas: fica na classe, não em cada registro
+
+    def __init__(self, ip, nome, status, cor, msg, progresso=0, arquivo=None, versao=0):
+        self.ip = ip
+        self.nome = nome
+        self.status = status
+        self.cor = cor
+        self.msg = msg
+        self.progresso = progresso
+        self.arquivo = arquivo
+        self.versao = versao
+
+    def mesmo_conteudo(self, outro):
+        return (self.nome, self.status, self.cor, self.msg, self.progresso, self.arquivo) == \
+               (outro.nome, outro.status, outro.cor, outro.msg, outro.progresso, outro.arquivo)
+
+    def como_dict(self):
+        d = {
+            'nome': self.nome,
+            'ip': self.ip,
+            'status': self.status,
+            'cor': self.cor,
+            'msg': self.msg,
+            'progresso': self.progresso,
+            'versao': self.versao
+        }
+        if self.arquivo is not None:
+            d['arquivo'] = self.arquivo
+        return d
+
+
+class EstadoFarm:
+    """
+    Memória de status de todas as impressoras.
+    - versão global monotônica (+1 a cada card que muda)
+    - versão por impressora (para responder só o que mudou desde X)
+    - JSON completo cacheado por versão (ETag / 304 no /status_atualizado)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registros = {}       # ip -> StatusImpressora
+        self._removidos = {}       # ip -> versão em que saiu (para o delta)
+        self._disponiveis = 0
+        self._cache_json = (-1, b"")
+        self.boot = secrets.token_hex(4)   # versão reinicia no restart; boot diferencia
+        self.versao = 0
+
+    def __contains__(self, ip):
+        return ip in self._registros
+
+    def __getitem__(self, ip):
+        return self._registros[ip]
+
+    def get(self, ip, default=None):
+        return self._registros.get(ip, default)
+
+    def values(self):
+        return list(self._registros.values())
+
+    @property
+    def disponiveis(self):
+        return self._disponiveis
+
+    def publicar(self, registro):
+        """Grava o registro; retorna None se nada mudou no card."""
+        with self._lock:
+            atual = self._registros.get(registro.ip)
+            if atual is not None and atual.mesmo_conteudo(registro):
+                return None
+
+            self.versao += 1
+            registro.versao = self.versao
+            self._registros[registro.ip] = registro
+            self._removidos.pop(registro.ip, None)
+            self._disponiveis += (registro.cor == 'ready') - (atual is not None and atual.cor == 'ready')
+            return registro
+
+    def remover(self, ip):
+        with self._lock:
+            atual = self._registros.pop(ip, None)
+            if atual is None:
+                return False
+            self.versao += 1
+            self._removidos[ip] = self.versao
+            self._disponiveis -= (atual.cor == 'ready')
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            return {ip: r.como_dict() for ip, r in self._registros.items()}, self.versao
+
+    def delta(self, desde):
+        """Só as impressoras que mudaram (e as removidas) depois da versão `desde`."""
+        with self._lock:
+            mudaram = {ip: r.como_dict() for ip, r in self._registros.items() if r.versao > desde}
+            removidas = [ip for ip, v in self._removidos.items() if v > desde]
+            return mudaram, removidas, self.versao
+
+    def json_completo(self):
+        """Corpo do /status_atualizado, serializado uma vez por versão."""
+        versao, corpo = self._cache_json
+        if versao == self.versao:
+            return corpo, versao
+
+        impressoras, versao = self.snapshot()
+        corpo = json.dumps({
+            "impressoras": impressoras,
+            "total_disponiveis": self._disponiveis,
+            "versao": versao,
+            "boot": self.boot
+        }, separators=(",", ":")).encode("utf-8")
+        self._cache_json = (versao, corpo)
+        return corpo, versao
+
+    def etag(self, versao):
+        return f"{self.boot}-{versao}"
+# --- Fim Estado Versionado da Farm ---
+
 # Dicionários Globais - Memória de Status
-IMPRESSORAS_ENCONTRADAS = {}
+IMPRESSORAS_ENCONTRADAS = EstadoFarm()
 PROGRESSO_UPLOAD = {} 
 
 ARQUIVO_PRODUCAO = 'producao_diaria.json'
 ULTIMO_STATUS_MAQUINAS = {} # Para detectar a transição de status
+INICIO_IMPRESSAO = {}       # ip -> datetime UTC em que entrou em "printing"
 
 
 FALHAS_CONSECUTIVAS = {}
 
 
-thread_local = threading.local()
+# ==========================================================================
+# CLIENTE HTTP CENTRAL (POOL KEEP-ALIVE POR IMPRESSORA)
+# ==========================================================================
+# Todo tráfego com as impressoras (status, comandos, uploads, listagens)
+# passa por aqui: uma Session por host, reaproveitada entre monitor,
+# uploads e comandos. O pool do urllib3 é thread-safe; como não usamos
+# cookies, compartilhar a Session entre threads é seguro.
+TIMEOUTS_IMPRESSORA = {          # (connect, read) por classe de operação
+    "status":   (0.8, 3.0),
+    "detalhes": (0.8, 1.5),
+    "comando":  (2.0, 5.0),
+    "arquivos": (3.0, 10.0),
+    "start":    (3.0, 15.0),
+    "upload":   (8.0, 1800),
+}
+POOL_CONEXOES_POR_HOST = 4      # upload + comando + detalhes em paralelo
+
+
+class ClientesImpressoras:
+    """Registro de Sessions por host com contadores de reuso de conexão."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessoes = {}   # host -> requests.Session
+
+    def sessao(self, host):
+        with self._lock:
+            s = self._sessoes.get(host)
+            if s is None:
+                s = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=POOL_CONEXOES_POR_HOST,
+                    max_retries=0
+                )
+                s.mount("http://", adapter)
+                s.headers.update({"Connection": "keep-alive"})
+                self._sessoes[host] = s
+            return s
+
+    def request(self, metodo, url, operacao="status", timeout=None, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        timeout = timeout or TIMEOUTS_IMPRESSORA[operacao]
+        return self.sessao(host).request(metodo, url, timeout=timeout, **kwargs)
+
+    def descartar(self, host):
+        """Fecha o pool de uma impressora removida da farm."""
+        with self._lock:
+            s = self._sessoes.pop(host, None)
+        if s:
+            s.close()
+
+    def estatisticas(self):
+        """
+        requisicoes = total enviado; conexoes_novas = pool miss (TCP novo);
+        reusos = pool hit (foi numa conexão keep-alive já aberta).
+        """
+        por_host = {}
+        with self._lock:
+            sessoes = list(self._sessoes.items())
+
+        for host, s in sessoes:
+            reqs = novas = 0
+            adapter = s.get_adapter("http://")
+            pools = adapter.poolmanager.pools
+            for chave in list(pools.keys()):
+                pool = pools.get(chave)
+                if pool is None:
+                    continue
+                reqs += pool.num_requests
+                novas += pool.num_connections
+            por_host[host] = {"requisicoes": reqs, "conexoes_novas": novas, "reusos": max(reqs - novas, 0)}
+
+        total_reqs = sum(h["requisicoes"] for h in por_host.values())
+        total_novas = sum(h["conexoes_novas"] for h in por_host.values())
+        return {
+            "requisicoes": total_reqs,
+            "conexoes_novas": total_novas,
+            "reusos": max(total_reqs - total_novas, 0),
+            "taxa_reuso": round(1 - total_novas / total_reqs, 3) if total_reqs else 0,
+            "hosts": por_host
+        }
 
-def get_session():
-    """
-    Uma requests.Session por thread => thread-safe.
-    Evita comportamento doido quando várias threads usam a mesma Session.
-    """
-    if not hasattr(thread_local, "sess"):
-        s = requests.Session()
-        s.headers.update({"Connection": "keep-alive"})
-        thread_local.sess = s
-    return thread_local.sess
 
-def http_get(url, timeout=3.0):
-    sess = get_session()
-    return sess.get(url, timeout=timeout)
+CLIENTES = ClientesImpressoras()
 
-def http_post(url, timeout=5.0, **kwargs):
-    sess = get_session()
-    return sess.post(url, timeout=timeout, **kwargs)
+def http_get(url, timeout=None, operacao="status", **kwargs):
+    return CLIENTES.request("GET", url, operacao=operacao, timeout=timeout, **kwargs)
+
+def http_post(url, timeout=None, operacao="comando", **kwargs):
+    return CLIENTES.request("POST", url, operacao=operacao, timeout=timeout, **kwargs)
 
 # =========================================================
 # SEGURANÇA: BLOQUEIO DE COMANDOS QUE RESTARTAM O KLIPPER
@@ -120,17 +360,193 @@ class Maquina(db.Model):
     nome = db.Column(db.String(50), nullable=False)           # Nome da Neptune 4 MAX
     modelo = db.Column(db.String(50), default="Neptune 4 MAX") # Modelo padrão
     imagem = db.Column(db.String(100), default="n4max.png")   # Nome da imagem na pasta static
+    grupo_rede = db.Column(db.String(50))                      # Tag do access point (vazio = usa a sub-rede /24)
+    tags = db.Column(db.String(200))                           # Pools do despacho automático: "pla,bico-04"
 
 # MODELO: Tabela que salva o histórico de peças produzidas
 class RegistroProducao(db.Model):
+    # upsert do contador (INSERT ... ON CONFLICT) depende deste índice único
+    __table_args__ = (db.UniqueConstraint('nome_peca', 'data', name='uq_producao_peca_data'),)
     id = db.Column(db.Integer, primary_key=True)
-    data = db.Column(db.Date, default=datetime.utcnow)        # Data da conclusão
+    data = db.Column(db.Date, default=datetime.utcnow, index=True)  # Data da conclusão
     nome_peca = db.Column(db.String(200), nullable=False)     # Nome do arquivo G-Code
     quantidade = db.Column(db.Integer, default=1)             # Quantos ciclos foram feitos
 
+# MODELO: Uma linha por impressão concluída (para análise por máquina / horário)
+class EventoProducao(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    ip = db.Column(db.String(50), index=True)
+    nome_arquivo = db.Column(db.String(255), nullable=False)  # como o Klipper reportou
+    nome_peca = db.Column(db.String(200), nullable=False)     # mesma chave do RegistroProducao
+    data = db.Column(db.Date, index=True)                     # dia (UTC) em que contou no RegistroProducao
+    inicio = db.Column(db.DateTime)                           # None = começou antes do app subir
+    fim = db.Column(db.DateTime, nullable=False)
+
+# MODELO: Produção pré-agregada por dia/semana/mês × impressora × peça (relatórios)
+class ResumoProducao(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('periodo', 'inicio', 'ip', 'nome_peca', name='uq_resumo_producao'),
+        db.Index('ix_resumo_producao_peca', 'periodo', 'nome_peca', 'inicio'),
+        db.Index('ix_resumo_producao_ip', 'periodo', 'ip', 'inicio'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    periodo = db.Column(db.String(6), nullable=False)         # 'dia' | 'semana' | 'mes'
+    inicio = db.Column(db.Date, nullable=False)               # 1º dia do período (semana começa na segunda)
+    ip = db.Column(db.String(50), nullable=False, default='') # '' = sem impressora (histórico antigo)
+    nome_peca = db.Column(db.String(200), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+    segundos = db.Column(db.Float, nullable=False, default=0)  # tempo de impressão somado (quando conhecido)
+
+# MODELO: O que já enviamos para cada impressora (permite pular o upload repetido)
+class ArquivoRemoto(db.Model):
+    __table_args__ = (db.UniqueConstraint('ip', 'nome', name='uq_arquivo_remoto_ip_nome'),)
+    id = db.Column(db.Integer, primary_key=True)
+    ip = db.Column(db.String(20), nullable=False, index=True)
+    nome = db.Column(db.String(255), nullable=False)          # path dentro do root=gcodes
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)         # hash do conteúdo local enviado
+    mtime_local = db.Column(db.Float)                         # mtime do arquivo no Samba
+    mtime_remoto = db.Column(db.Float)                        # "modified" do Moonraker após o upload
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+# MODELO: Espelho da PASTA_RAIZ (o /navegar lê daqui, não do Samba)
+class ItemBiblioteca(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    caminho = db.Column(db.String(500), unique=True, nullable=False)  # relativo à raiz ('' = raiz)
+    pasta = db.Column(db.String(500), index=True)                      # caminho da pasta-mãe
+    nome = db.Column(db.String(255), nullable=False)
+    tipo = db.Column(db.String(10), nullable=False)                    # 'pasta' | 'arquivo'
+    tamanho = db.Column(db.BigInteger, default=0)
+    mtime = db.Column(db.Float)     # pasta: mtime da última listagem sincronizada (None = nunca listada)
+
+# MODELO: Resultado da análise de G-code por versão do arquivo (tamanho + mtime)
+class AnaliseGcode(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    caminho = db.Column(db.String(500), unique=True, nullable=False)  # relativo à PASTA_RAIZ
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    completo = db.Column(db.Boolean, default=False)                    # passou pela análise completa
+    dados = db.Column(db.Text, nullable=False)                         # JSON de analisar_gcode
+    calculado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+# MODELO: Job da fila de impressão (bind "fila" → fila_jobs.db, sobrevive a reinício)
+class JobImpressao(db.Model):
+    __bind_key__ = 'fila'
+    id = db.Column(db.Integer, primary_key=True)
+    ip = db.Column(db.String(50), index=True)                          # None = job de pool ainda sem impressora
+    pool_modelo = db.Column(db.String(50))                              # pool: modelo exigido (vazio = qualquer)
+    pool_tag = db.Column(db.String(50))                                 # pool: tag exigida (vazio = qualquer)
+    caminho = db.Column(db.String(1000), nullable=False)
+    arquivo_label = db.Column(db.String(255))
+    estado = db.Column(db.String(15), index=True, default='aguardando')  # aguardando | executando | concluido | erro | cancelado
+    tentativas = db.Column(db.Integer, default=0)                       # execuções iniciadas (reinícios contam)
+    retomado = db.Column(db.Boolean, default=False)                     # voltou para a fila após queda do processo
+    etapa = db.Column(db.String(30))                                    # etapa atual enquanto executa
+    duracoes = db.Column(db.Text)                                       # JSON etapa -> segundos
+    erro = db.Column(db.String(500))
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime)
+    finalizado_em = db.Column(db.DateTime)
+
+# --- Inicio Migração Leve ---
+def garantir_coluna(tabela, coluna, tipo_sql, bind=None):
+    """create_all não altera tabela existente: adiciona a coluna nova no .db antigo."""
+    engine = db.engines[bind] if bind else db.engine
+    with engine.begin() as conn:
+        existentes = {r[1] for r in conn.exec_driver_sql(f"PRAGMA table_info({tabela})")}
+        if coluna not in existentes:
+            conn.exec_driver_sql(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo_sql}")
+            print(f"🛠️ Coluna {tabela}.{coluna} adicionada ao SQLite")
+
+def garantir_unico_producao():
+    """
+    .db antigo não tem o índice único (nome_peca, data): junta as linhas
+    duplicadas somando a quantidade na mais antiga e só então cria o índice.
+    """
+    with db.engine.begin() as conn:
+        existe = conn.exec_driver_sql(
+            "SELECT 1 FROM pragma_index_list('registro_producao') WHERE [unique] = 1").first()
+        if existe:
+            return
+        duplicadas = conn.exec_driver_sql(
+            "SELECT nome_peca, data, MIN(id), SUM(quantidade), COUNT(*) FROM registro_producao "
+            "GROUP BY nome_peca, data HAVING COUNT(*) > 1").fetchall()
+        for nome_peca, data, manter, total, n in duplicadas:
+            conn.exec_driver_sql("UPDATE registro_producao SET quantidade = ? WHERE id = ?", (total, manter))
+            conn.exec_driver_sql("DELETE FROM registro_producao WHERE nome_peca = ? AND data = ? AND id <> ?",
+                                 (nome_peca, data, manter))
+        conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS uq_producao_peca_data "
+                             "ON registro_producao (nome_peca, data)")
+        print(f"🛠️ Índice único de produção criado ({len(duplicadas)} grupo(s) duplicado(s) mesclado(s))")
+
+def garantir_resumo_producao():
+    """
+    Índice de data no .db antigo e, se o resumo estiver vazio, carga inicial:
+    eventos (com impressora) + o que o contador diário tem a mais (ip '').
+    """
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_registro_producao_data ON registro_producao (data)")
+        if conn.exec_driver_sql("SELECT 1 FROM resumo_producao LIMIT 1").first():
+            return
+        if not conn.exec_driver_sql("SELECT 1 FROM registro_producao LIMIT 1").first():
+            return
+        conn.exec_driver_sql("""
+            INSERT INTO resumo_producao (periodo, inicio, ip, nome_peca, quantidade, segundos)
+            SELECT 'dia', data, ip, nome_peca, SUM(n), SUM(seg) FROM (
+                SELECT data, COALESCE(ip, '') AS ip, nome_peca, COUNT(*) AS n,
+                       COALESCE(SUM((julianday(fim) - julianday(inicio)) * 86400), 0) AS seg
+                FROM evento_producao GROUP BY data, COALESCE(ip, ''), nome_peca
+                UNION ALL
+                SELECT r.data, '', r.nome_peca, r.quantidade - COALESCE(e.n, 0), 0
+                FROM registro_producao r
+                LEFT JOIN (SELECT data, nome_peca, COUNT(*) AS n FROM evento_producao
+                           GROUP BY data, nome_peca) e ON e.data = r.data AND e.nome_peca = r.nome_peca
+                WHERE r.quantidade > COALESCE(e.n, 0)
+            ) GROUP BY data, ip, nome_peca""")
+        for periodo, expr in (("semana", "date(inicio, 'weekday 0', '-6 days')"),
+                              ("mes", "date(inicio, 'start of month')")):
+            conn.exec_driver_sql(f"""
+                INSERT INTO resumo_producao (periodo, inicio, ip, nome_peca, quantidade, segundos)
+                SELECT '{periodo}', {expr}, ip, nome_peca, SUM(quantidade), SUM(segundos)
+                FROM resumo_producao WHERE periodo = 'dia' GROUP BY {expr}, ip, nome_peca""")
+        n = conn.exec_driver_sql("SELECT COUNT(*) FROM resumo_producao").scalar()
+        print(f"🛠️ Resumo de produção montado a partir do histórico ({n} linha(s))")
+
+def garantir_versao_tabela(tabela):
+    """Contador em versao_tabela que os gatilhos sobem a cada INSERT/UPDATE/DELETE."""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS versao_tabela "
+                             "(nome VARCHAR(50) PRIMARY KEY, versao INTEGER NOT NULL DEFAULT 0)")
+        conn.exec_driver_sql("INSERT OR IGNORE INTO versao_tabela (nome, versao) VALUES (?, 0)", (tabela,))
+        for operacao in ("INSERT", "UPDATE", "DELETE"):
+            conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS trg_versao_{tabela}_{operacao.lower()} "
+                f"AFTER {operacao} ON {tabela} BEGIN "
+                f"UPDATE versao_tabela SET versao = versao + 1 WHERE nome = '{tabela}'; END")
+# --- Fim Migração Leve ---
+
+def configurar_sqlite_wal(engine):
+    """WAL + busy_timeout em cada conexão nova: leitura (monitor, fila) não espera escrita da web."""
+    @event.listens_for(engine, "connect")
+    def _pragmas(conexao, _registro):
+        cur = conexao.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.close()
+
 # COMANDO: Cria as tabelas fisicamente no arquivo .db ao iniciar o app
 with app.app_context():
+    for _engine in db.engines.values():
+        configurar_sqlite_wal(_engine)
     db.create_all()
+    garantir_coluna("maquina", "grupo_rede", "VARCHAR(50)")
+    garantir_coluna("maquina", "tags", "VARCHAR(200)")
+    garantir_coluna("job_impressao", "pool_modelo", "VARCHAR(50)", bind='fila')
+    garantir_coluna("job_impressao", "pool_tag", "VARCHAR(50)", bind='fila')
+    garantir_unico_producao()
+    garantir_versao_tabela("maquina")
+    garantir_resumo_producao()
 
 # --- Inicio Funcao Auxiliar de Ordenacao ---
 def chave_ordem_maquina(m):
@@ -163,34 +579,71 @@ if not os.path.exists(PASTA_RAIZ):
     print(f"🚨 ERRO CRÍTICO: A pasta {PASTA_RAIZ} não foi encontrada no servidor!")
 
 # --- Inicio Funcao Carregar Maquinas ---
+class RegistroMaquinas:
+    """
+    Lista de máquinas já ordenada (chave_ordem_maquina) em memória.
+    O monitor pedia Maquina.query.all() + sort a cada 3 s e o / também.
+    Agora o SQLite só é lido quando a tabela muda: salvar/remover invalidam
+    na hora e, para mudanças de fora (outro processo, sqlite3 na mão), um
+    gatilho incrementa versao_tabela['maquina'], conferida no máximo a cada
+    REGISTRO_VERIFICA_S com um SELECT de uma linha.
+    """
+    REGISTRO_VERIFICA_S = 3.0
+    COLUNAS = ("ip", "nome", "modelo", "imagem", "grupo_rede", "tags")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engine = None
+        self._lista = None
+        self._versao = None
+        self._verificado_em = 0.0
+        self.recargas = 0
+
+    def _conexao(self):
+        if self._engine is None:
+            with app.app_context():
+                self._engine = db.engine
+        return self._engine.connect()
+
+    def invalidar(self):
+        with self._lock:
+            self._lista = None
+
+    def obter(self):
+        agora = time.monotonic()
+        with self._lock:
+            if self._lista is not None and agora - self._verificado_em < self.REGISTRO_VERIFICA_S:
+                return list(self._lista)
+            with self._conexao() as conn:
+                versao = conn.exec_driver_sql(
+                    "SELECT versao FROM versao_tabela WHERE nome = 'maquina'").scalar()
+                if self._lista is None or versao != self._versao:
+                    linhas = conn.exec_driver_sql(
+                        f"SELECT {', '.join(self.COLUNAS)} FROM maquina").fetchall()
+                    self._lista = tuple(sorted((dict(zip(self.COLUNAS, l)) for l in linhas),
+                                               key=chave_ordem_maquina))
+                    self._versao = versao
+                    self.recargas += 1
+            self._verificado_em = agora
+            return list(self._lista)
+
+REGISTRO_MAQUINAS = RegistroMaquinas()
+
+
 def carregar_maquinas():
     """
-    Busca todas as impressoras no banco SQLite e retorna 
-    uma lista de dicionários ORDENADA para o seu front-end.
+    Retorna a lista de impressoras (dicts) ORDENADA para o seu front-end.
+    Vem do RegistroMaquinas: não abre sessão nem app_context.
     """
     try:
-        # Busca todos os registros na tabela Maquina
-        maquinas_db = Maquina.query.all()
-        
-        # Converte os objetos do banco para o formato de dicionário que seu código já usa
-        lista_maquinas = []
-        for m in maquinas_db:
-            lista_maquinas.append({
-                "ip": m.ip,
-                "nome": m.nome,
-                "modelo": m.modelo,
-                "imagem": m.imagem
-            })
-        
-        # Retorna a lista usando a sua regra de ordenação por número no nome
-        return sorted(lista_maquinas, key=chave_ordem_maquina)
+        return REGISTRO_MAQUINAS.obter()
     except Exception as e:
         print(f"🚨 Erro ao ler banco de dados em Betim: {e}")
         return []
 # --- Fim Funcao Carregar Maquinas ---
 
 # --- Inicio Funcao Salvar Maquina ---
-def salvar_maquina(ip, nome):
+def salvar_maquina(ip, nome, grupo_rede=None, tags=None):
     """
     Adiciona uma nova impressora ao banco de dados se o IP não existir.
     Elimina a necessidade de ler/escrever o arquivo JSON inteiro.
@@ -201,11 +654,12 @@ def salvar_maquina(ip, nome):
         
         if not existente:
             # Cria o novo registro
-            nova_maquina = Maquina(ip=ip, nome=nome)
+            nova_maquina = Maquina(ip=ip, nome=nome, grupo_rede=grupo_rede or None, tags=tags or None)
             
             # Adiciona e salva (commit) no arquivo .db
             db.session.add(nova_maquina)
             db.session.commit()
+            REGISTRO_MAQUINAS.invalidar()
             print(f"✅ {nome} ({ip}) salva com sucesso no SQLite!")
             return True
         
@@ -216,53 +670,346 @@ def salvar_maquina(ip, nome):
         print(f"🚨 Falha ao salvar no SQLite: {e}")
         return False
 # --- Fim Funcao Salvar Maquina ---
-class Monitor:
-    def __init__(self, file, ip_alvo):
-        self.file = file
-        self.total = os.path.getsize(file.name)
-        self.bytes_read = 0
+# ==========================================================================
+# AGENDADOR DE UPLOADS (GRUPOS DE REDE + BALDE DE BANDA)
+# ==========================================================================
+class BaldeTokens:
+    """Limita bytes/s de um grupo. Déficit vira espera proporcional."""
+    def __init__(self, mbps):
+        self.taxa = mbps * 1024 * 1024
+        self.capacidade = max(self.taxa, 256 * 1024)   # rajada de no máx. ~1s
+        self.tokens = self.capacidade
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consumir(self, n):
+        if self.taxa <= 0:
+            return
+        with self._lock:
+            agora = time.monotonic()
+            self.tokens = min(self.capacidade, self.tokens + (agora - self._t) * self.taxa)
+            self._t = agora
+            self.tokens -= n
+            deficit = -self.tokens
+        if deficit > 0:
+            time.sleep(deficit / self.taxa)
+
+
+class GrupoUpload:
+    def __init__(self, nome):
+        cfg = UPLOAD_GRUPOS_CONFIG.get(nome, {})
+        self.nome = nome
+        self.limite = int(cfg.get("concorrencia", UPLOAD_CONCORRENCIA_GRUPO))
+        self.mbps = float(cfg.get("mbps", UPLOAD_MBPS_GRUPO))
+        self.balde = BaldeTokens(self.mbps)
+        self.ativos = set()
+        self.bytes_total = 0
+        self._janela = deque()   # (t, bytes) dos últimos segundos -> MB/s atual
+        self._lock = threading.Lock()
+
+    def registrar_bytes(self, n):
+        agora = time.monotonic()
+        with self._lock:
+            self.bytes_total += n
+            self._janela.append((agora, n))
+            while self._janela and agora - self._janela[0][0] > 5:
+                self._janela.popleft()
+
+    def mb_por_segundo(self):
+        with self._lock:
+            if len(self._janela) < 2:
+                return 0.0
+            dt = max(time.monotonic() - self._janela[0][0], 0.5)
+            return round(sum(n for _, n in self._janela) / dt / (1024 * 1024), 2)
+
+
+class AgendadorUploads:
+    """
+    Substitui o UPLOAD_SEM global de 1 vaga.
+    - Grupo = tag de AP da máquina (grupo_rede) ou a sub-rede /24 do IP
+    - Cada grupo tem N vagas e um balde de MB/s; a farm tem um teto total
+    - Fila FIFO única: quem chegou primeiro entra primeiro, sem furar a vez
+      de outro IP do mesmo grupo (justo entre as filas por impressora)
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._grupos = {}          # nome -> GrupoUpload
+        self._grupo_por_ip = {}    # ip -> tag configurada no banco
+        self._espera = deque()     # (ticket, ip, grupo) em ordem de chegada
+        self._ativos_total = 0
+        self._ticket = 0
+
+    def atualizar_grupos(self, maquinas):
+        with self._cond:
+            self._grupo_por_ip = {m['ip']: m.get('grupo_rede') for m in maquinas if m.get('grupo_rede')}
+
+    def grupo_de(self, ip):
+        tag = self._grupo_por_ip.get(ip)
+        if tag:
+            return tag
+        partes = ip.split('.')
+        return ".".join(partes[:3]) + ".0/24" if len(partes) == 4 else ip
+
+    def _grupo(self, nome):
+        if nome not in self._grupos:
+            self._grupos[nome] = GrupoUpload(nome)
+        return self._grupos[nome]
+
+    def _proximo(self):
+        """Primeiro da fila cujo grupo tem vaga (e a farm também)."""
+        if self._ativos_total >= UPLOAD_CONCORRENCIA_TOTAL:
+            return None
+        for ticket, _ip, nome in self._espera:
+            g = self._grupo(nome)
+            if len(g.ativos) < g.limite:
+                return ticket
+        return None
+
+    @contextmanager
+    def vaga(self, ip):
+        nome = self.grupo_de(ip)
+        with self._cond:
+            self._ticket += 1
+            ticket = self._ticket
+            self._espera.append((ticket, ip, nome))
+            while self._proximo() != ticket:
+                self._cond.wait()
+            self._espera = deque(x for x in self._espera if x[0] != ticket)
+            grupo = self._grupo(nome)
+            grupo.ativos.add(ip)
+            self._ativos_total += 1
+        try:
+            yield grupo
+        finally:
+            with self._cond:
+                grupo.ativos.discard(ip)
+                self._ativos_total -= 1
+                self._cond.notify_all()
+
+    def estatisticas(self):
+        with self._cond:
+            grupos = list(self._grupos.values())
+            aguardando = len(self._espera)
+            ativos = self._ativos_total
+        return {
+            "ativos": ativos,
+            "aguardando": aguardando,
+            "limite_total": UPLOAD_CONCORRENCIA_TOTAL,
+            "mb_s_total": round(sum(g.mb_por_segundo() for g in grupos), 2),
+            "grupos": {
+                g.nome: {
+                    "ativos": sorted(g.ativos),
+                    "limite": g.limite,
+                    "limite_mb_s": g.mbps or None,
+                    "mb_s": g.mb_por_segundo(),
+                    "mb_enviados": round(g.bytes_total / (1024 * 1024), 1)
+                } for g in grupos
+            }
+        }
+
+
+AGENDADOR_UPLOADS = AgendadorUploads()
+
+
+class ArquivoCompartilhado:
+    """
+    G-code de um envio em massa: estabilizado e lido do Samba UMA vez para um
+    buffer mmap anônimo somente-leitura, que N uploads transmitem em paralelo.
+    (Cópia em memória anônima e não mmap do arquivo: se alguém sobrescrever o
+    .gcode no meio do lote, o mmap do arquivo truncado derrubaria o processo.)
+    """
+    def __init__(self, caminho, referencias):
+        self.caminho = caminho
+        self.tamanho = 0
+        self.mtime = None
+        self.buffer = None
+        self.sha256 = None             # calculado sob demanda, uma vez por lote
+        self.ok = None                 # None = ainda não preparado
+        self._refs = referencias       # um por impressora do lote
+        self._lock = threading.Lock()
+
+    def preparar(self, ip_alvo=None):
+        """Primeiro worker que chegar estabiliza e carrega; os outros esperam o resultado."""
+        with self._lock:
+            if self.ok is not None:
+                return self.ok
+
+            log(ip_alvo or "LOTE", "LOTE", f"Preparando buffer único: {self.caminho}")
+            self.ok = False
+            if not aguardar_estabilidade_arquivo(self.caminho):
+                return False
+
+            tamanho = os.path.getsize(self.caminho)
+            buf = mmap.mmap(-1, tamanho)
+            with open(self.caminho, "rb") as f:
+                lidos = 0
+                while lidos < tamanho:
+                    n = f.readinto(memoryview(buf)[lidos:lidos + 8 * 1024 * 1024])
+                    if not n:
+                        break
+                    lidos += n
+
+            if lidos != tamanho:
+                buf.close()
+                log(ip_alvo or "LOTE", "LOTE", f"Leitura incompleta ({lidos}/{tamanho})")
+                return False
+
+            self.buffer = buf
+            self.tamanho = tamanho
+            self.mtime = os.path.getmtime(self.caminho)
+            self.ok = True
+            log(ip_alvo or "LOTE", "LOTE", f"Buffer pronto | size={tamanho}")
+            return True
+
+    def hash_conteudo(self):
+        with self._lock:
+            if self.sha256 is None and self.buffer is not None:
+                self.sha256 = hashlib.sha256(self.buffer).hexdigest()
+            return self.sha256
+
+    def liberar(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs <= 0 and self.buffer is not None:
+                try:
+                    self.buffer.close()
+                except BufferError:
+                    pass   # ainda há memoryview viva; o GC libera o mmap depois
+                self.buffer = None
+
+
+class CorpoMultipart:
+    """
+    Corpo multipart/form-data em streaming com Content-Length conhecido.
+    O requests itera os pedaços (não lê o arquivo inteiro de uma vez), o que
+    permite aplicar o balde de banda do grupo e reportar o progresso real.
+
+    Memória por upload é fixa (um buffer de CHUNK), independente do tamanho
+    do G-code: o arquivo é lido com readinto() sempre no mesmo bytearray e
+    entregue como memoryview; no lote, as fatias do mmap vão sem cópia.
+    Reusar o buffer é seguro porque o http.client envia cada pedaço
+    (sendall) antes de pedir o próximo.
+
+    Sem sha256 conhecido, o hash é calculado sobre os próprios pedaços
+    enviados (self.sha256 fica pronto no fim): o arquivo não é lido duas vezes.
+    Com enviar_checksum o hash vai no campo "checksum" do Moonraker: antes do
+    arquivo quando já é conhecido, senão numa parte depois dele (o Moonraker
+    só confere depois de receber o corpo inteiro, a ordem não importa).
+    """
+    CHUNK = 256 * 1024
+
+    def __init__(self, caminho, nome_arquivo, ip_alvo, grupo=None, lote=None, campos=None, sha256=None,
+                 enviar_checksum=False):
+        self.caminho = caminho
         self.ip_alvo = ip_alvo
+        self.grupo = grupo
+        self.lote = lote              # ArquivoCompartilhado: lê do buffer, não do Samba
+        self.total = lote.tamanho if lote else os.path.getsize(caminho)
+        self.sha256 = sha256
+        self._hash = hashlib.sha256() if sha256 is None else None
+        self.bytes_read = 0
+        self._inicio = 0.0
         self._last_update = 0.0
         self._min_interval = 0.3
 
+        self.boundary = secrets.token_hex(16)
+        nome_seguro = nome_arquivo.replace('"', '%22').replace('\r', '').replace('\n', '')
+        campos = dict(campos or {})
+        if enviar_checksum and sha256:
+            campos["checksum"] = sha256
+        # checksum ainda desconhecido: parte de tamanho fixo (64 hex) depois do arquivo
+        self._checksum_no_fim = enviar_checksum and not sha256
+        # campos simples (ex.: print=true) vão antes do arquivo
+        extras = "".join(
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{nome}"\r\n\r\n'
+            f"{valor}\r\n"
+            for nome, valor in campos.items()
+        )
+        self._inicio_parte = (
+            extras +
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{nome_seguro}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        self._fim_parte = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._parte_checksum = (
+            f"\r\n--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="checksum"\r\n\r\n'
+        ).encode("utf-8") if self._checksum_no_fim else b""
+
         log(ip_alvo, "MONITOR", f"Iniciado | size={self.total}")
 
-    def read(self, size=-1):
-        try:
-            # ✅ Se o requests pedir "tudo" (size=-1/None), NÃO limite.
-            if size is None or size < 0:
-                data = self.file.read()  # lê o restante inteiro
-            else:
-                # ✅ Se pedir em chunks, você pode limitar para performance
-                size = min(size, 256 * 1024)
-                data = self.file.read(size)
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        checksum = len(self._parte_checksum) + 64 if self._checksum_no_fim else 0
+        return len(self._inicio_parte) + self.total + checksum + len(self._fim_parte)
+
+    def mb_por_segundo(self):
+        dt = time.monotonic() - self._inicio
+        return round(self.bytes_read / dt / (1024 * 1024), 2) if dt > 0 else 0.0
 
-            n = len(data)
-            self.bytes_read += n
+    def _progresso(self, n):
+        self.bytes_read += n
+        if self.grupo:
+            self.grupo.registrar_bytes(n)
 
-            now = time.time()
-            if self.total > 0:
-                percent = int((self.bytes_read / self.total) * 100)
+        now = time.time()
+        if self.total > 0:
+            percent = int((self.bytes_read / self.total) * 100)
 
-                if (now - self._last_update) >= self._min_interval or self.bytes_read >= self.total:
-                    self._last_update = now
+            if (now - self._last_update) >= self._min_interval or self.bytes_read >= self.total:
+                self._last_update = now
 
-                    msg = f"[UPLOAD] {percent}%"
-                    if percent >= 100:
-                        msg = "[UPLOAD] Finalizando..."
+                msg = f"[UPLOAD] {percent}% · {self.mb_por_segundo()} MB/s"
+                if percent >= 100:
+                    msg = "[UPLOAD] Finalizando..."
 
-                    PROGRESSO_UPLOAD[self.ip_alvo] = {"p": percent, "msg": msg}
-                    log(self.ip_alvo, "UPLOAD", f"{percent}% ({self.bytes_read}/{self.total})")
+                PROGRESSO_UPLOAD[self.ip_alvo] = {"p": percent, "msg": msg}
+                log(self.ip_alvo, "UPLOAD", f"{percent}% ({self.bytes_read}/{self.total})")
 
-            return data
+    def _pedacos(self):
+        if self.lote:
+            mv = memoryview(self.lote.buffer)
+            for pos in range(0, self.total, self.CHUNK):
+                yield mv[pos:pos + self.CHUNK]
+            return
 
+        buf = memoryview(bytearray(self.CHUNK))
+        restante = self.total
+        with open(self.caminho, "rb", buffering=0) as f:
+            while restante > 0:
+                n = f.readinto(buf[:min(self.CHUNK, restante)])
+                if not n:
+                    # Content-Length já foi enviado: não dá para mandar menos bytes
+                    raise Exception(f"Arquivo encolheu durante o upload ({self.total - restante}/{self.total})")
+                restante -= n
+                yield buf[:n]
+
+    def __iter__(self):
+        self._inicio = time.monotonic()
+        yield self._inicio_parte
+        try:
+            for data in self._pedacos():
+                if self.grupo:
+                    self.grupo.balde.consumir(len(data))
+                if self._hash is not None:
+                    self._hash.update(data)
+                yield data
+                self._progresso(len(data))
         except Exception as e:
             log(self.ip_alvo, "ERRO_MONITOR", str(e))
             PROGRESSO_UPLOAD[self.ip_alvo] = {"p": -1, "msg": "[MONITOR] erro"}
             raise
+        if self._hash is not None:
+            self.sha256 = self._hash.hexdigest()
+        if self._checksum_no_fim:
+            yield self._parte_checksum + self.sha256.encode("ascii")
+        yield self._fim_parte
 
-    def __getattr__(self, attr):
-        return getattr(self.file, attr)
 
 # --- FUNÇÕES DE REDE E MONITORAMENTO ---
 def testar_conexao_rapida(ip, porta=80):
@@ -291,72 +1038,371 @@ def carregar_tokens():
         return {}
 
 def salvar_tokens(tokens):
-    with open(TOKENS_PATH, 'w') as f:
+    # grava ao lado e troca de uma vez: um crash no meio nunca deixa o arquivo pela metade
+    tmp = TOKENS_PATH + ".tmp"
+    with open(tmp, 'w') as f:
         json.dump(tokens, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, TOKENS_PATH)
 
 
-
-
-# 2. Lógica de Renovação Automática (OAuth 2.0) - VERSÃO CORRIGIDA
-def garantir_token_valido(forcar_renovacao=False):
-    tokens = carregar_tokens()
-    if not tokens:
-        raise Exception("Nenhum token encontrado. Acesse /login_bling primeiro.")
-
-    agora = time.time()
-    # ✅ CORREÇÃO: Renova se o tempo expirou OU se o sistema forçar (após erro 401)
-    if forcar_renovacao or agora > (tokens.get('expires_at', 0) - 300):
+# 2. Gerenciador de Tokens em memória (OAuth 2.0)
+class TokensBling:
+    """
+    Token em memória; o tokens.json só é lido na primeira vez e gravado após
+    cada renovação. O Bling troca o refresh_token a cada uso, então só uma
+    renovação pode acontecer por vez: as outras chamadas esperam o lock e
+    usam o token que a primeira obteve.
+    """
+    def __init__(self):
+        self._tokens = None
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._falhou_em = 0.0
+        self.precisa_login = False    # Bling recusou o refresh_token: só um login novo resolve
+        self.renovacoes = 0
+        self.falhas = 0
+
+    def _carregar(self):
+        # chamado com o lock; o disco só é lido enquanto não houver token
+        if not self._tokens:
+            self._tokens = carregar_tokens()
+        return self._tokens
+
+    def _precisa_renovar(self, tokens):
+        return time.time() > tokens.get('expires_at', 0) - TOKEN_RENOVAR_ANTES_S
+
+    def obter(self, forcar_renovacao=False, rejeitado=None):
+        tokens = self._tokens
+        if tokens and not forcar_renovacao and not self._precisa_renovar(tokens):
+            return tokens.get('access_token')
+
+        with self._lock:
+            tokens = self._carregar()
+            if not tokens:
+                raise Exception("Nenhum token encontrado. Acesse /login_bling primeiro.")
+            # outra chamada já renovou enquanto esta esperava o lock
+            if forcar_renovacao and rejeitado and tokens.get('access_token') != rejeitado:
+                return tokens.get('access_token')
+            if not forcar_renovacao and not self._precisa_renovar(tokens):
+                return tokens.get('access_token')
+            # renovação acabou de falhar (ou o refresh_token morreu): não martela o Bling
+            novo = None
+            if not self.precisa_login and time.time() - self._falhou_em >= TOKEN_ESPERA_FALHA_S:
+                novo = self._renovar(tokens)
+            if novo or forcar_renovacao:
+                return novo
+            # falhou, mas o token atual ainda não venceu: segue com ele
+            return tokens.get('access_token') if time.time() < tokens.get('expires_at', 0) else None
+
+    def _renovar(self, tokens):
+        # chamado com o lock
         print("🔄 Renovando acesso para múltiplos dispositivos...")
         url = "https://www.bling.com.br/Api/v3/oauth/token"
-        
+
         payload = {
             "grant_type": "refresh_token",
             "refresh_token": tokens['refresh_token']
         }
-        
+
         # O Bling exige o Client ID e Secret via Basic Auth ou no Payload
         try:
+            agora = time.time()
             response = requests.post(url, data=payload, auth=(CLIENT_ID, CLIENT_SECRET), timeout=10)
-            
+
             if response.status_code == 200:
                 novos_dados = response.json()
-                tokens['access_token'] = novos_dados['access_token']
+                novos = dict(tokens)
+                novos['access_token'] = novos_dados['access_token']
                 # ✅ IMPORTANTE: O Bling pode mandar um novo refresh_token, você deve salvar!
-                tokens['refresh_token'] = novos_dados.get('refresh_token', tokens['refresh_token'])
-                tokens['expires_at'] = agora + novos_dados['expires_in']
-                salvar_tokens(tokens)
+                novos['refresh_token'] = novos_dados.get('refresh_token', tokens['refresh_token'])
+                novos['expires_at'] = agora + novos_dados['expires_in']
+                self._tokens = novos
+                self._falhou_em = 0.0
+                self.renovacoes += 1
+                salvar_tokens(novos)
+                self._acordar.set()
                 print("✅ Token renovado com sucesso!")
+                return novos['access_token']
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # 🚨 O refresh_token morreu: para de tentar até o próximo login (definir)
+                self.precisa_login = True
+                print(f"🚨 Refresh Token expirou ou é inválido: {response.text} → acesse /login_bling")
             else:
-                # 🚨 Se a renovação falhar, o refresh_token morreu. Precisa de login manual.
-                print(f"🚨 Refresh Token expirou ou é inválido: {response.text}")
-                return None 
+                print(f"🚨 Bling indisponível na renovação ({response.status_code}): {response.text[:200]}")
         except Exception as e:
             print(f"🚨 Falha de rede na renovação: {e}")
-            return None
-    
-    return tokens.get('access_token')
+        self._falhou_em = time.time()
+        self.falhas += 1
+        return None
+
+    def definir(self, tokens):
+        """Login novo (/callback): substitui o token em memória e no disco."""
+        with self._lock:
+            self._tokens = tokens
+            self._falhou_em = 0.0
+            self.precisa_login = False
+            salvar_tokens(tokens)
+        self._acordar.set()
+
+    def iniciar(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        # renova antes de vencer, fora do caminho das requisições
+        while True:
+            with self._lock:
+                tokens = self._carregar()
+            if self.precisa_login:
+                # refresh_token recusado: dorme até o /callback chamar definir()
+                self._acordar.wait()
+                self._acordar.clear()
+                continue
+            if tokens.get('refresh_token'):
+                falta = tokens.get('expires_at', 0) - TOKEN_RENOVAR_ANTES_S - TOKEN_FOLGA_FUNDO_S - time.time()
+            else:
+                falta = 3600
+            if falta > 0:
+                self._acordar.wait(timeout=falta)
+                self._acordar.clear()
+                continue
+            with self._lock:
+                tokens = self._carregar()
+                vence_em = tokens.get('expires_at', 0) - TOKEN_RENOVAR_ANTES_S - TOKEN_FOLGA_FUNDO_S
+                if (not self.precisa_login and time.time() >= vence_em
+                        and time.time() - self._falhou_em >= TOKEN_ESPERA_FALHA_S):
+                    self._renovar(tokens)
+            self._acordar.wait(timeout=TOKEN_ESPERA_FALHA_S)
+            self._acordar.clear()
+
+    def estatisticas(self):
+        tokens = self._tokens or {}
+        return {
+            "carregado": bool(tokens),
+            "expira_em_s": round(tokens.get('expires_at', 0) - time.time()) if tokens else None,
+            "precisa_login": self.precisa_login,
+            "renovacoes": self.renovacoes,
+            "falhas": self.falhas,
+        }
 
-# 3. Busca de Estoque com Cache de 5 Minutos
-def buscar_estoque_bling(headers):
-    agora = time.time()
-    if cache_estoque["dados"] and agora < cache_estoque["expira_em"]:
-        return cache_estoque["dados"]
 
-    # Rota correta para trazer NOME + FOTO + ESTOQUE (8,00)
-    url = "https://www.bling.com.br/Api/v3/produtos?estoque=S"
-    
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            cache_estoque["dados"] = response.json()
-            cache_estoque["expira_em"] = agora + 300
-            return cache_estoque["dados"]
-        return {"data": []}
-    except Exception as e:
-        print(f"Erro na API: {e}")
-        return {"data": []}
+TOKENS_BLING = TokensBling()
+
+
+def garantir_token_valido(forcar_renovacao=False, rejeitado=None):
+    return TOKENS_BLING.obter(forcar_renovacao=forcar_renovacao, rejeitado=rejeitado)
+
+# 3. Chamadas ao Bling (token + segunda chance no 401 + espera no 429)
+def requisitar_bling(metodo, caminho, tentativas=3, **kwargs):
+    token = garantir_token_valido()
+    if not token:
+        raise Exception("Token Bling indisponível. Acesse /login_bling.")
+    url = "https://www.bling.com.br/Api/v3" + caminho
+    kwargs.setdefault("timeout", 15)
+    renovado = False
+    for tentativa in range(tentativas):
+        response = requests.request(metodo, url, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        if response.status_code == 401 and not renovado:
+            print("⚠️ Token rejeitado (401). Forçando renovação...")
+            renovado = True
+            token = garantir_token_valido(forcar_renovacao=True, rejeitado=token)
+            if not token:
+                return response
+            continue
+        if response.status_code == 429 and tentativa < tentativas - 1:
+            time.sleep(1.0 + tentativa)
+            continue
+        return response
+    return response
+
+
+# 4. Estoque em cache: catálogo paginado, stale-while-revalidate e busca única
+class EstoqueBling:
+    """
+    Catálogo /produtos?estoque=S inteiro em memória.
+    - Dentro do TTL responde direto da memória.
+    - Vencido, responde o catálogo velho na hora e recarrega em segundo plano.
+    - Só um download por vez: quem chega durante a carga espera a mesma carga
+      (apenas quando ainda não há nada para servir).
+    - Ajuste de estoque atualiza só o produto afetado (/estoques/saldos).
+    """
+    def __init__(self, ttl=ESTOQUE_TTL):
+        self.ttl = ttl
+        self.produtos = {}              # id -> item, na ordem do Bling
+        self.atualizado_em = 0.0
+        self.erro = None
+        self._lock = threading.Lock()
+        self._mudou = threading.Condition(self._lock)
+        self._carregando = False
+        self._revalidando = False
+        self._pendentes = {}            # id -> instante do ajuste ainda não confirmado
+        self.cargas = 0
+        self.paginas = 0
+        self.servidos_cache = 0
+        self.servidos_velhos = 0
+        self.esperas = 0
+        self.revalidacoes = 0
+
+    def _fresco(self):
+        return self.atualizado_em and time.time() - self.atualizado_em < self.ttl
+
+    def _resposta(self):
+        return {
+            "data": list(self.produtos.values()),
+            "atualizado_em": self.atualizado_em or None,
+            "desatualizado": not self._fresco(),
+            "atualizando": self._carregando,
+            "erro": self.erro,
+        }
+
+    def _disparar(self):
+        # chamado com o lock
+        if not self._carregando:
+            self._carregando = True
+            threading.Thread(target=self._carregar, daemon=True).start()
+
+    def obter(self, atualizar=False, espera=30.0):
+        with self._lock:
+            if self._fresco() and not atualizar:
+                self.servidos_cache += 1
+                return self._resposta()
+            self._disparar()
+            if self.atualizado_em:
+                self.servidos_velhos += 1
+                return self._resposta()
+            # primeira carga: todos esperam o mesmo download
+            self.esperas += 1
+            limite = time.time() + espera
+            while self._carregando and time.time() < limite:
+                self._mudou.wait(timeout=max(0.1, limite - time.time()))
+            return self._resposta()
+
+    def _baixar_catalogo(self):
+        produtos = {}
+        pagina = 1
+        while True:
+            r = requisitar_bling("GET", "/produtos", params={
+                "estoque": "S", "pagina": pagina, "limite": ESTOQUE_LIMITE_PAGINA,
+            })
+            if r.status_code != 200:
+                raise Exception(f"Erro no Bling (página {pagina}): {r.status_code} {r.text[:200]}")
+            itens = r.json().get("data") or []
+            self.paginas += 1
+            for item in itens:
+                produtos[str(item.get("id"))] = item
+            if len(itens) < ESTOQUE_LIMITE_PAGINA:
+                return produtos, pagina
+            pagina += 1
+            time.sleep(ESTOQUE_INTERVALO_S)
+
+    def _carregar(self):
+        inicio = time.time()
+        try:
+            produtos, paginas = self._baixar_catalogo()
+        except Exception as e:
+            print(f"🚨 Estoque Bling: falha ao atualizar catálogo: {e}")
+            with self._lock:
+                self.erro = str(e)
+                self._carregando = False
+                self._mudou.notify_all()
+            return
+
+        with self._lock:
+            # ajustes feitos durante o download valem mais que a página já baixada
+            for pid in self._pendentes:
+                if pid in self.produtos and pid in produtos:
+                    produtos[pid] = self.produtos[pid]
+            self.produtos = produtos
+            self.atualizado_em = time.time()
+            self.erro = None
+            self.cargas += 1
+            self._carregando = False
+            self._mudou.notify_all()
+            revalidar = bool(self._pendentes) and not self._revalidando
+            if revalidar:
+                self._revalidando = True
+        print(f"📦 Estoque Bling: {len(produtos)} produto(s) em {paginas} página(s) ({time.time() - inicio:.1f}s)")
+        if revalidar:
+            self._revalidar()
+
+    def invalidar_produto(self, produto_id, delta=None):
+        """Ajuste feito: aplica o delta na hora e confirma o saldo no Bling em segundo plano."""
+        pid = str(produto_id)
+        with self._lock:
+            item = self.produtos.get(pid)
+            if item is not None and isinstance(delta, (int, float)) and delta:
+                estoque = dict(item.get("estoque") or {})
+                for campo in ("saldoVirtualTotal", "saldoFisicoTotal"):
+                    if isinstance(estoque.get(campo), (int, float)):
+                        estoque[campo] += delta
+                self.produtos[pid] = {**item, "estoque": estoque}
+            self._pendentes[pid] = time.time()
+            if self._revalidando:
+                return
+            self._revalidando = True
+        threading.Thread(target=self._revalidar, daemon=True).start()
+
+    def _revalidar(self):
+        while True:
+            with self._lock:
+                ids = list(self._pendentes)[:50]
+                if not ids:
+                    self._revalidando = False
+                    return
+            pedido_em = time.time()
+            try:
+                r = requisitar_bling("GET", "/estoques/saldos", params={"idsProdutos[]": ids})
+                if r.status_code != 200:
+                    raise Exception(f"{r.status_code} {r.text[:200]}")
+                saldos = r.json().get("data") or []
+            except Exception as e:
+                print(f"🚨 Estoque Bling: falha ao confirmar saldo de {len(ids)} produto(s): {e}")
+                with self._lock:
+                    # desiste do ajuste fino: a próxima consulta recarrega o catálogo
+                    for pid in ids:
+                        self._pendentes.pop(pid, None)
+                    self.atualizado_em = min(self.atualizado_em, time.time() - self.ttl)
+                continue
 
-# 4. Rotas de Autenticação e API
+            with self._lock:
+                self.revalidacoes += 1
+                for saldo in saldos:
+                    pid = str((saldo.get("produto") or {}).get("id"))
+                    item = self.produtos.get(pid)
+                    if item is not None:
+                        estoque = dict(item.get("estoque") or {})
+                        for campo in ("saldoVirtualTotal", "saldoFisicoTotal"):
+                            if campo in saldo:
+                                estoque[campo] = saldo[campo]
+                        self.produtos[pid] = {**item, "estoque": estoque}
+                for pid in ids:
+                    # ajuste novo chegou depois da consulta: confere de novo
+                    if self._pendentes.get(pid, 0) <= pedido_em:
+                        self._pendentes.pop(pid, None)
+            time.sleep(ESTOQUE_INTERVALO_S)
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "produtos": len(self.produtos),
+                "idade_s": round(time.time() - self.atualizado_em, 1) if self.atualizado_em else None,
+                "ttl_s": self.ttl,
+                "carregando": self._carregando,
+                "pendentes": len(self._pendentes),
+                "cargas": self.cargas,
+                "paginas": self.paginas,
+                "servidos_cache": self.servidos_cache,
+                "servidos_velhos": self.servidos_velhos,
+                "esperas": self.esperas,
+                "revalidacoes": self.revalidacoes,
+                "erro": self.erro,
+            }
+
+
+ESTOQUE_BLING = EstoqueBling()
+
+# 5. Rotas de Autenticação e API
 @app.route('/login_bling')
 def login_bling():
     # 1. Gera um código aleatório para o 'state'
@@ -404,54 +1450,38 @@ def callback():
             "refresh_token": dados['refresh_token'],
             "expires_at": time.time() + dados['expires_in']
         }
-        salvar_tokens(tokens)
+        TOKENS_BLING.definir(tokens)
         return "<h1>✅ SuperTech 3D: Acesso Total Liberado!</h1>"
     
     return f"Erro final: {response.text}"
 
 @app.route('/api/estoque_bling')
 def pegar_estoque():
-    try:
-        token = garantir_token_valido()
-        headers = {"Authorization": f"Bearer {token}"}
-        url = "https://www.bling.com.br/Api/v3/produtos?estoque=S"
-        
-        response = requests.get(url, headers=headers, timeout=10)
+    dados = ESTOQUE_BLING.obter(atualizar=request.args.get('atualizar') == '1')
+    if not dados["data"] and dados["erro"]:
+        return jsonify({"error": "Erro no Bling", "details": dados["erro"]}), 502
+    return jsonify(dados)
 
-        # ✅ SEGUNDA CHANCE: Se der 401, força a renovação e tenta de novo
-        if response.status_code == 401:
-            print("⚠️ Token rejeitado (401). Forçando renovação...")
-            novo_token = garantir_token_valido(forcar_renovacao=True)
-            if novo_token:
-                headers = {"Authorization": f"Bearer {novo_token}"}
-                response = requests.get(url, headers=headers, timeout=10)
-
-        if response.status_code == 200:
-            return jsonify(response.json())
-        else:
-            return jsonify({"error": "Erro no Bling", "details": response.text}), response.status_code
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+@app.route('/api/estoque_stats')
+def estoque_stats():
+    return jsonify({**ESTOQUE_BLING.estatisticas(), "token": TOKENS_BLING.estatisticas()})
 
 
 @app.route('/api/adicionar_estoque', methods=['POST'])
 def adicionar_estoque():
     dados = request.json
     try:
-        token = garantir_token_valido()
-        url = "https://www.bling.com.br/Api/v3/estoques"
-        headers = {"Authorization": f"Bearer {token}"}
-        
         payload = {
             "produto": {"id": dados.get('id')},
             "quantidade": dados.get('quantidade'),
             "operacao": "E" # Entrada manual de produção
         }
-        
-        response = requests.post(url, json=payload, headers=headers)
-        # Invalida o cache para mostrar o novo número imediatamente
-        cache_estoque["expira_em"] = 0
+
+        response = requisitar_bling("POST", "/estoques", json=payload)
+        if response.status_code in (200, 201):
+            # Atualiza só esse produto no cache para mostrar o novo número imediatamente
+            ESTOQUE_BLING.invalidar_produto(dados.get('id'), dados.get('quantidade'))
         return jsonify(response.json())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -462,37 +1492,224 @@ def adicionar_estoque():
 # NOVAS ROTAS PARA O COMMAND CENTER (ABAS DE DETALHES)
 # ==========================================================================
 
+# --- Inicio Console em Anel (por impressora) ---
+CONSOLE_MAX_LINHAS = 200        # linhas guardadas por impressora no servidor
+CONSOLE_LINHAS_INICIAIS = 12    # o que o painel recebe ao abrir (igual ao antigo [-12:])
+CONSOLE_COUNT_SYNC = 100        # 1ª leitura do gcode_store
+CONSOLE_COUNT_INCREMENTAL = 25  # leituras seguintes: só o rabo
+CONSOLE_JANELA_DEDUPE = 8       # linhas do websocket onde o gcode_store procura a sua
+CONSOLE_TOLERANCIA_S = 2.0      # s: folga de relógio entre a linha do websocket e a do gcode_store
+
+CONSOLES = {}                   # ip -> ConsoleImpressora
+CONSOLES_LOCK = threading.Lock()
+
+# status + console em paralelo sem criar pool a cada requisição
+POOL_DETALHES = ThreadPoolExecutor(max_workers=8)
+
+
+class ConsoleImpressora:
+    """
+    Buffer circular com as últimas linhas do console do Klipper.
+    Cada linha ganha um seq crescente; o front manda o último seq que viu
+    (cursor) e recebe só o que chegou depois.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._linhas = deque(maxlen=CONSOLE_MAX_LINHAS)   # (seq, {"message","time","type"})
+        self._seq = 0
+        self.ultimo_tempo_remoto = None   # 'time' (relógio do Moonraker) da última linha lida do gcode_store
+        # linhas do websocket (os mesmos dicts do buffer) que o gcode_store ainda não confirmou
+        self._vindas_ws = deque(maxlen=CONSOLE_MAX_LINHAS)
+        self.precisa_sync = False         # websocket caiu/voltou: buscar o buraco via HTTP
+
+    def _adicionar(self, linha):
+        self._seq += 1
+        self._linhas.append((self._seq, linha))
+
+    def _alinhar(self, novas):
+        """
+        {índice em novas: linha do websocket com a mesma mensagem}.
+        As duas fontes vêm na mesma ordem: anda de trás para frente e só
+        procura nas CONSOLE_JANELA_DEDUPE linhas pendentes seguintes, e com a
+        mesma diferença de relógio do primeiro par, para um "ok" repetido não
+        casar com uma linha antiga e engolir o resto.
+        """
+        pares, j = {}, len(self._vindas_ws) - 1
+        diferenca = None    # relógio local - relógio do Moonraker, medido no 1º par
+        for i in range(len(novas) - 1, -1, -1):
+            if j < 0:
+                break
+            e = novas[i]
+            if e.get("type", "response") == "command":
+                continue    # comandos digitados não vêm pelo notify_gcode_response
+            mensagem, t = e.get("message", ""), e.get("time") or 0
+            for k in range(j, max(-1, j - CONSOLE_JANELA_DEDUPE), -1):
+                ws = self._vindas_ws[k]
+                if ws["message"] != mensagem:
+                    continue
+                # mesmo texto de outro momento (ex.: "ok" de antes da queda) não é par
+                if diferenca is not None and abs(ws["time"] - t - diferenca) > CONSOLE_TOLERANCIA_S:
+                    continue
+                if diferenca is None:
+                    diferenca = ws["time"] - t
+                pares[i] = ws
+                j = k - 1
+                break
+        return pares
+
+    def adicionar_gcode_store(self, entradas):
+        """
+        Ingestão incremental do /server/gcode_store (dedupe pelo 'time' do Moonraker).
+        O que já veio pelo websocket é pulado; o resto entra na posição certa:
+        o histórico anterior à 1ª linha do websocket vai para antes dela.
+        """
+        with self._lock:
+            self.precisa_sync = False
+            novas = [e for e in entradas if isinstance(e, dict)
+                     and (self.ultimo_tempo_remoto is None or (e.get("time") or 0) > self.ultimo_tempo_remoto)]
+            if not novas:
+                return
+            self.ultimo_tempo_remoto = novas[-1].get("time") or 0
+
+            pares = self._alinhar(novas)
+            if pares:
+                # tudo até a linha confirmada mais recente já foi conferido
+                confirmada = pares[max(pares)]
+                while self._vindas_ws:
+                    if self._vindas_ws.popleft() is confirmada:
+                        break
+
+            # linha nova vai para antes da próxima linha do websocket que ela precede
+            posicao = {id(l): n for n, (_, l) in enumerate(self._linhas)}
+            antes, fim, proxima = {}, [], None
+            for i in range(len(novas) - 1, -1, -1):
+                if i in pares:
+                    proxima = posicao.get(id(pares[i]), 0)   # já saiu do anel: é mais velha que tudo
+                    continue
+                e = novas[i]
+                linha = {"message": e.get("message", ""), "time": e.get("time") or 0,
+                         "type": e.get("type", "response")}
+                (fim if proxima is None else antes.setdefault(proxima, [])).append(linha)
+
+            if not antes:
+                for linha in reversed(fim):
+                    self._adicionar(linha)
+                return
+
+            # inserção no meio: renumera tudo e pula um seq, assim o cursor de
+            # quem já estava lendo fica para trás e o painel recarrega em ordem
+            linhas = []
+            for n, (_, l) in enumerate(self._linhas):
+                linhas.extend(reversed(antes.get(n, [])))
+                linhas.append(l)
+            linhas.extend(reversed(fim))
+            self._seq += 1
+            self._linhas.clear()
+            for linha in linhas:
+                self._adicionar(linha)
+
+    def adicionar_notificacao(self, mensagem):
+        """Linha empurrada pelo websocket (notify_gcode_response)."""
+        with self._lock:
+            linha = {"message": mensagem, "time": time.time(), "type": "response"}
+            self._adicionar(linha)
+            # o marcador remoto fica como está: o gcode_store só pula o que já veio por aqui
+            self._vindas_ws.append(linha)
+
+    @property
+    def sem_historico(self):
+        """Ainda não leu o gcode_store (buffer vazio ou só com linhas do websocket)."""
+        return self.ultimo_tempo_remoto is None
+
+    @property
+    def vazio(self):
+        return not self._linhas
+
+    def desde(self, cursor):
+        """Retorna (linhas novas, cursor novo, reset). reset=True => front limpa a tela."""
+        with self._lock:
+            if not self._linhas:
+                return [], self._seq, cursor is None
+
+            primeiro_seq = self._linhas[0][0]
+            if cursor is None or cursor > self._seq or cursor < primeiro_seq - 1:
+                # primeira abertura, restart do servidor ou cliente ficou para trás
+                linhas = [l for _, l in list(self._linhas)[-CONSOLE_LINHAS_INICIAIS:]]
+                return linhas, self._seq, True
+
+            return [l for seq, l in self._linhas if seq > cursor], self._seq, False
+
+
+def console_da(ip):
+    with CONSOLES_LOCK:
+        if ip not in CONSOLES:
+            CONSOLES[ip] = ConsoleImpressora()
+        return CONSOLES[ip]
+
+
+def buscar_status_detalhado(ip):
+    url_status = f"http://{ip}/printer/objects/query?extruder&heater_bed&print_stats&display_status"
+    resp = http_get(url_status, operacao="detalhes")
+    if resp.status_code != 200:
+        log(ip, "DETALHES_HTTP", f"status={resp.status_code}")
+        return {}
+    return resp.json().get('result', {}).get('status', {})
+
+
+def alimentar_console_http(ip):
+    console = console_da(ip)
+    count = CONSOLE_COUNT_INCREMENTAL if console.ultimo_tempo_remoto is not None else CONSOLE_COUNT_SYNC
+    resp = http_get(f"http://{ip}/server/gcode_store?count={count}", operacao="detalhes")
+    if resp.status_code != 200:
+        log(ip, "DETALHES_HTTP", f"console={resp.status_code}")
+        return
+    logs_brutos = resp.json().get('result', {}).get('gcode_store', [])
+    if isinstance(logs_brutos, list):
+        console.adicionar_gcode_store(logs_brutos)
+# --- Fim Console em Anel ---
+
+
 @app.route('/api/detalhes_profundos/<ip>')
 def detalhes_profundos(ip):
-    """Busca Temperaturas e Console com tratamento robusto e thread-safe"""
+    """
+    Temperaturas + console incremental.
+    ?cursor=<seq> -> devolve só as linhas novas desde o cursor.
+    Com websocket ativo tudo vem da memória (zero requisição na impressora).
+    """
+    cursor = request.args.get('cursor', type=int)
+    vazio = {"status": {}, "console": [], "cursor": cursor or 0, "reset": False}
+
     try:
         # ✅ TRAVA: se estiver enviando/starting, não martela a impressora
         if is_busy(ip):
-            return jsonify({"status": {}, "console": []})
-
-        url_status = f"http://{ip}/printer/objects/query?extruder&heater_bed&print_stats&display_status"
-        url_console = f"http://{ip}/server/gcode_store"
-
-        resp_s = http_get(url_status, timeout=1.5)
-        resp_c = http_get(url_console, timeout=1.5)
-
-        if resp_s.status_code == 200 and resp_c.status_code == 200:
-            dados_s = resp_s.json()
-            dados_c = resp_c.json()
-
-            logs_brutos = dados_c.get('result', {}).get('gcode_store', [])
-            result = {
-                "status": dados_s.get('result', {}).get('status', {}),
-                "console": logs_brutos[-12:] if isinstance(logs_brutos, list) else []
-            }
-            return jsonify(result)
+            return jsonify(vazio)
+
+        assinatura = ASSINATURAS.get(ip)
+        if assinatura and assinatura.conectado:
+            status = {obj: dict(campos) for obj, campos in list(assinatura.status.items())}
+            console = console_da(ip)
+            if console.sem_historico or console.precisa_sync:
+                # socket só traz linhas novas: histórico inicial (e o buraco de
+                # uma reconexão) vem via HTTP
+                alimentar_console_http(ip)
+        else:
+            # status e console em paralelo (antes eram dois GETs em sequência)
+            f_status = POOL_DETALHES.submit(buscar_status_detalhado, ip)
+            f_console = POOL_DETALHES.submit(alimentar_console_http, ip)
+            status = f_status.result()
+            f_console.result()
 
-        log(ip, "DETALHES_HTTP", f"status={resp_s.status_code}/{resp_c.status_code}")
-        return jsonify({"status": {}, "console": []})
+        linhas, novo_cursor, reset = console_da(ip).desde(cursor)
+        return jsonify({
+            "status": status,
+            "console": linhas,
+            "cursor": novo_cursor,
+            "reset": reset
+        })
 
     except Exception as e:
         log(ip, "DETALHES_FAIL", str(e))
-        return jsonify({"status": {}, "console": []})
+        return jsonify(vazio)
 
 
 # --- 3) Rota Imprimir Interno (Arquivos da Memória da Impressora) ---
@@ -512,7 +1729,7 @@ def imprimir_interno():
         nome_url = urllib.parse.quote(filename)
         url = f"http://{ip}/printer/print/start?filename={nome_url}"
 
-        resp = http_post(url, timeout=15.0)
+        resp = http_post(url, operacao="start")
         log(ip, "IMPRIMIR_INTERNO", f"Resposta | status={resp.status_code} | body={(resp.text or '')[:200]}")
 
         if resp.status_code == 200:
@@ -554,7 +1771,7 @@ def comando_gcode():
             url = f"http://{ip}/printer/gcode/script?script={urllib.parse.quote(comando)}"
 
         log(ip, "CMD", f"POST {url}")
-        resp = http_post(url, timeout=5.0)
+        resp = http_post(url, operacao="comando")
         log(ip, "CMD", f"Resposta status={resp.status_code} | body={(resp.text or '')[:200]}")
 
         return jsonify({"success": True})
@@ -565,109 +1782,138 @@ def comando_gcode():
 
 
 # --- Inicio Bloco de Segurança verificar_ip ---
+def contar_disponiveis():
+    return IMPRESSORAS_ENCONTRADAS.disponiveis
+
+
+def publicar_status(ip, nome, status, cor, msg, progresso=0, arquivo=None):
+    """
+    Único ponto de escrita do IMPRESSORAS_ENCONTRADAS.
+    Só empurra para os dashboards quando algo realmente mudou no card.
+    """
+    registro = IMPRESSORAS_ENCONTRADAS.publicar(
+        StatusImpressora(ip, nome, status, cor, msg, progresso, arquivo)
+    )
+    if registro is None:
+        return
+    if cor == 'ready':
+        DESPACHANTE.acordar()
+    socketio.emit('status_impressora', {
+        "ip": ip,
+        "dados": registro.como_dict(),
+        "versao": registro.versao,
+        "total_disponiveis": contar_disponiveis()
+    })
+
+
+def remover_status(ip):
+    if IMPRESSORAS_ENCONTRADAS.remover(ip):
+        socketio.emit('impressora_removida', {
+            "ip": ip,
+            "versao": IMPRESSORAS_ENCONTRADAS.versao,
+            "total_disponiveis": contar_disponiveis()
+        })
+
+
+@socketio.on('connect')
+def dashboard_conectado():
+    """Dashboard novo recebe a foto completa uma vez; depois só deltas."""
+    impressoras, versao = IMPRESSORAS_ENCONTRADAS.snapshot()
+    emit('snapshot_status', {
+        "impressoras": impressoras,
+        "total_disponiveis": contar_disponiveis(),
+        "versao": versao,
+        "boot": IMPRESSORAS_ENCONTRADAS.boot
+    })
+
+
+def marcar_falha(ip, nome_personalizado):
+    """Conta falha consecutiva e só marca OFFLINE a partir da 2ª (evita piscar)."""
+    FALHAS_CONSECUTIVAS[ip] = FALHAS_CONSECUTIVAS.get(ip, 0) + 1
+    if FALHAS_CONSECUTIVAS[ip] >= 2:
+        publicar_status(ip, nome_personalizado, 'offline', 'offline', 'OFFLINE')
+
+
+def marcar_transmitindo(ip, nome_personalizado):
+    """Durante upload/start não consulta a API; só garante um card 'TRANSMITINDO'."""
+    if ip in IMPRESSORAS_ENCONTRADAS:
+        return
+    publicar_status(ip, nome_personalizado, 'busy', 'printing', 'TRANSMITINDO...', arquivo="...")
+
+
+def aplicar_status_klipper(ip, nome_personalizado, dados):
+    """
+    Converte o status do Klipper (print_stats/display_status) no formato do front.
+    Usado tanto pelo polling HTTP quanto pelas assinaturas via websocket.
+    """
+    FALHAS_CONSECUTIVAS[ip] = 0
+
+    status_klipper = (dados.get('print_stats') or {}).get('state')
+    filename = (dados.get('print_stats') or {}).get('filename')
+    progresso = int(((dados.get('display_status') or {}).get('progress') or 0) * 100)
+
+    status_anterior = ULTIMO_STATUS_MAQUINAS.get(ip)
+    if status_klipper == "printing" and status_anterior not in ("printing", "paused"):
+        INICIO_IMPRESSAO[ip] = datetime.utcnow()
+    if status_anterior == "printing" and status_klipper == "complete":
+        if filename and filename != "Nenhum":
+            inicio = INICIO_IMPRESSAO.pop(ip, None)
+            duracao = (dados.get('print_stats') or {}).get('total_duration')
+            if inicio is None and duracao:
+                inicio = datetime.utcnow() - timedelta(seconds=float(duracao))
+            registrar_conclusao(filename, ip, inicio)
+
+    ULTIMO_STATUS_MAQUINAS[ip] = status_klipper
+
+    if status_klipper == "printing":
+        msg_exibicao, cor_status = f"IMPRIMINDO {progresso}%", "printing"
+    elif status_klipper in ["startup", "busy"]:
+        msg_exibicao, cor_status = "PREPARANDO", "printing"
+    elif status_klipper == "paused":
+        msg_exibicao, cor_status = "PAUSADO", "paused"
+    elif status_klipper == "complete":
+        # peça pronta ainda na mesa: cor própria, fora do contador de prontas e do
+        # despachante até a "mesa liberada"
+        msg_exibicao, cor_status = "CONCLUÍDA · RETIRAR PEÇA", "complete"
+    elif status_klipper in ["standby", "ready", "idle"]:
+        msg_exibicao, cor_status = "PRONTA", "ready"
+    else:
+        msg_exibicao, cor_status = "OFFLINE", "offline"
+
+    publicar_status(ip, nome_personalizado, status_klipper or "unknown", cor_status,
+                    msg_exibicao, progresso, filename or "Nenhum")
+    TELEMETRIA.registrar(ip, dados)
+
+
 def verificar_ip(ip, nome_personalizado):
     """
     Monitora a impressora e atualiza o estado global (thread-safe).
     """
     # ✅ TRAVA: se estiver enviando/starting, não consulta API (evita derrubar wifi/porta)
     if is_busy(ip):
-        if ip in IMPRESSORAS_ENCONTRADAS:
-            return
-        IMPRESSORAS_ENCONTRADAS[ip] = {
-            'nome': nome_personalizado,
-            'ip': ip,
-            'status': 'busy',
-            'cor': 'printing',
-            'msg': 'TRANSMITINDO...',
-            'progresso': 0,
-            'imagem': 'n4max.png',
-            'arquivo': "..."
-        }
+        marcar_transmitindo(ip, nome_personalizado)
         return
 
     if not testar_conexao_rapida(ip):
-        FALHAS_CONSECUTIVAS[ip] = FALHAS_CONSECUTIVAS.get(ip, 0) + 1
-        if FALHAS_CONSECUTIVAS[ip] >= 2:
-            IMPRESSORAS_ENCONTRADAS[ip] = {
-                'nome': nome_personalizado,
-                'ip': ip,
-                'status': 'offline',
-                'cor': 'offline',
-                'msg': 'OFFLINE',
-                'progresso': 0,
-                'imagem': 'n4max.png'
-            }
+        marcar_falha(ip, nome_personalizado)
         return
 
-    url = f"http://{ip}/printer/objects/query?print_stats&display_status"
+    url = f"http://{ip}/printer/objects/query?{OBJETOS_CONSULTA_STATUS}"
 
     try:
-        resp = http_get(url, timeout=3.0)
+        resp = http_get(url, operacao="status")
 
         if resp.status_code == 200:
-            FALHAS_CONSECUTIVAS[ip] = 0
             dados = resp.json().get('result', {}).get('status', {})
-
-            status_klipper = (dados.get('print_stats') or {}).get('state')
-            filename = (dados.get('print_stats') or {}).get('filename')
-            progresso = int(((dados.get('display_status') or {}).get('progress') or 0) * 100)
-
-            status_anterior = ULTIMO_STATUS_MAQUINAS.get(ip)
-            if status_anterior == "printing" and status_klipper == "complete":
-                if filename and filename != "Nenhum":
-                    registrar_conclusao(filename)
-
-            ULTIMO_STATUS_MAQUINAS[ip] = status_klipper
-
-            if status_klipper == "printing":
-                msg_exibicao, cor_status = f"IMPRIMINDO {progresso}%", "printing"
-            elif status_klipper in ["startup", "busy"]:
-                msg_exibicao, cor_status = "PREPARANDO", "printing"
-            elif status_klipper == "paused":
-                msg_exibicao, cor_status = "PAUSADO", "paused"
-            elif status_klipper in ["standby", "ready", "idle", "complete"]:
-                msg_exibicao, cor_status = "PRONTA", "ready"
-            else:
-                msg_exibicao, cor_status = "OFFLINE", "offline"
-
-            IMPRESSORAS_ENCONTRADAS[ip] = {
-                'nome': nome_personalizado,
-                'ip': ip,
-                'status': status_klipper or "unknown",
-                'cor': cor_status,
-                'msg': msg_exibicao,
-                'progresso': progresso,
-                'imagem': "n4max.png",
-                'arquivo': filename or "Nenhum"
-            }
+            aplicar_status_klipper(ip, nome_personalizado, dados)
             return
 
         # se não for 200, incrementa falhas
-        FALHAS_CONSECUTIVAS[ip] = FALHAS_CONSECUTIVAS.get(ip, 0) + 1
-        if FALHAS_CONSECUTIVAS[ip] >= 2:
-            IMPRESSORAS_ENCONTRADAS[ip] = {
-                'nome': nome_personalizado,
-                'ip': ip,
-                'status': 'offline',
-                'cor': 'offline',
-                'msg': 'OFFLINE',
-                'progresso': 0,
-                'imagem': 'n4max.png'
-            }
+        marcar_falha(ip, nome_personalizado)
         log(ip, "STATUS_HTTP", f"HTTP {resp.status_code}")
 
     except Exception as e:
-        FALHAS_CONSECUTIVAS[ip] = FALHAS_CONSECUTIVAS.get(ip, 0) + 1
-        if FALHAS_CONSECUTIVAS[ip] >= 2:
-            IMPRESSORAS_ENCONTRADAS[ip] = {
-                'nome': nome_personalizado,
-                'ip': ip,
-                'status': 'offline',
-                'cor': 'offline',
-                'msg': 'OFFLINE',
-                'progresso': 0,
-                'imagem': 'n4max.png'
-            }
+        marcar_falha(ip, nome_personalizado)
         log(ip, "STATUS_FAIL", str(e))
 
 
@@ -692,82 +1938,1146 @@ def imprimir_biblioteca():
 
 
 
-# --- Monitor Inteligente (Limpo) ---
-def monitor_inteligente():
-    """Motor principal que mantém a sincronia com o SQLite"""
-    while True:
-        try:
-            with app.app_context():
-                maquinas = carregar_maquinas()
+# ==========================================================================
+# ASSINATURAS MOONRAKER (WEBSOCKET) - STATUS POR PUSH
+# ==========================================================================
+# Um websocket longo por impressora. O Moonraker empurra só os campos que
+# mudaram (notify_status_update), então o polling HTTP vira apenas fallback
+# para quem está sem socket conectado.
+# polling HTTP pede o mesmo que a assinatura (temperaturas alimentam a TELEMETRIA)
+OBJETOS_CONSULTA_STATUS = "print_stats&display_status&extruder=temperature,target&heater_bed=temperature,target"
+
+OBJETOS_ASSINADOS = {
+    "print_stats": ["state", "filename"],
+    "display_status": ["progress"],
+    "extruder": ["temperature", "target"],
+    "heater_bed": ["temperature", "target"],
+}
 
-            if maquinas:
-                # cada task abre seu próprio app_context com segurança
-                def task(m):
-                    with app.app_context():
-                        verificar_ip(m['ip'], m['nome'])
+ASSINATURAS = {}           # ip -> AssinaturaMoonraker
+ASSINATURAS_LOCK = threading.Lock()
 
-                with ThreadPoolExecutor(max_workers=15) as executor:
-                    list(executor.map(task, maquinas))
+if websocket is not None:
+    # timeout de conexão/handshake (impressora offline não pode segurar a thread)
+    websocket.setdefaulttimeout(5)
 
-        except Exception as e:
-            # silencioso, mas se quiser ver:
-            # print("monitor_inteligente erro:", e, flush=True)
+
+class AssinaturaMoonraker:
+    """
+    Mantém o websocket de UMA impressora e aplica os deltas recebidos
+    direto no IMPRESSORAS_ENCONTRADAS (mesmo formato do polling HTTP).
+    """
+    def __init__(self, ip, nome):
+        self.ip = ip
+        self.nome = nome
+        self.status = {}           # objeto -> campos (estado acumulado)
+        self.conectado = False
+        self._parar = threading.Event()
+        self._ws = None
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self.mudou = threading.Condition()   # acorda quem espera estado (esperar_estado_impressao)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        try:
+            if self._ws:
+                self._ws.close()
+        except Exception:
             pass
 
-        time.sleep(3)
+    def _loop(self):
+        espera = 2
+        while not self._parar.is_set():
+            self._ws = websocket.WebSocketApp(
+                f"ws://{self.ip}/websocket",
+                on_open=self._on_open,
+                on_message=self._on_message,
+                on_close=self._on_close,
+                on_error=self._on_error,
+            )
+            try:
+                self._ws.run_forever(ping_interval=20, ping_timeout=10, reconnect=0)
+            except Exception as e:
+                log(self.ip, "WS_FAIL", str(e))
+
+            foi_conectado = self.conectado
+            self.conectado = False
+
+            # reconexão com backoff (reseta se a conexão chegou a abrir)
+            espera = 2 if foi_conectado else min(espera * 2, 60)
+            if self._parar.wait(espera):
+                break
+
+    def _assinar(self):
+        self._ws.send(json.dumps({
+            "jsonrpc": "2.0",
+            "method": "printer.objects.subscribe",
+            "params": {"objects": OBJETOS_ASSINADOS},
+            "id": 1,
+        }))
+
+    def _on_open(self, ws):
+        log(self.ip, "WS", "Conectado, assinando objetos do Klipper")
+        ARQUIVOS_IMPRESSORAS.invalidar(self.ip)   # notificações perdidas enquanto estava fora
+        console_da(self.ip).precisa_sync = True    # linhas do console idem
+        self._assinar()
+
+    def _on_close(self, ws, code, msg):
+        if self.conectado:
+            log(self.ip, "WS", f"Desconectado (code={code}) -> fallback HTTP")
+        self.conectado = False
+
+    def _on_error(self, ws, erro):
+        # offline é esperado; o fallback HTTP cuida do status
+        pass
+
+    def _mesclar(self, delta):
+        for objeto, campos in (delta or {}).items():
+            if isinstance(campos, dict):
+                self.status.setdefault(objeto, {}).update(campos)
+
+    def _on_message(self, ws, mensagem):
+        try:
+            dados = json.loads(mensagem)
+        except Exception:
+            return
+
+        metodo = dados.get("method")
+
+        if dados.get("id") == 1 and isinstance(dados.get("result"), dict):
+            # resposta da assinatura = snapshot inicial completo
+            self.status = {}
+            self._mesclar(dados["result"].get("status"))
+            self.conectado = True
+        elif metodo == "notify_status_update":
+            params = dados.get("params") or [{}]
+            self._mesclar(params[0])
+        elif metodo == "notify_gcode_response":
+            for linha in dados.get("params") or []:
+                console_da(self.ip).adicionar_notificacao(str(linha))
+            return
+        elif metodo == "notify_filelist_changed":
+            ARQUIVOS_IMPRESSORAS.ao_notificar(self.ip, dados.get("params"))
+            return
+        elif metodo == "notify_klippy_ready":
+            self._assinar()
+            return
+        elif metodo in ("notify_klippy_disconnected", "notify_klippy_shutdown"):
+            # Moonraker continua vivo mas o Klipper caiu: deixa o HTTP decidir
+            self.conectado = False
+            return
+        else:
+            return
+
+        with self.mudou:
+            self.mudou.notify_all()
 
-"""Fila de impressão """
-def garantir_fila(ip):
-    with UPLOAD_LOCK:
-        if ip not in UPLOAD_FILAS:
-            UPLOAD_FILAS[ip] = Queue()
-        if ip not in UPLOAD_WORKERS or not UPLOAD_WORKERS[ip].is_alive():
-            t = threading.Thread(target=worker_upload, args=(ip,), daemon=True)
-            UPLOAD_WORKERS[ip] = t
-            t.start()
+        if self.conectado and not is_busy(self.ip):
+            # conclusão de peça vai para o BufferProducao: nada de SQLite nesta thread
+            aplicar_status_klipper(self.ip, self.nome, self.status)
 
-def worker_upload(ip):
-    fila = UPLOAD_FILAS[ip]
-    log(ip, "WORKER", "Iniciado e aguardando fila")
 
+def sincronizar_assinaturas(maquinas):
+    """Abre socket para máquinas novas e fecha das que saíram do banco."""
+    if websocket is None:
+        return
+
+    ips = {m['ip']: m['nome'] for m in maquinas}
+    with ASSINATURAS_LOCK:
+        for ip, nome in ips.items():
+            if ip not in ASSINATURAS:
+                a = AssinaturaMoonraker(ip, nome)
+                ASSINATURAS[ip] = a
+                a.iniciar()
+        for ip in [ip for ip in ASSINATURAS if ip not in ips]:
+            ASSINATURAS.pop(ip).parar()
+
+
+def parar_assinatura(ip):
+    with ASSINATURAS_LOCK:
+        a = ASSINATURAS.pop(ip, None)
+    if a:
+        a.parar()
+
+
+def assinatura_ativa(ip):
+    a = ASSINATURAS.get(ip)
+    return bool(a and a.conectado)
+
+
+# tolerância: algumas N4 ficam em "startup/busy" antes de virar "printing"
+ESTADOS_IMPRIMINDO = {"printing", "paused", "startup", "busy"}
+
+def print_stats_http(ip):
+    """print_stats da impressora (state, filename, ...) ou None se não respondeu."""
+    url_state = f"http://{ip}/printer/objects/query?print_stats"
+    try:
+        st = http_get(url_state)
+        if st.status_code == 200:
+            dados = st.json().get("result", {}).get("status", {})
+            return dados.get("print_stats") or {}
+        log(ip, "VALIDATE_BAD", f"HTTP {st.status_code} | body={(st.text or '')[:200]}")
+    except Exception as e:
+        log(ip, "VALIDATE_FAIL", str(e))
+    return None
+
+def estado_impressao_http(ip):
+    return (print_stats_http(ip) or {}).get("state")
+
+def esperar_estado_impressao(ip, timeout_total=60, estados=ESTADOS_IMPRIMINDO):
+    """
+    Espera print_stats.state entrar em `estados`. Com websocket ativo acorda a
+    cada notify_status_update; sem ele consulta por HTTP em intervalos curtos
+    (0.2 s crescendo até 1 s) em vez de dormir 2 s fixos.
+    """
+    prazo = time.monotonic() + timeout_total
+    intervalo = 0.2
+    ultimo_state = object()
     while True:
-        job = fila.get()
-        if job is None:
-            log(ip, "WORKER", "Encerrando worker")
-            break
+        a = ASSINATURAS.get(ip)
+        if a and a.conectado:
+            with a.mudou:
+                state = (a.status.get("print_stats") or {}).get("state")
+                resta = prazo - time.monotonic()
+                if state not in estados and resta > 0:
+                    a.mudou.wait(min(resta, 1.0))
+                    state = (a.status.get("print_stats") or {}).get("state")
+        else:
+            state = estado_impressao_http(ip)
+
+        if state != ultimo_state:
+            log(ip, "VALIDATE", f"state={state}")
+            ultimo_state = state
+        if state in estados:
+            return True
+
+        resta = prazo - time.monotonic()
+        if resta <= 0:
+            return False
+        if not (a and a.conectado):
+            time.sleep(min(resta, intervalo))
+            intervalo = min(intervalo * 1.5, 1.0)
 
-        caminho = job.get("caminho")
-        label = job.get("arquivo_label", os.path.basename(caminho or ""))
 
-        log(ip, "WORKER", f"Novo job: {label}")
+# ==========================================================================
+# MOTOR DE MONITORAMENTO ASSÍNCRONO (HTTPX + ASYNCIO)
+# ==========================================================================
+# Um único event loop e um único pool de conexões para a farm inteira.
+# Impressora offline não segura mais uma thread: cada uma tem seu prazo e
+# a varredura termina no tempo da requisição mais lenta, não na soma delas.
+MONITOR_INTERVALO = 3.0             # segundos entre varreduras
+MONITOR_CONCORRENCIA = 64           # requisições simultâneas no máximo
+MONITOR_PRAZO_IMPRESSORA = 3.0      # deadline total por impressora
+MONITOR_TIMEOUT = httpx.Timeout(3.0, connect=0.8)  # connect curto = antigo teste TCP
+
+ESTATISTICAS_MONITOR = {
+    "ciclo_ms": 0,          # duração da última varredura HTTP
+    "ciclo_max_ms": 0,      # pior varredura desde o boot
+    "consultadas": 0,       # impressoras consultadas via HTTP no último ciclo
+    "falhas": 0,            # dessas, quantas falharam
+    "via_websocket": 0,     # impressoras atendidas por push (sem polling)
+    "ciclos": 0,
+    "ultimo_ciclo": None,
+}
 
+
+async def consultar_status_async(client, sem, ip, nome_personalizado):
+    """Versão async do verificar_ip. Retorna True se a impressora respondeu."""
+    if is_busy(ip):
+        marcar_transmitindo(ip, nome_personalizado)
+        return True
+
+    url = f"http://{ip}/printer/objects/query?{OBJETOS_CONSULTA_STATUS}"
+
+    try:
+        async with sem:
+            resp = await asyncio.wait_for(client.get(url), MONITOR_PRAZO_IMPRESSORA)
+    except Exception as e:
+        marcar_falha(ip, nome_personalizado)
+        # offline/timeout é rotina na farm; loga só erro inesperado
+        if not isinstance(e, (httpx.TransportError, asyncio.TimeoutError)):
+            log(ip, "STATUS_FAIL", str(e) or type(e).__name__)
+        return False
+
+    if resp.status_code == 200:
+        try:
+            dados = resp.json().get('result', {}).get('status', {})
+        except Exception as e:
+            marcar_falha(ip, nome_personalizado)
+            log(ip, "STATUS_FAIL", f"JSON inválido: {e}")
+            return False
+        aplicar_status_klipper(ip, nome_personalizado, dados)
+        return True
+
+    marcar_falha(ip, nome_personalizado)
+    log(ip, "STATUS_HTTP", f"HTTP {resp.status_code}")
+    return False
+
+
+async def varredura_async(client, maquinas):
+    """Consulta todas as máquinas em paralelo (limitado pelo semáforo)."""
+    sem = asyncio.Semaphore(MONITOR_CONCORRENCIA)
+    inicio = time.perf_counter()
+
+    resultados = await asyncio.gather(
+        *(consultar_status_async(client, sem, m['ip'], m['nome']) for m in maquinas),
+        return_exceptions=True
+    )
+
+    duracao_ms = int((time.perf_counter() - inicio) * 1000)
+    falhas = sum(1 for r in resultados if r is not True)
+
+    ESTATISTICAS_MONITOR["ciclo_ms"] = duracao_ms
+    ESTATISTICAS_MONITOR["ciclo_max_ms"] = max(ESTATISTICAS_MONITOR["ciclo_max_ms"], duracao_ms)
+    ESTATISTICAS_MONITOR["consultadas"] = len(maquinas)
+    ESTATISTICAS_MONITOR["falhas"] = falhas
+
+    if duracao_ms > MONITOR_INTERVALO * 1000:
+        log("MONITOR", "CICLO_LENTO", f"{len(maquinas)} impressoras em {duracao_ms} ms")
+
+
+async def motor_monitor_async():
+    limites = httpx.Limits(
+        max_connections=MONITOR_CONCORRENCIA,
+        max_keepalive_connections=MONITOR_CONCORRENCIA
+    )
+    async with httpx.AsyncClient(timeout=MONITOR_TIMEOUT, limits=limites) as client:
+        while True:
+            try:
+                maquinas = carregar_maquinas()   # memória; SQLite só quando a tabela mudou
+
+                sincronizar_assinaturas(maquinas)
+                AGENDADOR_UPLOADS.atualizar_grupos(maquinas)
+
+                # ✅ Polling HTTP só para quem está sem websocket conectado
+                pendentes = [m for m in maquinas if not assinatura_ativa(m['ip'])]
+                ESTATISTICAS_MONITOR["via_websocket"] = len(maquinas) - len(pendentes)
+
+                if pendentes:
+                    await varredura_async(client, pendentes)
+                else:
+                    ESTATISTICAS_MONITOR["ciclo_ms"] = 0
+                    ESTATISTICAS_MONITOR["consultadas"] = 0
+                    ESTATISTICAS_MONITOR["falhas"] = 0
+
+                ESTATISTICAS_MONITOR["ciclos"] += 1
+                ESTATISTICAS_MONITOR["ultimo_ciclo"] = datetime.now().strftime("%H:%M:%S")
+
+            except Exception as e:
+                # silencioso, mas se quiser ver:
+                # print("monitor_inteligente erro:", e, flush=True)
+                pass
+
+            await asyncio.sleep(MONITOR_INTERVALO)
+
+
+# --- Monitor Inteligente (Limpo) ---
+def monitor_inteligente():
+    """Motor principal que mantém a sincronia com o SQLite"""
+    asyncio.run(motor_monitor_async())
+
+
+@app.route('/api/monitor_stats')
+def monitor_stats():
+    """Duração da última varredura e quantas impressoras estão em push x polling"""
+    return jsonify(ESTATISTICAS_MONITOR)
+
+
+@app.route('/api/upload_stats')
+def upload_stats():
+    """Uploads ativos/aguardando e MB/s atingido por grupo de rede"""
+    return jsonify({**AGENDADOR_UPLOADS.estatisticas(), "prontidao": PRONTIDAO.estatisticas(),
+                    "listas_remotas": ARQUIVOS_IMPRESSORAS.estatisticas()})
+
+
+@app.route('/api/http_stats')
+def http_stats():
+    """Reuso do pool keep-alive (hits x conexões novas) por impressora"""
+    return jsonify(CLIENTES.estatisticas())
+
+# ==========================================================================
+# 📋 FILA PERSISTENTE DE IMPRESSÃO (SQLite em WAL, bind "fila")
+# ==========================================================================
+# A fila era um Queue() em memória por impressora: reiniciar o app perdia
+# todos os jobs. Agora cada job é uma linha em fila_jobs.db. O worker da
+# impressora pega o próximo com UPDATE condicional (só um consegue) e o job
+# que estava "executando" quando o processo caiu volta para a fila no boot.
+FILA_MAX_TENTATIVAS = 3        # execuções por job (queda do processo conta)
+FILA_ETA_PADRAO = 60.0         # s por job enquanto não há histórico
+FILA_HISTORICO_ETA = 20        # jobs concluídos usados na média
+FILA_LOTES = {}                # job_id -> ArquivoCompartilhado (buffer do lote só existe em memória)
+
+def etapa_do_progresso(p, msg):
+    """Etapa da tarefa_upload a partir do set_prog (mesmas faixas de % que a tela usa)."""
+    if p < 5:
+        return "sincronizacao"
+    if p < 85:
+        return "vaga_rede" if str(msg).startswith("Aguardando vaga") else "upload"
+    if p < 95:
+        return "verificacao"
+    if p < 98:
+        return "start"
+    return "confirmacao"
+
+class FilaJobs:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._geracao = 0            # muda a cada job novo (worker não perde aviso)
+        self._workers = {}           # ip -> Thread
+        self._execucao = {}          # ip -> {"id", "etapa", "desde", "inicio", "duracoes"}
+
+    # ---------- produção ----------
+    def enfileirar(self, ip, caminho, label, lote=None, modelo=None, tag=None):
+        """ip=None → job de pool: o DESPACHANTE escolhe a impressora (modelo/tag)."""
+        with app.app_context():
+            job = JobImpressao(ip=ip, caminho=caminho, arquivo_label=label,
+                               pool_modelo=modelo or None, pool_tag=tag or None)
+            db.session.add(job)
+            db.session.commit()
+            job_id = job.id
+            mesmo_alvo = JobImpressao.ip == ip if ip else JobImpressao.ip.is_(None)
+            pos = JobImpressao.query.filter(mesmo_alvo,
+                                            JobImpressao.estado.in_(('aguardando', 'executando')),
+                                            JobImpressao.id <= job_id).count()
+        if lote:
+            FILA_LOTES[job_id] = lote
+        self._avisar()
+        if ip:
+            self.garantir_worker(ip)
+        else:
+            DESPACHANTE.acordar()
+        return job_id, pos
+
+    def _avisar(self):
+        with self._cond:
+            self._geracao += 1
+            self._cond.notify_all()
+
+    def cancelar(self, job_id):
+        """Só job que ainda não começou; o upload em andamento segue até o fim."""
+        with app.app_context():
+            n = (JobImpressao.query.filter_by(id=job_id, estado='aguardando')
+                 .update({"estado": "cancelado", "finalizado_em": datetime.utcnow()},
+                         synchronize_session=False))
+            db.session.commit()
+        if n:
+            lote = FILA_LOTES.pop(job_id, None)
+            if lote:
+                lote.liberar()
+        return bool(n)
+
+    def retomar(self):
+        """Boot: job preso em 'executando' (processo caiu no meio) volta para a fila."""
+        with app.app_context():
+            presos = JobImpressao.query.filter_by(estado='executando').all()
+            for job in presos:
+                job.etapa = None
+                if (job.tentativas or 0) >= FILA_MAX_TENTATIVAS:
+                    job.estado = 'erro'
+                    job.erro = f"Interrompido {job.tentativas}x por reinício do servidor"
+                    job.finalizado_em = datetime.utcnow()
+                else:
+                    job.estado = 'aguardando'
+                    job.retomado = True
+            db.session.commit()
+            ips = [ip for (ip,) in db.session.query(JobImpressao.ip)
+                   .filter(JobImpressao.estado == 'aguardando', JobImpressao.ip.isnot(None)).distinct()]
+        self._avisar()
+        for ip in ips:
+            self.garantir_worker(ip)
+        print(f"📋 Fila: {len(presos)} job(s) interrompido(s) retomado(s) | {len(ips)} impressora(s) com fila")
+
+    # ---------- consumo ----------
+    def garantir_worker(self, ip):
+        with self._cond:
+            t = self._workers.get(ip)
+            if t is None or not t.is_alive():
+                t = threading.Thread(target=self._worker, args=(ip,), daemon=True)
+                self._workers[ip] = t
+                t.start()
+
+    def _reivindicar(self, ip):
+        """Próximo job da impressora; o UPDATE com estado='aguardando' no WHERE garante um dono só."""
+        with app.app_context():
+            while True:
+                prox = (JobImpressao.query.with_entities(JobImpressao.id)
+                        .filter_by(ip=ip, estado='aguardando')
+                        .order_by(JobImpressao.id).first())
+                if prox is None:
+                    return None
+                n = (JobImpressao.query.filter_by(id=prox.id, estado='aguardando')
+                     .update({"estado": "executando", "iniciado_em": datetime.utcnow(),
+                              "tentativas": JobImpressao.tentativas + 1, "etapa": "inicio"},
+                             synchronize_session=False))
+                db.session.commit()
+                if n == 1:
+                    job = db.session.get(JobImpressao, prox.id)
+                    return {"id": job.id, "caminho": job.caminho, "retomado": job.retomado,
+                            "label": job.arquivo_label or os.path.basename(job.caminho),
+                            "tentativas": job.tentativas}
+
+    def _worker(self, ip):
+        log(ip, "WORKER", "Iniciado e aguardando fila")
+        while True:
+            with self._cond:
+                geracao = self._geracao
+            job = self._reivindicar(ip)
+            if job is None:
+                with self._cond:
+                    if self._geracao == geracao:
+                        self._cond.wait(30)
+                continue
+            self._executar(ip, job)
+
+    def _executar(self, ip, job):
+        job_id, label = job["id"], job["label"]
+        lote = FILA_LOTES.pop(job_id, None)
+        agora = time.monotonic()
+        self._execucao[ip] = {"id": job_id, "etapa": None, "desde": agora, "inicio": agora, "duracoes": {}}
+
+        log(ip, "WORKER", f"Novo job #{job_id}: {label} (execução {job['tentativas']})")
         PROGRESSO_UPLOAD[ip] = {"p": 0, "msg": f"[QUEUE] {label}"}
 
+        ok, erro = False, None
         try:
-            tarefa_upload(ip, caminho)
+            ps = print_stats_http(ip) if job["retomado"] else None
+            if ps and ps.get("state") in ESTADOS_IMPRIMINDO:
+                imprimindo = os.path.basename(ps.get("filename") or "").lower()
+                if imprimindo == os.path.basename(job["caminho"]).lower():
+                    # o processo caiu depois do start: a impressão deste job já está rodando
+                    log(ip, "WORKER", f"Job #{job_id} retomado com a impressora já imprimindo o arquivo → concluído")
+                    PROGRESSO_UPLOAD[ip] = {"p": 100, "msg": "Sucesso! (já imprimindo após reinício)"}
+                    ok = True
+                else:
+                    # ocupada com outra peça: o start deste job seria recusado
+                    erro = f"Impressora ocupada com outro arquivo ({ps.get('filename') or '?'}) ao retomar"
+                    log(ip, "WORKER", f"Job #{job_id} retomado: {erro}")
+                    PROGRESSO_UPLOAD[ip] = {"p": -1, "msg": erro[:120]}
+            else:
+                ok = tarefa_upload(ip, job["caminho"], lote=lote)
+                if not ok:
+                    erro = (PROGRESSO_UPLOAD.get(ip) or {}).get("msg")
         except Exception as e:
+            erro = str(e)
             log(ip, "ERRO_WORKER", str(e))
             PROGRESSO_UPLOAD[ip] = {"p": -1, "msg": "[WORKER] erro"}
         finally:
-            fila.task_done()
-            log(ip, "WORKER", "Job finalizado")
-
+            if lote:
+                lote.liberar()
+            self._finalizar(ip, job_id, ok, erro)
+            log(ip, "WORKER", f"Job #{job_id} finalizado ({'ok' if ok else 'erro'})")
+
+    def registrar_etapa(self, ip, p, msg):
+        """Chamado pelo set_prog da tarefa_upload: fecha a etapa anterior e abre a nova."""
+        ex = self._execucao.get(ip)
+        if not ex or p < 0 or p >= 100:
+            return
+        nova = etapa_do_progresso(p, msg)
+        if nova == ex["etapa"]:
+            return
+        agora = time.monotonic()
+        if ex["etapa"]:
+            ex["duracoes"][ex["etapa"]] = round(ex["duracoes"].get(ex["etapa"], 0) + agora - ex["desde"], 3)
+        ex["etapa"], ex["desde"] = nova, agora
+        try:
+            with app.app_context():
+                JobImpressao.query.filter_by(id=ex["id"]).update({"etapa": nova}, synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            log(ip, "FILA_FAIL", f"etapa não gravada: {e}")
 
-def enfileirar_impressao(ip, caminho_completo, arquivo_label=None):
-    garantir_fila(ip)
+    def _finalizar(self, ip, job_id, ok, erro):
+        ex = self._execucao.pop(ip, None) or {"duracoes": {}}
+        if ex.get("etapa"):
+            ex["duracoes"][ex["etapa"]] = round(ex["duracoes"].get(ex["etapa"], 0) + time.monotonic() - ex["desde"], 3)
+        try:
+            with app.app_context():
+                JobImpressao.query.filter_by(id=job_id).update({
+                    "estado": "concluido" if ok else "erro",
+                    "etapa": None,
+                    "erro": None if ok else (erro or "falha")[:500],
+                    "duracoes": json.dumps(ex["duracoes"]),
+                    "finalizado_em": datetime.utcnow(),
+                }, synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            log(ip, "FILA_FAIL", f"job #{job_id} não finalizado no banco: {e}")
+        DESPACHANTE.job_terminou(ip, ok)
+
+    # ---------- inspeção ----------
+    def duracao_media(self, ip=None):
+        """Média dos últimos jobs concluídos (da impressora, ou da farm se ela tem pouco histórico)."""
+        def media(q):
+            feitos = (q.filter(JobImpressao.estado == 'concluido', JobImpressao.iniciado_em.isnot(None))
+                      .order_by(JobImpressao.finalizado_em.desc()).limit(FILA_HISTORICO_ETA).all())
+            dur = [(j.finalizado_em - j.iniciado_em).total_seconds() for j in feitos if j.finalizado_em]
+            return (sum(dur) / len(dur), len(dur)) if dur else (None, 0)
+
+        if ip:
+            m, n = media(JobImpressao.query.filter_by(ip=ip))
+            if n >= 3:
+                return m
+        m, _ = media(JobImpressao.query)
+        return m or FILA_ETA_PADRAO
+
+    @staticmethod
+    def _dict(job):
+        return {
+            "id": job.id,
+            "ip": job.ip,
+            "arquivo": job.arquivo_label or os.path.basename(job.caminho),
+            "caminho": job.caminho,
+            "estado": job.estado,
+            "pool": ({"modelo": job.pool_modelo, "tag": job.pool_tag}
+                     if (job.pool_modelo or job.pool_tag or job.ip is None) else None),
+            "etapa": job.etapa,
+            "tentativas": job.tentativas,
+            "retomado": bool(job.retomado),
+            "duracoes": json.loads(job.duracoes) if job.duracoes else None,
+            "erro": job.erro,
+            "criado_em": job.criado_em.isoformat() if job.criado_em else None,
+            "iniciado_em": job.iniciado_em.isoformat() if job.iniciado_em else None,
+            "finalizado_em": job.finalizado_em.isoformat() if job.finalizado_em else None,
+        }
 
-    pos = UPLOAD_FILAS[ip].qsize() + 1
+    def resumo(self, ip=None, recentes=20):
+        """Jobs ativos com posição e ETA (até começar / até terminar) por impressora."""
+        with app.app_context():
+            q = JobImpressao.query.filter(JobImpressao.estado.in_(('aguardando', 'executando')))
+            if ip:
+                q = q.filter_by(ip=ip)
+            ativos = q.order_by(JobImpressao.id).all()
+
+            por_ip = {}
+            for job in ativos:
+                por_ip.setdefault(job.ip, []).append(job)
+
+            agora = time.monotonic()
+            jobs, impressoras = [], {}
+
+            # jobs de pool ainda sem impressora: posição na fila global, ETA depende do despacho
+            sem_ip = por_ip.pop(None, [])
+            for posicao, job in enumerate(sem_ip, 1):
+                jobs.append(dict(self._dict(job), posicao=posicao, eta_inicio_s=None, eta_fim_s=None))
+            if sem_ip:
+                impressoras["pool"] = {"aguardando": len(sem_ip)}
+
+            for ip_job, lista in por_ip.items():
+                media = self.duracao_media(ip_job)
+                espera = 0.0
+                lista.sort(key=lambda j: (j.estado != 'executando', j.id))
+                posicao = 0
+                for job in lista:
+                    d = self._dict(job)
+                    if job.estado == 'executando':
+                        ex = self._execucao.get(ip_job) or {}
+                        decorrido = agora - ex["inicio"] if ex.get("id") == job.id else 0.0
+                        d["decorrido_s"] = round(decorrido, 1)
+                        restante = max(0.0, media - decorrido)
+                        d["posicao"], d["eta_inicio_s"], d["eta_fim_s"] = 0, 0, round(restante)
+                        espera += restante
+                    else:
+                        posicao += 1
+                        d["posicao"] = posicao
+                        d["eta_inicio_s"] = round(espera)
+                        espera += media
+                        d["eta_fim_s"] = round(espera)
+                    jobs.append(d)
+                impressoras[ip_job] = {
+                    "aguardando": posicao,
+                    "executando": any(j.estado == 'executando' for j in lista),
+                    "duracao_media_s": round(media, 1),
+                    "eta_fila_vazia_s": round(espera),
+                }
+
+            q = JobImpressao.query.filter(JobImpressao.estado.in_(('concluido', 'erro', 'cancelado')))
+            if ip:
+                q = q.filter_by(ip=ip)
+            historico = [self._dict(j) for j in q.order_by(JobImpressao.finalizado_em.desc()).limit(recentes)]
+
+        return {"jobs": jobs, "impressoras": impressoras, "recentes": historico}
+
+FILA_JOBS = FilaJobs()
+
+
+def enfileirar_impressao(ip, caminho_completo, arquivo_label=None, lote=None):
     label = arquivo_label or os.path.basename(caminho_completo)
+    job_id, pos = FILA_JOBS.enfileirar(ip, caminho_completo, label, lote)
+
+    log(ip, "QUEUE", f"Job #{job_id} adicionado na fila posição {pos}: {label}")
+
+    if pos > 1:
+        PROGRESSO_UPLOAD[ip] = {"p": 0, "msg": f"[QUEUE] pos {pos}"}
+    return job_id
+
+
+def enfileirar_pool(caminho_completo, copias=1, modelo=None, tag=None, lote=None):
+    """N cópias para o pool (modelo/tag); cada uma vai para a próxima impressora livre."""
+    label = os.path.basename(caminho_completo)
+    ids = [FILA_JOBS.enfileirar(None, caminho_completo, label, lote, modelo, tag)[0] for _ in range(copias)]
+    print(f"📋 Pool {modelo or '*'}/{tag or '*'}: {copias} cópia(s) de {label} na fila global")
+    return ids
+
+
+# ==========================================================================
+# 🚚 DESPACHO AUTOMÁTICO (fila global → próxima impressora livre)
+# ==========================================================================
+# Job de pool não nasce preso a um IP: o despachante entrega cada um para a
+# primeira impressora do pool (modelo/tag) que o monitor (verificar_ip ou
+# websocket) mostra como PRONTA e que não tem job na fila. Preferência:
+# 1) quem já tem o arquivo idêntico (ArquivoRemoto → start sem upload)
+# 2) o grupo de rede (AP) com menos uploads/jobs em andamento
+DESPACHO_INTERVALO = 2.0       # s: varredura mesmo sem aviso
+DESPACHO_ESPERA_ERRO = 60.0    # s: impressora cujo job falhou fica fora do pool
+
+def normalizar_tags(tags):
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return sorted({str(t).strip().lower() for t in (tags or []) if str(t).strip()})
+
+def mesa_livre(registro):
+    """Card PRONTA com a mesa vazia (Klipper em standby/ready; complete tem cor própria)."""
+    return registro is not None and registro.cor == 'ready'
+
+class DespachanteFarm:
+    def __init__(self):
+        self._acordar = threading.Event()
+        self._thread = None
+        self._despachado = {}      # ip -> versão do card quando recebeu job (espera o card mudar)
+        self._liberar_em = {}      # ip -> monotonic a partir do qual volta ao pool após erro
+        self.despachos = 0
+        self.no_arquivo = 0        # despachos para quem já tinha o arquivo
+
+    def iniciar(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+            print("🚚 Despachante da fila global iniciado")
+
+    def acordar(self):
+        self._acordar.set()
+
+    def job_terminou(self, ip, ok):
+        if not ok:
+            self._liberar_em[ip] = time.monotonic() + DESPACHO_ESPERA_ERRO
+        self.acordar()
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(DESPACHO_INTERVALO)
+            self._acordar.clear()
+            try:
+                self.despachar()
+            except Exception as e:
+                print(f"🚨 Despachante: {e}")
+
+    def _livre(self, ip, ocupadas):
+        """
+        PRONTA no monitor (standby/ready, nunca complete: a peça anterior ainda
+        está na mesa), sem upload, sem job e com o card atualizado desde o
+        último despacho.
+        """
+        if ip in ocupadas or is_busy(ip):
+            return False
+        registro = IMPRESSORAS_ENCONTRADAS.get(ip)
+        if not mesa_livre(registro):
+            return False
+        versao = self._despachado.get(ip)
+        if versao is not None:
+            # terminou o job mas o card ainda é o de antes da impressão: não é "livre" de verdade
+            if registro.versao <= versao and time.monotonic() < self._liberar_em.get(ip, float('inf')):
+                return False
+            self._despachado.pop(ip, None)
+            self._liberar_em.pop(ip, None)
+        return True
+
+    @staticmethod
+    def _combina(maquina, job):
+        if job.pool_modelo and (maquina.get('modelo') or '').lower() != job.pool_modelo.lower():
+            return False
+        if job.pool_tag and job.pool_tag.lower() not in normalizar_tags(maquina.get('tags')):
+            return False
+        return True
+
+    @staticmethod
+    def _detentores(caminho, lote=None):
+        """
+        IPs que já têm este conteúdo pelo índice de uploads. Nada é lido do NAS
+        aqui (o arquivo pode estar no meio da cópia e o lote ainda vai lê-lo):
+        vale o sha256 já conhecido (cache ou buffer do lote); sem ele, nome +
+        tamanho. É só preferência: a tarefa_upload confere o hash antes de
+        pular o envio.
+        """
+        try:
+            st = os.stat(caminho)
+        except OSError:
+            return set()
+        sha = hash_local_em_cache(caminho, st.st_size, st.st_mtime) or (lote.sha256 if lote else None)
+        q = db.session.query(ArquivoRemoto.ip, ArquivoRemoto.nome).filter_by(tamanho=st.st_size)
+        if sha:
+            return {ip for ip, _nome in q.filter_by(sha256=sha)}
+        nome_low = os.path.basename(caminho).lower()
+        return {ip for ip, nome in q if os.path.basename(nome).lower() == nome_low}
+
+    def despachar(self):
+        with app.app_context():
+            pendentes = (JobImpressao.query
+                         .filter(JobImpressao.ip.is_(None), JobImpressao.estado == 'aguardando')
+                         .order_by(JobImpressao.id).all())
+            if not pendentes:
+                return 0
+
+            ocupadas = {ip for (ip,) in db.session.query(JobImpressao.ip)
+                        .filter(JobImpressao.ip.isnot(None),
+                                JobImpressao.estado.in_(('aguardando', 'executando'))).distinct()}
+            livres = [m for m in carregar_maquinas() if self._livre(m['ip'], ocupadas)]
+            if not livres:
+                return 0
+
+            carga = {}
+            for ip in ocupadas:
+                g = AGENDADOR_UPLOADS.grupo_de(ip)
+                carga[g] = carga.get(g, 0) + 1
+
+            detentores = {}
+            feitos = 0
+            for job in pendentes:
+                candidatas = [m for m in livres if self._combina(m, job)]
+                if not candidatas:
+                    continue
+                if job.caminho not in detentores:
+                    detentores[job.caminho] = self._detentores(job.caminho, FILA_LOTES.get(job.id))
+                tem = detentores[job.caminho]
+                escolhida = min(candidatas, key=lambda m: (
+                    m['ip'] not in tem,
+                    carga.get(AGENDADOR_UPLOADS.grupo_de(m['ip']), 0),
+                    chave_ordem_maquina(m),
+                ))
+                ip = escolhida['ip']
+
+                n = (JobImpressao.query.filter(JobImpressao.id == job.id, JobImpressao.ip.is_(None),
+                                               JobImpressao.estado == 'aguardando')
+                     .update({"ip": ip}, synchronize_session=False))
+                db.session.commit()
+                if not n:
+                    continue   # cancelado no meio do caminho
+
+                livres.remove(escolhida)
+                g = AGENDADOR_UPLOADS.grupo_de(ip)
+                carga[g] = carga.get(g, 0) + 1
+                registro = IMPRESSORAS_ENCONTRADAS.get(ip)
+                self._despachado[ip] = registro.versao if registro else 0
+                self.despachos += 1
+                self.no_arquivo += ip in tem
+                feitos += 1
+                log(ip, "DESPACHO", f"Job #{job.id} ({job.arquivo_label}) → {escolhida['nome']} "
+                                    f"| grupo={g} | já tem o arquivo={ip in tem}")
+                PROGRESSO_UPLOAD[ip] = {"p": 0, "msg": f"[QUEUE] {job.arquivo_label}"}
+                FILA_JOBS.garantir_worker(ip)
+                if not livres:
+                    break
+
+        if feitos:
+            FILA_JOBS._avisar()
+        return feitos
+
+    def estatisticas(self):
+        return {"despachos": self.despachos, "no_arquivo": self.no_arquivo,
+                "aguardando_card": len(self._despachado)}
+
+DESPACHANTE = DespachanteFarm()
+
+
+@app.route('/api/fila')
+def fila_jobs():
+    """Jobs aguardando/executando com posição e ETA; ?ip= filtra uma impressora"""
+    return jsonify({**FILA_JOBS.resumo(request.args.get('ip') or None),
+                    "despacho": DESPACHANTE.estatisticas()})
+
+@app.route('/api/pools')
+def pools_impressoras():
+    """Modelos e tags cadastrados, com quantas impressoras estão PRONTAS em cada um"""
+    modelos, tags = {}, {}
+    for m in carregar_maquinas():
+        registro = IMPRESSORAS_ENCONTRADAS.get(m['ip'])
+        pronta = mesa_livre(registro)
+        for destino, chave in [(modelos, m.get('modelo') or '')] + [(tags, t) for t in normalizar_tags(m.get('tags'))]:
+            d = destino.setdefault(chave, {"total": 0, "prontas": 0})
+            d["total"] += 1
+            d["prontas"] += pronta
+    return jsonify({"modelos": modelos, "tags": tags})
+
+@app.route('/api/imprimir_pool', methods=['POST'])
+def imprimir_pool():
+    """Enfileira N cópias na fila global; o despachante escolhe as impressoras"""
+    dados = request.json or {}
+    arquivo = (dados.get('arquivo') or '').strip().replace("\\", "/").lstrip("/")
+    modelo = (dados.get('modelo') or '').strip() or None
+    tag = (normalizar_tags(dados.get('tag')) or [None])[0]
+    try:
+        copias = max(1, min(int(dados.get('copias') or 1), 500))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "copias inválido"}), 400
+
+    if not arquivo:
+        return jsonify({"success": False, "message": "arquivo ausente"}), 400
+    caminho = os.path.abspath(os.path.join(PASTA_RAIZ, arquivo))
+    if BIBLIOTECA.relativo(caminho) in (None, ''):
+        return jsonify({"success": False, "message": "Acesso negado"}), 403
+    if not os.path.exists(caminho):
+        return jsonify({"success": False, "message": f"Arquivo não encontrado: {arquivo}"}), 404
+
+    # ✅ mesmo buffer compartilhado do envio em massa: o NAS é lido uma vez para as N cópias
+    lote = ArquivoCompartilhado(caminho, referencias=copias) if copias > 1 else None
+    ids = enfileirar_pool(caminho, copias, modelo, tag, lote)
+    return jsonify({"success": True, "queued": True, "jobs": ids})
+
+@app.route('/api/mesa_liberada', methods=['POST'])
+def mesa_liberada():
+    """
+    Operador retirou a peça: SDCARD_RESET_FILE leva o print_stats de
+    complete para standby e a impressora volta ao pool do despachante.
+    """
+    ip = (request.json or {}).get('ip')
+    if not ip:
+        return jsonify({"success": False, "message": "ip ausente"}), 400
+    try:
+        url = f"http://{ip}/printer/gcode/script?script={urllib.parse.quote('SDCARD_RESET_FILE')}"
+        resp = http_post(url, operacao="comando")
+        log(ip, "MESA", f"Mesa liberada pelo operador | status={resp.status_code}")
+        if resp.status_code >= 400:
+            return jsonify({"success": False, "message": (resp.text or '')[:200]}), 502
+    except Exception as e:
+        log(ip, "MESA_FAIL", str(e))
+        return jsonify({"success": False, "message": str(e)}), 500
+    DESPACHANTE.acordar()
+    return jsonify({"success": True})
+
+@app.route('/api/fila/<int:job_id>/cancelar', methods=['POST'])
+def cancelar_job_fila(job_id):
+    if FILA_JOBS.cancelar(job_id):
+        return jsonify({"success": True})
+    return jsonify({"success": False, "message": "Job não está aguardando na fila"}), 409
+
+# ==========================================================================
+# 👁️ PRONTIDÃO DE ARQUIVOS (inotify na PASTA_RAIZ)
+# ==========================================================================
+# O Samba grava no disco local do servidor, então o kernel avisa quando o
+# Windows termina de copiar (IN_CLOSE_WRITE / IN_MOVED_TO). Arquivo que
+# fechou a escrita e não mudou (mesmo tamanho + mtime) é despachado na hora;
+# o polling de tamanho do aguardar_estabilidade_arquivo fica só de reserva.
+
+PRONTIDAO_MARGEM_INICIAL = 5.0   # s: arquivo com mtime anterior ao vigia (menos isso) conta como parado
+
+class VigiaArquivos:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASCARA = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    def __init__(self, raiz):
+        self.raiz = os.path.abspath(raiz)
+        self.ativo = False
+        self.inicio = None
+        self._libc = None
+        self._fd = None
+        self._pastas = {}              # wd -> pasta
+        self._estaveis = {}            # caminho -> (tamanho, mtime_ns)
+        self._em_escrita = set()       # caminhos com escrita aberta desde o último close
+        self._ouvintes = []            # callbacks(evento, caminho) para outros índices
+        self._cond = threading.Condition()
+        self.stats = {"instantaneos": 0, "polling": 0, "eventos": 0, "overflow": 0}
+
+    def iniciar(self):
+        """Sobe a thread do inotify. Fora do Linux (modo dev Z:) fica só o polling."""
+        if self.ativo:
+            return True
+        if platform.system() != "Linux" or not os.path.isdir(self.raiz):
+            print(f"⚠️ Vigia de arquivos desligado ({self.raiz}) → usando polling de tamanho")
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+        except Exception as e:
+            print(f"⚠️ inotify indisponível ({e}) → usando polling de tamanho")
+            return False
+
+        self._libc, self._fd = libc, fd
+        self.inicio = time.time()
+        self._vigiar_arvore(self.raiz)
+        self.ativo = True
+        threading.Thread(target=self._loop, daemon=True).start()
+        print(f"👁️ Vigia de arquivos ativo em {self.raiz} ({len(self._pastas)} pastas)")
+        return True
+
+    def _vigiar_arvore(self, pasta, marcar_estaveis=False):
+        for atual, subpastas, arquivos in os.walk(pasta):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(atual), self.MASCARA)
+            if wd >= 0:
+                with self._cond:
+                    self._pastas[wd] = atual
+            if marcar_estaveis:
+                # pasta movida para dentro da raiz: os arquivos já chegaram inteiros
+                for nome in arquivos:
+                    self.marcar_estavel(os.path.join(atual, nome))
+
+    def _loop(self):
+        while True:
+            try:
+                dados = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                print(f"⚠️ Vigia de arquivos parou ({e}) → polling de tamanho")
+                self.ativo = False
+                return
+
+            pos = 0
+            while pos + 16 <= len(dados):
+                wd, mascara, _cookie, tam = struct.unpack_from("iIII", dados, pos)
+                nome = os.fsdecode(dados[pos + 16:pos + 16 + tam].rstrip(b"\0"))
+                pos += 16 + tam
+                try:
+                    self._evento(wd, mascara, nome)
+                except Exception as e:
+                    print(f"⚠️ Erro no evento inotify: {e}")
+
+    def _evento(self, wd, mascara, nome):
+        self.stats["eventos"] += 1
+        if mascara & self.IN_Q_OVERFLOW:
+            # perdemos eventos: nada do que sabíamos é confiável
+            with self._cond:
+                self._estaveis.clear()
+                self.stats["overflow"] += 1
+            self._avisar("overflow", self.raiz)
+            return
+        with self._cond:
+            if mascara & self.IN_IGNORED:
+                self._pastas.pop(wd, None)
+                return
+            pasta = self._pastas.get(wd)
+        if pasta is None:
+            return
+        caminho = os.path.join(pasta, nome) if nome else pasta
+
+        if mascara & self.IN_ISDIR:
+            if mascara & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._vigiar_arvore(caminho, marcar_estaveis=bool(mascara & self.IN_MOVED_TO))
+            elif mascara & (self.IN_DELETE | self.IN_MOVED_FROM):
+                prefixo = caminho + os.sep
+                with self._cond:
+                    for c in [c for c in self._estaveis if c.startswith(prefixo)]:
+                        del self._estaveis[c]
+            self._avisar("pasta", caminho)
+            return
 
-    log(ip, "QUEUE", f"Adicionado na fila posição {pos}: {label}")
+        if mascara & (self.IN_CREATE | self.IN_MODIFY):
+            with self._cond:
+                self._em_escrita.add(caminho)
+                self._estaveis.pop(caminho, None)
+            if mascara & self.IN_CREATE:
+                self._avisar("criado", caminho)
+        elif mascara & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+            self.marcar_estavel(caminho)
+            self._avisar("pronto", caminho)
+        elif mascara & (self.IN_DELETE | self.IN_MOVED_FROM):
+            with self._cond:
+                self._em_escrita.discard(caminho)
+                self._estaveis.pop(caminho, None)
+            self._avisar("removido", caminho)
+
+    def _avisar(self, evento, caminho):
+        for fn in list(self._ouvintes):
+            try:
+                fn(evento, caminho)
+            except Exception as e:
+                print(f"⚠️ Ouvinte do vigia falhou: {e}")
+
+    def ouvir(self, fn):
+        """Registra callback(evento, caminho) chamado na thread do inotify."""
+        self._ouvintes.append(fn)
+
+    def marcar_estavel(self, caminho):
+        caminho = os.path.abspath(caminho)
+        try:
+            st = os.stat(caminho)
+        except OSError:
+            return
+        with self._cond:
+            self._em_escrita.discard(caminho)
+            if st.st_size > 0:
+                self._estaveis[caminho] = (st.st_size, st.st_mtime_ns)
+            self._cond.notify_all()
+
+    def pronto(self, caminho):
+        """
+        True  = escrita concluída e o arquivo não mudou desde então (sem espera)
+        False = ainda não existe / vazio
+        None  = não sabemos → quem chamou faz o polling de tamanho
+        """
+        caminho = os.path.abspath(caminho)
+        try:
+            st = os.stat(caminho)
+        except OSError:
+            return False
+        if st.st_size <= 0:
+            return False
 
-    PROGRESSO_UPLOAD[ip] = {"p": 0, "msg": f"[QUEUE] pos {pos}"}
+        chave = (st.st_size, st.st_mtime_ns)
+        with self._cond:
+            if self._estaveis.get(caminho) == chave:
+                self.stats["instantaneos"] += 1
+                return True
+            if not self.ativo or caminho in self._em_escrita:
+                return None
+            # parado desde antes do vigia subir e sem nenhum evento depois: arquivo antigo
+            if (os.path.dirname(caminho) in self._pastas.values()
+                    and st.st_mtime < self.inicio - PRONTIDAO_MARGEM_INICIAL):
+                self._estaveis[caminho] = chave
+                self.stats["instantaneos"] += 1
+                return True
+        return None
+
+    def esperar(self, caminho, timeout):
+        """
+        Dorme até o close-write DESTE arquivo (ou timeout): substitui o sleep
+        fixo do polling. Eventos de outros arquivos da árvore não acordam quem
+        espera, senão as leituras de tamanho sairiam coladas umas nas outras.
+        """
+        caminho = os.path.abspath(caminho)
+        with self._cond:
+            self._cond.wait_for(lambda: caminho in self._estaveis, timeout)
+
+    def estatisticas(self):
+        with self._cond:
+            return {"ativo": self.ativo, "pastas": len(self._pastas),
+                    "estaveis": len(self._estaveis), "em_escrita": len(self._em_escrita),
+                    **self.stats}
+
+PRONTIDAO = VigiaArquivos(PASTA_RAIZ)
 
-    UPLOAD_FILAS[ip].put({"caminho": caminho_completo, "arquivo_label": label})
-"""Fila de impressão """
 
 def aguardar_estabilidade_arquivo(caminho, timeout=60):
     """Garante sincronia total entre Windows -> Samba -> Flask"""
+    # ⚡ Caminho rápido: o inotify já viu a escrita terminar (ou o arquivo é antigo)
+    try:
+        if PRONTIDAO.pronto(caminho):
+            return True
+    except Exception as e:
+        print(f"⚠️ Vigia de arquivos falhou ({e}) → polling de tamanho")
+    PRONTIDAO.stats["polling"] += 1
+
     tamanho_anterior = -1
     leituras_iguais = 0
     inicio = time.time()
@@ -777,15 +3087,20 @@ def aguardar_estabilidade_arquivo(caminho, timeout=60):
             # ✅ CORREÇÃO: se o arquivo ainda não existe, NÃO pode ficar em loop travado
             if not os.path.exists(caminho):
                 leituras_iguais = 0
-                time.sleep(0.5)
+                PRONTIDAO.esperar(caminho, 0.5)
                 continue
 
+            # close-write chegou durante a espera → não precisa das 6 leituras
+            if PRONTIDAO.pronto(caminho):
+                return True
+
             tamanho_atual = os.path.getsize(caminho)
 
             # ✅ Só prossegue se o arquivo tiver tamanho e não mudar por 6 verificações
             if tamanho_atual > 0 and tamanho_atual == tamanho_anterior:
                 leituras_iguais += 1
                 if leituras_iguais >= 6:
+                    PRONTIDAO.marcar_estavel(caminho)
                     return True
             else:
                 leituras_iguais = 0
@@ -795,7 +3110,8 @@ def aguardar_estabilidade_arquivo(caminho, timeout=60):
         except Exception as e:
             print(f"⚠️ Erro ao checar arquivo: {e}")
 
-        time.sleep(1.3)
+        # só o close-write deste arquivo encurta o intervalo entre leituras
+        PRONTIDAO.esperar(caminho, 1.3)
         
     return False
 
@@ -830,8 +3146,397 @@ def extrair_lista_arquivos_moonraker(json_data):
 
     return []
 
+# ==========================================================================
+# 🗂️ ÍNDICE DE CONTEÚDO REMOTO (pula upload de arquivo idêntico)
+# ==========================================================================
+# Reimprimir a mesma peça na mesma impressora reenviava o G-code inteiro.
+# Guardamos (ip, nome, tamanho, sha256, mtimes) de cada upload confirmado e,
+# antes do próximo envio, conferimos com o /server/files/metadata da
+# impressora: mesmo tamanho e mesmo "modified" = o arquivo lá é o nosso.
+
+HASHES_LOCAIS = {}              # (caminho, tamanho, mtime) -> sha256
+HASHES_LOCAIS_LOCK = threading.Lock()
+HASH_CHUNK = 1024 * 1024
+
+def guardar_hash_local(caminho, tamanho, mtime, sha):
+    chave = (caminho, tamanho, mtime)
+    with HASHES_LOCAIS_LOCK:
+        # uma entrada por caminho: versão nova do arquivo substitui a antiga
+        for k in [k for k in HASHES_LOCAIS if k[0] == caminho and k != chave]:
+            del HASHES_LOCAIS[k]
+        HASHES_LOCAIS[chave] = sha
+
+def hash_local_em_cache(caminho, tamanho, mtime):
+    """sha256 já conhecido desta versão do arquivo, sem ler nada do Samba."""
+    return HASHES_LOCAIS.get((caminho, tamanho, mtime))
+
+def hash_arquivo_local(caminho, lote=None):
+    """sha256 do G-code local, com cache por versão (tamanho + mtime) do arquivo."""
+    if lote and lote.ok:
+        tamanho, mtime = lote.tamanho, lote.mtime
+        sha = hash_local_em_cache(caminho, tamanho, mtime)
+        if sha is None:
+            sha = lote.hash_conteudo()
+    else:
+        st = os.stat(caminho)
+        tamanho, mtime = st.st_size, st.st_mtime
+        sha = hash_local_em_cache(caminho, tamanho, mtime)
+        if sha is None:
+            h = hashlib.sha256()
+            buf = memoryview(bytearray(HASH_CHUNK))
+            with open(caminho, "rb", buffering=0) as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(buf[:n])
+            sha = h.hexdigest()
+
+    guardar_hash_local(caminho, tamanho, mtime, sha)
+    return sha
+
+def candidato_remoto(ip, nome_arquivo, tamanho):
+    """Há no índice um arquivo com este nome e tamanho? Só então vale hashear antes do upload."""
+    with app.app_context():
+        nome_low = nome_arquivo.lower()
+        nomes = (ArquivoRemoto.query.with_entities(ArquivoRemoto.nome)
+                 .filter_by(ip=ip, tamanho=tamanho).all())
+        return any(os.path.basename(n).lower() == nome_low for (n,) in nomes)
+
+def consultar_metadados(ip, filename_path):
+    """
+    (status HTTP, metadata) de um arquivo da impressora.
+    Só 404 quer dizer "não existe"; timeout/5xx voltam (None ou status, None).
+    """
+    url = f"http://{ip}/server/files/metadata?filename={urllib.parse.quote(filename_path)}"
+    try:
+        r = http_get(url, operacao="arquivos")
+        if r.status_code != 200:
+            return r.status_code, None
+        meta = r.json().get("result")
+        return 200, (meta if isinstance(meta, dict) else None)
+    except Exception as e:
+        log(ip, "META_FAIL", str(e))
+        return None, None
+
+def metadados_remotos(ip, filename_path):
+    """/server/files/metadata de um arquivo da impressora (None se não existir ou não respondeu)."""
+    return consultar_metadados(ip, filename_path)[1]
+
+def arquivo_identico_na_impressora(ip, nome_arquivo, tamanho, sha256):
+    """
+    Retorna o path remoto se a impressora já tem exatamente este conteúdo.
+    Entrada do índice que não bate mais com a impressora é descartada.
+    """
+    with app.app_context():
+        candidatos = (ArquivoRemoto.query
+                      .filter_by(ip=ip, sha256=sha256, tamanho=tamanho)
+                      .order_by(ArquivoRemoto.atualizado_em.desc())
+                      .all())
+        nome_low = nome_arquivo.lower()
+        reg = next((c for c in candidatos if os.path.basename(c.nome).lower() == nome_low), None)
+        if not reg:
+            return None
+
+        meta = metadados_remotos(ip, reg.nome)
+        ok = (meta is not None
+              and int(meta.get("size") or 0) == tamanho
+              and (reg.mtime_remoto is None or abs(float(meta.get("modified") or 0) - reg.mtime_remoto) < 1e-3))
+        if ok:
+            return reg.nome
+
+        log(ip, "CACHE", f"Índice desatualizado para '{reg.nome}' (meta={bool(meta)}) → reenviando")
+        db.session.delete(reg)
+        db.session.commit()
+        return None
+
+def registrar_arquivo_remoto(ip, filename_path, tamanho, sha256, mtime_local=None, mtime_remoto=None):
+    """Grava/atualiza o índice depois de um upload com tamanho conferido."""
+    meta = {"modified": mtime_remoto} if mtime_remoto is not None else (metadados_remotos(ip, filename_path) or {})
+    with app.app_context():
+        reg = ArquivoRemoto.query.filter_by(ip=ip, nome=filename_path).first()
+        if not reg:
+            reg = ArquivoRemoto(ip=ip, nome=filename_path)
+            db.session.add(reg)
+        reg.tamanho = tamanho
+        reg.sha256 = sha256
+        reg.mtime_local = mtime_local
+        reg.mtime_remoto = float(meta["modified"]) if meta.get("modified") is not None else None
+        reg.atualizado_em = datetime.utcnow()
+        db.session.commit()
+
+def esquecer_arquivo_remoto(ip, filename_path=None):
+    """Remove do índice um arquivo (ou todos os da impressora, se filename_path=None)."""
+    with app.app_context():
+        q = ArquivoRemoto.query.filter_by(ip=ip)
+        if filename_path:
+            q = q.filter_by(nome=filename_path)
+        q.delete(synchronize_session=False)
+        db.session.commit()
+
+
+# ==========================================================================
+# 📁 LISTA DE ARQUIVOS POR IMPRESSORA (cache do /server/files/list)
+# ==========================================================================
+# Cada job baixava a lista inteira de G-codes da impressora depois do upload
+# e de novo antes de cada retry; a aba "arquivos internos" também. Agora a
+# lista é baixada uma vez e mantida por notify_filelist_changed (websocket).
+# Sem websocket a lista vale ARQUIVOS_REMOTOS_TTL segundos; para um arquivo
+# só, o /server/files/metadata confirma tamanho sem baixar o diretório.
+ARQUIVOS_REMOTOS_TTL = 30.0
+
+class ListaArquivosImpressora:
+    """Arquivos do root=gcodes de UMA impressora, por path, nome e nome minúsculo."""
+    def __init__(self):
+        self.por_path = {}          # path -> item do Moonraker (com "path" normalizado)
+        self.por_nome = {}          # basename -> set(path)
+        self.por_nome_low = {}      # basename.lower() -> set(path)
+        self.carregada_em = 0.0     # 0 = nunca baixada / invalidada
+        self.ordenada = None        # cache da lista por modified desc
+        self.versao = 0             # sobe a cada notificação do websocket
+        self.durante = None         # notificações recebidas durante um download (None = sem download)
+        self.lock = threading.Lock()        # só para mexer no índice, nunca durante HTTP
+        self.baixando = threading.Lock()    # um download da lista por vez
+
+    def _indexar(self, path, item):
+        nome = path.rsplit('/', 1)[-1]
+        self.por_path[path] = item
+        self.por_nome.setdefault(nome, set()).add(path)
+        self.por_nome_low.setdefault(nome.lower(), set()).add(path)
+        self.ordenada = None
+
+    def _desindexar(self, path):
+        if self.por_path.pop(path, None) is None:
+            return
+        nome = path.rsplit('/', 1)[-1]
+        for idx, chave in ((self.por_nome, nome), (self.por_nome_low, nome.lower())):
+            paths = idx.get(chave)
+            if paths:
+                paths.discard(path)
+                if not paths:
+                    del idx[chave]
+        self.ordenada = None
+
+    def substituir(self, itens):
+        self.por_path, self.por_nome, self.por_nome_low = {}, {}, {}
+        for a in itens:
+            path = a.get("path") or a.get("filename")
+            if path:
+                self._indexar(path, dict(a, path=path))
+        self.carregada_em = time.time()
+
+    def atualizar(self, path, item):
+        self._desindexar(path)
+        self._indexar(path, dict(item, path=path))
+
+    def remover(self, path):
+        self._desindexar(path)
+
+    def remover_pasta(self, pasta):
+        prefixo = pasta.rstrip('/') + '/'
+        for path in [p for p in self.por_path if p.startswith(prefixo)]:
+            self._desindexar(path)
+
+    def procurar(self, nome):
+        """path do arquivo pelo nome (exato primeiro, depois sem caixa); raiz ganha de subpasta."""
+        paths = self.por_nome.get(nome) or self.por_nome_low.get((nome or "").lower())
+        if not paths:
+            return None
+        return min(paths, key=lambda p: (p.count('/'), p))
+
+    def ordenada_por_data(self):
+        if self.ordenada is None:
+            self.ordenada = sorted(self.por_path.values(),
+                                   key=lambda x: x.get('modified', 0) or 0, reverse=True)
+        return self.ordenada
+
+
+class ArquivosImpressoras:
+    """Listas por IP + aplicação das notificações de arquivo do Moonraker."""
+    def __init__(self, ttl=ARQUIVOS_REMOTOS_TTL):
+        self.ttl = ttl
+        self._listas = {}
+        self._guarda = threading.Lock()
+        self.downloads = 0          # listas completas baixadas
+        self.consultas = 0          # buscas respondidas sem baixar a lista
+        self.notificacoes = 0
+
+    def _lista(self, ip):
+        with self._guarda:
+            lista = self._listas.get(ip)
+            if lista is None:
+                lista = self._listas[ip] = ListaArquivosImpressora()
+            return lista
+
+    def _valida(self, ip, lista):
+        if not lista.carregada_em:
+            return False
+        # com websocket as notificações mantêm a lista; sem ele, vale pelo TTL
+        return assinatura_ativa(ip) or time.time() - lista.carregada_em < self.ttl
+
+    def _baixar(self, ip, lista, pedido_em=None):
+        """
+        Baixa a lista SEM segurar lista.lock (o websocket da impressora precisa
+        dele para aplicar notificações). O que chegar durante o download é
+        reaplicado por cima da lista nova.
+        """
+        pedido_em = pedido_em or time.time()
+        with lista.baixando:
+            if lista.carregada_em >= pedido_em:
+                return 200      # outro pedido acabou de baixar enquanto esperávamos
+            with lista.lock:
+                lista.durante = []
+            try:
+                url = f"http://{ip}/server/files/list?root=gcodes"
+                r = http_get(url, operacao="arquivos")
+                if r.status_code != 200:
+                    log(ip, "LIST", f"falhou | status={r.status_code} | body={(r.text or '')[:200]}")
+                    return r.status_code
+                itens = extrair_lista_arquivos_moonraker(r.json())
+                with lista.lock:
+                    lista.substituir(itens)
+                    for params in lista.durante:
+                        self._aplicar(lista, params)
+                    lista.durante = None
+                    total = len(lista.por_path)
+            finally:
+                with lista.lock:
+                    lista.durante = None
+        self.downloads += 1
+        log(ip, "LIST", f"Lista baixada: {total} arquivo(s)")
+        return 200
+
+    def listar(self, ip):
+        """(arquivos por modified desc, status HTTP). Baixa a lista só se o cache venceu."""
+        lista = self._lista(ip)
+        with lista.lock:
+            valida = self._valida(ip, lista)
+        if not valida:
+            status = self._baixar(ip, lista)
+            if status != 200:
+                return None, status
+        with lista.lock:
+            return lista.ordenada_por_data(), 200
+
+    def buscar(self, ip, nome):
+        """
+        (filename_path, size_remoto) do arquivo no root=gcodes, ou (None, 0).
+        O tamanho vem do /server/files/metadata do próprio arquivo; a lista
+        completa só é baixada se o arquivo não estiver no índice e o índice
+        não for confiável, ou se o metadata não respondeu (timeout/5xx).
+        """
+        lista = self._lista(ip)
+        with lista.lock:
+            path = lista.procurar(nome) or nome
+            versao = lista.versao
+        status, meta = consultar_metadados(ip, path)
+
+        if meta is not None:
+            self.consultas += 1
+            with lista.lock:
+                # notificação no meio da consulta manda mais que a resposta
+                if lista.versao == versao:
+                    lista.atualizar(path, {"size": meta.get("size"), "modified": meta.get("modified")})
+            return path, int(meta.get("size") or 0)
+
+        if status == 404:
+            with lista.lock:
+                if lista.versao == versao:
+                    lista.remover(path)
+                if self._valida(ip, lista) and not lista.procurar(nome):
+                    self.consultas += 1
+                    return None, 0
+        else:
+            log(ip, "LIST", f"metadata de '{path}' sem resposta (status={status}) → conferindo pela lista")
+
+        if self._baixar(ip, lista) != 200:
+            return None, 0
+        with lista.lock:
+            path = lista.procurar(nome)
+            if not path:
+                log(ip, "LIST", f"Arquivo '{nome}' não encontrado na lista do Moonraker")
+                return None, 0
+            return path, int(lista.por_path[path].get("size") or 0)
+
+    def registrar(self, ip, path, item):
+        """Item conhecido sem consultar a impressora (ex.: resposta do upload)."""
+        self._aplicar_local(ip, "create_file", dict(item, root="gcodes", path=path))
+
+    def esquecer(self, ip, path):
+        self._aplicar_local(ip, "delete_file", {"root": "gcodes", "path": path})
+
+    def _aplicar_local(self, ip, acao, item):
+        # mudança feita por nós: entra no índice e, se houver download em curso, é reaplicada nele
+        params = [{"action": acao, "item": item}]
+        lista = self._lista(ip)
+        with lista.lock:
+            self._aplicar(lista, params)
+            if lista.durante is not None:
+                lista.durante.append(params)
+
+    def invalidar(self, ip):
+        """Websocket reconectou: notificações podem ter se perdido."""
+        self._notificar(ip, [{"action": "root_update"}])
+
+    def descartar(self, ip):
+        with self._guarda:
+            self._listas.pop(ip, None)
+
+    def ao_notificar(self, ip, params):
+        """notify_filelist_changed: [{action, item: {root, path, size, modified}, source_item}]"""
+        self.notificacoes += 1
+        self._notificar(ip, params)
+
+    def _notificar(self, ip, params):
+        lista = self._lista(ip)
+        with lista.lock:
+            lista.versao += 1
+            self._aplicar(lista, params)
+            if lista.durante is not None:
+                lista.durante.append(params)
+
+    def _aplicar(self, lista, params):
+        # chamado com lista.lock
+        for n in params or []:
+            if not isinstance(n, dict):
+                continue
+            acao = n.get("action")
+            item = n.get("item") or {}
+            origem = n.get("source_item") or {}
+            if acao == "root_update":
+                lista.carregada_em = 0.0
+                continue
+            if acao in ("move_file", "move_dir") and origem.get("root") == "gcodes":
+                if acao == "move_file":
+                    lista.remover(origem.get("path") or "")
+                else:
+                    lista.remover_pasta(origem.get("path") or "")
+            if item.get("root") != "gcodes" or not item.get("path"):
+                continue
+            if acao in ("create_file", "modify_file", "move_file"):
+                lista.atualizar(item["path"], {k: v for k, v in item.items() if k != "root"})
+            elif acao == "delete_file":
+                lista.remover(item["path"])
+            elif acao == "delete_dir":
+                lista.remover_pasta(item["path"])
+            elif acao == "move_dir":
+                lista.carregada_em = 0.0     # conteúdo da pasta nova não vem na notificação
+
+    def estatisticas(self):
+        with self._guarda:
+            listas = dict(self._listas)
+        return {
+            "impressoras": len(listas),
+            "arquivos": sum(len(l.por_path) for l in listas.values()),
+            "downloads_lista": self.downloads,
+            "consultas_sem_lista": self.consultas,
+            "notificacoes": self.notificacoes,
+        }
+
+ARQUIVOS_IMPRESSORAS = ArquivosImpressoras()
 
-def tarefa_upload(ip_alvo, caminho_completo):
+
+def tarefa_upload(ip_alvo, caminho_completo, lote=None):
     """
     Versão ROBUSTA baseada na SUA função, com:
     ✅ validação de arquivo truncado (size remoto x local)
@@ -845,15 +3550,14 @@ def tarefa_upload(ip_alvo, caminho_completo):
 
     def set_prog(p, msg):
         PROGRESSO_UPLOAD[ip_alvo] = {"p": p, "msg": msg}
+        FILA_JOBS.registrar_etapa(ip_alvo, p, msg)
         log(ip_alvo, "PROGRESS", f"{p}% | {msg}")
 
-    sess = requests.Session()
-
-    def moon_get(url, timeout=3.0):
-        return sess.get(url, timeout=timeout)
+    def moon_get(url, operacao="status"):
+        return http_get(url, operacao=operacao)
 
-    def moon_post(url, timeout=5.0, **kwargs):
-        return sess.post(url, timeout=timeout, **kwargs)
+    def moon_post(url, operacao="comando", **kwargs):
+        return http_post(url, operacao=operacao, **kwargs)
 
     def extrair_status(resp):
         try:
@@ -861,49 +3565,12 @@ def tarefa_upload(ip_alvo, caminho_completo):
         except Exception:
             return -1, ""
 
-    def listar_arquivos():
-        url_list = f"http://{ip_alvo}/server/files/list?root=gcodes"
-        log(ip_alvo, "LIST", f"GET {url_list}")
-        r = moon_get(url_list, timeout=10)
-        log(ip_alvo, "LIST", f"status={r.status_code}")
-        if r.status_code != 200:
-            log(ip_alvo, "LIST", f"falhou | body={(r.text or '')[:200]}")
-            return None, []
-        data = r.json()
-        arquivos = extrair_lista_arquivos_moonraker(data)
-        return r, arquivos
-
     def buscar_arquivo_no_moonraker(nome):
         """
         Retorna tupla (filename_path, size_remoto) do arquivo dentro do root=gcodes.
         filename_path pode ser: 'Teste.gcode' ou 'subpasta/Teste.gcode'
         """
-        _, arquivos = listar_arquivos()
-        if not arquivos:
-            return None, 0
-
-        # case-sensitive primeiro
-        for a in arquivos:
-            if not isinstance(a, dict):
-                continue
-            if a.get("filename") == nome:
-                path = a.get("path") or a.get("filename") or nome
-                size = int(a.get("size") or 0)
-                return path, size
-
-        # fallback case-insensitive
-        nome_low = (nome or "").lower()
-        for a in arquivos:
-            if not isinstance(a, dict):
-                continue
-            fn = (a.get("filename") or "")
-            if fn.lower() == nome_low:
-                path = a.get("path") or a.get("filename") or fn
-                size = int(a.get("size") or 0)
-                return path, size
-
-        log(ip_alvo, "LIST", f"Arquivo '{nome}' não encontrado na lista do Moonraker")
-        return None, 0
+        return ARQUIVOS_IMPRESSORAS.buscar(ip_alvo, nome)
 
     def deletar_arquivo_remoto(filename_path):
         """
@@ -918,7 +3585,9 @@ def tarefa_upload(ip_alvo, caminho_completo):
         log(ip_alvo, "DELETE", f"POST {url_del}")
 
         try:
-            r = moon_post(url_del, timeout=10)
+            esquecer_arquivo_remoto(ip_alvo, filename_path)
+            ARQUIVOS_IMPRESSORAS.esquecer(ip_alvo, filename_path)
+            r = moon_post(url_del, operacao="arquivos")
             log(ip_alvo, "DELETE", f"status={r.status_code} | body={(r.text or '')[:200]}")
             return r.status_code < 400
         except Exception as e:
@@ -937,7 +3606,7 @@ def tarefa_upload(ip_alvo, caminho_completo):
         log(ip_alvo, "START_PRINT", f"POST {url_start_qs}")
 
         try:
-            r1 = moon_post(url_start_qs, timeout=(3.0, 12.0))
+            r1 = moon_post(url_start_qs, operacao="start")
             log(ip_alvo, "START_PRINT", f"qs status={r1.status_code} | body={(r1.text or '')[:200]}")
             if r1.status_code < 400:
                 return True
@@ -952,7 +3621,7 @@ def tarefa_upload(ip_alvo, caminho_completo):
         log(ip_alvo, "START_PRINT", f"POST {url_start_json} json={payload}")
 
         try:
-            r2 = moon_post(url_start_json, json=payload, timeout=(3.0, 12.0))
+            r2 = moon_post(url_start_json, operacao="start", json=payload)
             log(ip_alvo, "START_PRINT", f"json status={r2.status_code} | body={(r2.text or '')[:200]}")
             if r2.status_code < 400:
                 return True
@@ -968,40 +3637,25 @@ def tarefa_upload(ip_alvo, caminho_completo):
         Valida se entrou em impressão. Tolerante a estados intermediários.
         Retorna True se ok.
         """
-        url_state = f"http://{ip_alvo}/printer/objects/query?print_stats"
-        inicio = time.time()
-        ultimo_state = None
-
-        # tolerância: algumas N4 ficam em "startup/busy" antes de virar "printing"
-        estados_ok = {"printing", "paused", "startup", "busy"}
-
-        while time.time() - inicio < timeout_total:
-            try:
-                st = moon_get(url_state, timeout=3.0)
-                if st.status_code == 200:
-                    dados = st.json().get("result", {}).get("status", {})
-                    state = (dados.get("print_stats") or {}).get("state")
-
-                    if state != ultimo_state:
-                        log(ip_alvo, "VALIDATE", f"state={state}")
-                        ultimo_state = state
+        return esperar_estado_impressao(ip_alvo, timeout_total)
 
-                    if state in estados_ok:
-                        return True
-
-                else:
-                    log(ip_alvo, "VALIDATE_BAD", f"HTTP {st.status_code} | body={(st.text or '')[:200]}")
-            except Exception as e:
-                log(ip_alvo, "VALIDATE_FAIL", str(e))
-
-            time.sleep(2)
-
-        return False
+    def resposta_upload(resp):
+        """
+        Item do upload no formato do Moonraker:
+        {"item": {"path", "root", "size", "modified"}, "print_started", "print_queued", "action"}
+        """
+        try:
+            dados = resp.json()
+        except Exception:
+            return {}
+        if isinstance(dados, dict) and isinstance(dados.get("result"), dict):
+            dados = dados["result"]
+        return dados if isinstance(dados, dict) else {}
 
     def log_ultimos_console():
         try:
             url_console = f"http://{ip_alvo}/server/gcode_store"
-            c = moon_get(url_console, timeout=3.0)
+            c = moon_get(url_console)
             if c.status_code == 200:
                 logs_brutos = c.json().get("result", {}).get("gcode_store", [])
                 if isinstance(logs_brutos, list) and logs_brutos:
@@ -1018,44 +3672,138 @@ def tarefa_upload(ip_alvo, caminho_completo):
         log(ip_alvo, "START", f"Iniciando envio: {nome_arquivo}")
 
         # 1) SYNC (Samba) - fora do retry (não muda entre tentativas)
-        set_prog(2, "Sincronizando arquivo (Samba)")
-        ok = aguardar_estabilidade_arquivo(caminho_completo)
+        if lote:
+            # envio em massa: estabiliza e lê o arquivo uma vez só para o lote inteiro
+            set_prog(2, "Preparando arquivo do lote (leitura única)")
+            ok = lote.preparar(ip_alvo)
+        else:
+            set_prog(2, "Sincronizando arquivo (Samba)")
+            ok = aguardar_estabilidade_arquivo(caminho_completo)
         log(ip_alvo, "SYNC", f"estavel={ok}")
         if not ok:
             raise Exception("Arquivo incompleto no servidor (Samba)")
 
-        tamanho_local = os.path.getsize(caminho_completo)
+        tamanho_local = lote.tamanho if lote else os.path.getsize(caminho_completo)
+        mtime_local = lote.mtime if lote else os.path.getmtime(caminho_completo)
         log(ip_alvo, "SYNC", f"size_local={tamanho_local}")
 
+        # 1.5) CACHE: impressora já tem este conteúdo? vai direto para o start
+        # Fora do lote o arquivo só é lido para hash se o índice tem um candidato
+        # com mesmo nome e tamanho; senão o hash sai do próprio upload.
+        sha_local = hash_local_em_cache(caminho_completo, tamanho_local, mtime_local)
+        if sha_local is None and (lote or candidato_remoto(ip_alvo, nome_arquivo, tamanho_local)):
+            sha_local = hash_arquivo_local(caminho_completo, lote)
+        path_cache = (arquivo_identico_na_impressora(ip_alvo, nome_arquivo, tamanho_local, sha_local)
+                      if sha_local else None)
+        if path_cache:
+            log(ip_alvo, "CACHE", f"Arquivo idêntico já está na impressora ({path_cache}) → sem upload")
+            set_prog(95, "Arquivo já está na impressora (sem upload) · iniciando")
+            tentar_start_print(path_cache)
+
+            set_prog(98, "Validando se entrou em impressão")
+            if validar_estado_printing(timeout_total=60):
+                set_prog(100, "Sucesso!")
+                log(ip_alvo, "SUCESSO", f"Impressão iniciada sem reenviar ({path_cache})")
+                return True
+
+            log_ultimos_console()
+            log(ip_alvo, "CACHE", "Start do arquivo em cache não confirmou → seguindo com upload normal")
+            esquecer_arquivo_remoto(ip_alvo, path_cache)
+
         ultima_ex = None
 
         for tentativa in range(1, 4):  # 1..3
             try:
                 log(ip_alvo, "TRY", f"Tentativa {tentativa}/3")
+                # rápido só na 1ª tentativa: retry volta ao caminho clássico (upload → start)
+                inicio_rapido = UPLOAD_INICIO_RAPIDO and tentativa == 1
 
-                # 2) UPLOAD (com semáforo global)
-                with UPLOAD_SEM:
+                # 2) UPLOAD (vaga no grupo de rede + balde de banda)
+                set_prog(5, f"Aguardando vaga de rede (tentativa {tentativa}/3)")
+                with AGENDADOR_UPLOADS.vaga(ip_alvo) as grupo:
                     set_prog(5, f"Transmitindo para a impressora (tentativa {tentativa}/3)")
-                    log(ip_alvo, "UPLOAD", "Entrou no semaphore")
-
-                    with open(caminho_completo, "rb") as f:
-                        monitor = Monitor(f, ip_alvo)
-                        files = {"file": (nome_arquivo, monitor)}
-
-                        url_upload = f"http://{ip_alvo}/server/files/upload"
-                        log(ip_alvo, "UPLOAD", f"POST {url_upload}")
-
-                        resp = sess.post(url_upload, files=files, timeout=(8.0, 1800))
-                        log(ip_alvo, "UPLOAD", f"status={resp.status_code}")
-
-                        if resp.status_code >= 400:
-                            body = (resp.text or "")[:300]
-                            raise Exception(f"Falha upload HTTP {resp.status_code}: {body}")
-
-                        log(ip_alvo, "UPLOAD_OK",
-                            f"Upload finalizado | status={resp.status_code} | size_local={tamanho_local}")
+                    log(ip_alvo, "UPLOAD", f"Entrou no agendador | grupo={grupo.nome}")
+
+                    corpo = CorpoMultipart(caminho_completo, nome_arquivo, ip_alvo, grupo, lote,
+                                           campos={"print": "true"} if inicio_rapido else None,
+                                           sha256=sha_local, enviar_checksum=UPLOAD_CHECKSUM)
+
+                    url_upload = f"http://{ip_alvo}/server/files/upload"
+                    log(ip_alvo, "UPLOAD", f"POST {url_upload}")
+
+                    resp = http_post(url_upload, operacao="upload", data=corpo,
+                                     headers={"Content-Type": corpo.content_type})
+                    log(ip_alvo, "UPLOAD", f"status={resp.status_code}")
+
+                    if resp.status_code == 422 and UPLOAD_CHECKSUM:
+                        # Moonraker recusou pelo checksum: nada foi gravado nem impresso
+                        log(ip_alvo, "CHECKSUM", f"Upload corrompido recusado pela impressora: {(resp.text or '')[:200]}")
+                        # hash do cache pode ser de outra gravação com mesmo tamanho/mtime:
+                        # o retry recalcula sobre o que transmitir
+                        with HASHES_LOCAIS_LOCK:
+                            HASHES_LOCAIS.pop((caminho_completo, tamanho_local, mtime_local), None)
+                        sha_local = None
+                        raise Exception("Checksum não confere na impressora (upload corrompido)")
+                    if resp.status_code >= 400:
+                        body = (resp.text or "")[:300]
+                        raise Exception(f"Falha upload HTTP {resp.status_code}: {body}")
+
+                    log(ip_alvo, "UPLOAD_OK",
+                        f"Upload finalizado | status={resp.status_code} | size_local={tamanho_local} "
+                        f"| {corpo.mb_por_segundo()} MB/s")
+
+                    log(ip_alvo, "UPLOAD_BODY", (resp.text or "")[:500])
+                    fim_upload = time.monotonic()
+
+                if sha_local is None and corpo.sha256 and corpo.bytes_read == tamanho_local:
+                    # hash do que foi transmitido: vale para esta versão do arquivo
+                    sha_local = corpo.sha256
+                    guardar_hash_local(caminho_completo, tamanho_local, mtime_local, sha_local)
+
+                # 3a) INÍCIO RÁPIDO: o checksum já foi conferido pelo Moonraker antes do
+                # start (resposta 2xx); tamanho vem da resposta do upload, estado por evento
+                if inicio_rapido:
+                    dados_up = resposta_upload(resp)
+                    item = dados_up.get("item") or {}
+                    filename_path = item.get("path") or nome_arquivo
+                    size_remoto = int(item.get("size") or 0)
+
+                    if item.get("path"):
+                        ARQUIVOS_IMPRESSORAS.registrar(ip_alvo, filename_path, item)
+                    if size_remoto == tamanho_local:
+                        registrar_arquivo_remoto(ip_alvo, filename_path, tamanho_local, sha_local,
+                                                 mtime_local, item.get("modified"))
+                    elif size_remoto:
+                        # não deveria acontecer com checksum; não apaga arquivo que pode estar imprimindo
+                        log(ip_alvo, "TRUNCADO", f"Tamanho diverge após checksum ok (remoto={size_remoto} local={tamanho_local})")
+
+                    if dados_up.get("print_queued"):
+                        set_prog(100, "Sucesso! (na fila da impressora)")
+                        log(ip_alvo, "SUCESSO", f"Arquivo enviado e colocado na fila do Moonraker ({filename_path})")
+                        return True
 
-                        log(ip_alvo, "UPLOAD_BODY", (resp.text or "")[:500])
+                    if dados_up.get("print_started"):
+                        set_prog(98, "Validando se entrou em impressão")
+                        if validar_estado_printing(timeout_total=60):
+                            set_prog(100, "Sucesso!")
+                            log(ip_alvo, "SUCESSO",
+                                f"Arquivo enviado e impressão iniciada ({filename_path}) | "
+                                f"upload→printing {time.monotonic() - fim_upload:.2f}s")
+                            return True
+                        log_ultimos_console()
+                        raise Exception("Upload com print=true não confirmou estado de impressão em 60s")
+
+                    # print=true ignorado (versão antiga / impressora ocupada): start clássico
+                    log(ip_alvo, "START_PRINT", "print_started=false na resposta do upload → start manual")
+                    set_prog(95, "Iniciando impressão (start)")
+                    tentar_start_print(filename_path)
+                    set_prog(98, "Validando se entrou em impressão")
+                    if not validar_estado_printing(timeout_total=60):
+                        log_ultimos_console()
+                        raise Exception("Start enviado, mas não confirmou estado de impressão em 60s")
+                    set_prog(100, "Sucesso!")
+                    log(ip_alvo, "SUCESSO", f"Arquivo enviado e impressão iniciada ({filename_path})")
+                    return True
 
                 # 3) LISTAR + descobrir PATH real + VALIDAR SIZE
                 set_prog(85, "Validando arquivo na impressora (size remoto)")
@@ -1075,6 +3823,9 @@ def tarefa_upload(ip_alvo, caminho_completo):
                     deletar_arquivo_remoto(filename_path)
                     raise Exception(f"Arquivo TRUNCADO na impressora (remoto={size_remoto} local={tamanho_local})")
 
+                if size_remoto == tamanho_local:
+                    registrar_arquivo_remoto(ip_alvo, filename_path, tamanho_local, sha_local, mtime_local)
+
                 # 4) START PRINT (robusto)
                 set_prog(95, "Iniciando impressão (start)")
                 tentar_start_print(filename_path)
@@ -1090,7 +3841,7 @@ def tarefa_upload(ip_alvo, caminho_completo):
                 # ✅ sucesso
                 set_prog(100, "Sucesso!")
                 log(ip_alvo, "SUCESSO", f"Arquivo enviado e impressão iniciada ({filename_path})")
-                return  # encerra função
+                return True  # encerra função
 
             except Exception as e:
                 ultima_ex = e
@@ -1113,13 +3864,10 @@ def tarefa_upload(ip_alvo, caminho_completo):
     except Exception as e:
         log(ip_alvo, "ERRO_GERAL", str(e))
         PROGRESSO_UPLOAD[ip_alvo] = {"p": -1, "msg": str(e)[:120]}
+        return False
 
     finally:
         set_busy(ip_alvo, False)
-        try:
-            sess.close()
-        except Exception:
-            pass
 
 
 @app.route('/progresso_transmissao/<ip>')
@@ -1139,26 +3887,137 @@ def progresso_transmissao(ip):
     return jsonify({"p": p, "msg": msg})
 
 # --- Inicio Funcao Registrar Conclusao (Data Corrigida) ---
-def registrar_conclusao(nome_arquivo):
-    """Registra a peça no SQLite com tratamento moderno de timezone."""
+# ==========================================================================
+# 🧮 PRODUÇÃO EM WRITE-BEHIND (buffer em memória → lote no SQLite)
+# ==========================================================================
+# A conclusão era query + incremento + commit dentro da thread do monitor:
+# duas impressoras terminando a mesma peça disputavam a mesma linha e um
+# lock do SQLite travava o polling. Agora o monitor só empilha o evento;
+# uma thread grava em lote com INSERT ... ON CONFLICT DO UPDATE (contador)
+# e as linhas de EventoProducao na mesma transação.
+PRODUCAO_FLUSH_S = 2.0          # intervalo máximo entre gravações
+PRODUCAO_LOTE_MAX = 200         # eventos que antecipam a gravação
+
+class BufferProducao:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pendentes = []        # dicts prontos para EventoProducao
+        self._tem_dados = threading.Event()
+        self._thread = None
+        self.gravados = 0
+        self.falhas = 0
+
+    def registrar(self, evento):
+        with self._lock:
+            self._pendentes.append(evento)
+            cheio = len(self._pendentes) >= PRODUCAO_LOTE_MAX
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        if cheio:
+            self._tem_dados.set()
+
+    def pendentes_do_dia(self, dia):
+        """Contagem ainda não gravada (o dashboard não pode esperar o flush)."""
+        contagem = {}
+        with self._lock:
+            for ev in self._pendentes:
+                if ev["data"] == dia:
+                    contagem[ev["nome_peca"]] = contagem.get(ev["nome_peca"], 0) + 1
+        return contagem
+
+    def _loop(self):
+        while True:
+            self._tem_dados.wait(PRODUCAO_FLUSH_S)
+            self._tem_dados.clear()
+            self.descarregar()
+
+    def descarregar(self):
+        with self._lock:
+            lote, self._pendentes = self._pendentes, []
+        if not lote:
+            return 0
+
+        contagem = {}
+        for ev in lote:
+            chave = (ev["nome_peca"], ev["data"])
+            contagem[chave] = contagem.get(chave, 0) + 1
+
+        stmt = sqlite_insert(RegistroProducao).values([
+            {"nome_peca": nome, "data": dia, "quantidade": n} for (nome, dia), n in contagem.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["nome_peca", "data"],
+            set_={"quantidade": RegistroProducao.quantidade + stmt.excluded.quantidade},
+        )
+        resumo = linhas_resumo_producao(lote)
+        stmt_resumo = sqlite_insert(ResumoProducao).values(resumo)
+        stmt_resumo = stmt_resumo.on_conflict_do_update(
+            index_elements=["periodo", "inicio", "ip", "nome_peca"],
+            set_={"quantidade": ResumoProducao.quantidade + stmt_resumo.excluded.quantidade,
+                  "segundos": ResumoProducao.segundos + stmt_resumo.excluded.segundos},
+        )
+        try:
+            with app.app_context():
+                db.session.execute(stmt)
+                db.session.execute(stmt_resumo)
+                db.session.execute(db.insert(EventoProducao), lote)
+                db.session.commit()
+            self.gravados += len(lote)
+            return len(lote)
+        except Exception as e:
+            # banco travado/indisponível: devolve o lote (na frente) para a próxima rodada
+            self.falhas += 1
+            with self._lock:
+                self._pendentes[:0] = lote
+            print(f"🚨 Erro ao gravar produção no SQLite ({len(lote)} evento(s) mantidos): {e}")
+            return 0
+
+    def estatisticas(self):
+        with self._lock:
+            pendentes = len(self._pendentes)
+        return {"pendentes": pendentes, "gravados": self.gravados, "falhas": self.falhas}
+
+def inicio_do_periodo(dia, periodo):
+    if periodo == "semana":
+        return dia - timedelta(days=dia.weekday())
+    if periodo == "mes":
+        return dia.replace(day=1)
+    return dia
+
+def linhas_resumo_producao(eventos):
+    """Eventos de conclusão → incrementos do ResumoProducao (dia, semana e mês)."""
+    soma = {}
+    for ev in eventos:
+        segundos = (ev["fim"] - ev["inicio"]).total_seconds() if ev.get("inicio") else 0.0
+        for periodo in ("dia", "semana", "mes"):
+            chave = (periodo, inicio_do_periodo(ev["data"], periodo), ev.get("ip") or "", ev["nome_peca"])
+            q, seg = soma.get(chave, (0, 0.0))
+            soma[chave] = (q + 1, seg + max(segundos, 0.0))
+    return [{"periodo": p, "inicio": i, "ip": ip, "nome_peca": nome, "quantidade": q, "segundos": seg}
+            for (p, i, ip, nome), (q, seg) in soma.items()]
+
+PRODUCAO = BufferProducao()
+atexit.register(PRODUCAO.descarregar)   # desligamento limpo não perde o último lote
+
+
+def registrar_conclusao(nome_arquivo, ip=None, inicio=None):
+    """Empilha a peça concluída; quem grava no SQLite é o BufferProducao."""
     if not nome_arquivo or nome_arquivo == "Nenhum": 
         return
         
     nome_limpo = nome_arquivo.replace('.gcode', '').replace('.bgcode', '')
     # Uso do timezone.utc para evitar o DeprecationWarning do seu terminal
-    hoje = datetime.now(timezone.utc).date()
-
-    try:
-        registro = RegistroProducao.query.filter_by(nome_peca=nome_limpo, data=hoje).first()
-        if registro:
-            registro.quantidade += 1
-        else:
-            novo_registro = RegistroProducao(nome_peca=nome_limpo, data=hoje, quantidade=1)
-            db.session.add(novo_registro)
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"🚨 Erro ao registrar produção no SQLite: {e}")
+    agora = datetime.now(timezone.utc)
+
+    PRODUCAO.registrar({
+        "ip": ip,
+        "nome_arquivo": nome_arquivo,
+        "nome_peca": nome_limpo,
+        "data": agora.date(),
+        "inicio": inicio,
+        "fim": agora.replace(tzinfo=None),
+    })
 # --- Fim Funcao Registrar Conclusao ---
 
 
@@ -1178,22 +4037,63 @@ def index():
             # Caso a máquina ainda não tenha sido monitorada no primeiro boot
             lista_final[ip] = {'nome': m['nome'], 'ip': ip, 'status': 'offline', 'cor': 'offline', 'msg': 'CONECTANDO...', 'progresso': 0, 'imagem': 'n4max.png', 'modelo_real': 'Neptune 4 MAX'}
 
-    disponiveis = sum(1 for p in IMPRESSORAS_ENCONTRADAS.values() if p.get('cor') == 'ready')
+    disponiveis = contar_disponiveis()
     return render_template('index.html', impressoras=lista_final, disponiveis=disponiveis)
 
 @app.route('/cadastrar_impressora', methods=['POST'])
 def cadastrar_impressora():
     dados = request.json
     ip, nome = dados.get('ip'), dados.get('nome')
-    if ip and nome and salvar_maquina(ip, nome):
+    grupo = (dados.get('grupo_rede') or '').strip()
+    tags = ",".join(normalizar_tags(dados.get('tags')))
+    if ip and nome and salvar_maquina(ip, nome, grupo, tags):
         return jsonify({"success": True})
     return jsonify({"success": False, "message": "IP já existe ou dados inválidos"})
 
+@app.route('/api/impressora_tags', methods=['POST'])
+def impressora_tags():
+    """Troca as tags (pools do despacho automático) de uma impressora"""
+    dados = request.json or {}
+    maquina = Maquina.query.filter_by(ip=dados.get('ip')).first()
+    if not maquina:
+        return jsonify({"success": False, "message": "Impressora não encontrada"}), 404
+    maquina.tags = ",".join(normalizar_tags(dados.get('tags'))) or None
+    db.session.commit()
+    REGISTRO_MAQUINAS.invalidar()
+    DESPACHANTE.acordar()
+    return jsonify({"success": True, "tags": maquina.tags})
+
 # --- Rota de Status (Limpa) ---
 @app.route('/status_atualizado')
 def status_atualizado():
-    disponiveis = sum(1 for p in IMPRESSORAS_ENCONTRADAS.values() if p.get('cor') == 'ready')
-    return jsonify({"impressoras": IMPRESSORAS_ENCONTRADAS, "total_disponiveis": disponiveis})
+    """
+    Estado da farm para o polling (fallback do push).
+    - If-None-Match com a ETag atual -> 304 sem corpo
+    - ?since=<versao>&boot=<boot> -> só as impressoras que mudaram
+    """
+    estado = IMPRESSORAS_ENCONTRADAS
+    since = request.args.get('since', type=int)
+
+    if since is not None and request.args.get('boot') == estado.boot:
+        mudaram, removidas, versao = estado.delta(since)
+        return jsonify({
+            "impressoras": mudaram,
+            "removidas": removidas,
+            "total_disponiveis": contar_disponiveis(),
+            "versao": versao,
+            "boot": estado.boot,
+            "completo": False
+        })
+
+    corpo, versao = estado.json_completo()
+    etag = estado.etag(versao)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(corpo, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 
 @app.route('/imprimir', methods=['POST'])
@@ -1232,6 +4132,265 @@ def imprimir():
 
 # --- 1) Rota Navegar (Acesso a Pastas e Arquivos com Tamanho) ---
 # --- Rota Navegar (Blindada e com Metadados) ---
+# ==========================================================================
+# 📚 ÍNDICE DA BIBLIOTECA (PASTA_RAIZ → SQLite)
+# ==========================================================================
+# Abrir pasta com milhares de G-codes fazia listdir + isdir + getsize por
+# item a cada clique. Um indexador em segundo plano espelha a árvore na
+# tabela ItemBiblioteca (scandir, só relista pasta cujo mtime mudou) e os
+# eventos do vigia de arquivos mantêm o espelho em dia entre as varreduras.
+
+BIBLIOTECA_INTERVALO = 300          # s entre varreduras (com inotify os eventos cobrem o resto)
+BIBLIOTECA_INTERVALO_SEM_VIGIA = 60
+BIBLIOTECA_PROFUNDA_A_CADA = 12     # a cada N varreduras relista tudo (pega sobrescrita sem evento)
+BIBLIOTECA_POR_PAGINA_MAX = 500
+ITENS_OCULTOS = {'Thumbs.db', '.DS_Store'}
+
+def item_oculto(nome):
+    return nome.startswith('.') or nome in ITENS_OCULTOS
+
+def formatar_tamanho_mb(tamanho_bytes):
+    return f"{round((tamanho_bytes or 0) / (1024 * 1024), 1)} MB"
+
+class IndiceBiblioteca:
+    def __init__(self, raiz):
+        self.raiz = os.path.abspath(raiz)
+        self._lock = threading.RLock()     # uma sincronização por vez (indexador x /navegar)
+        self._eventos = Queue()
+        self._thread = None
+        self._ouvintes = []                # callbacks(evento, caminho, tamanho, mtime) p/ a busca
+        self.stats = {"varreduras": 0, "pastas_relistadas": 0, "ultima_varredura_s": None,
+                      "eventos": 0, "fallback_navegar": 0}
+
+    # --- caminhos ---
+    def relativo(self, caminho_abs):
+        """Caminho absoluto → relativo com '/' (None se estiver fora da raiz)."""
+        caminho_abs = os.path.abspath(caminho_abs)
+        if caminho_abs == self.raiz:
+            return ''
+        if not caminho_abs.startswith(self.raiz + os.sep):
+            return None
+        return os.path.relpath(caminho_abs, self.raiz).replace(os.sep, '/')
+
+    def absoluto(self, rel):
+        return os.path.join(self.raiz, *rel.split('/')) if rel else self.raiz
+
+    @staticmethod
+    def _pai(rel):
+        return rel.rsplit('/', 1)[0] if '/' in rel else ''
+
+    def ouvir(self, fn):
+        """
+        callback(evento, caminho, tamanho, mtime) após cada commit:
+        'arquivo' | 'removido' | 'arvore_removida' | 'varredura_concluida'
+        """
+        self._ouvintes.append(fn)
+
+    def _avisar(self, mudancas):
+        for fn in list(self._ouvintes):
+            for m in mudancas:
+                try:
+                    fn(*m)
+                except Exception as e:
+                    print(f"⚠️ Ouvinte da biblioteca falhou: {e}")
+
+    # --- escrita no SQLite ---
+    def _apagar_arvore(self, rel):
+        q = ItemBiblioteca.query.filter(
+            (ItemBiblioteca.caminho == rel) |
+            ItemBiblioteca.caminho.startswith(rel + '/', autoescape=True))
+        q.delete(synchronize_session=False)
+
+    def sincronizar_pasta(self, rel, forcar=False):
+        """
+        Deixa as linhas filhas de `rel` iguais ao disco. Se o mtime da pasta não
+        mudou desde a última listagem, nem lista (retorna as subpastas do banco).
+        Retorna a lista de subpastas (relativas) para a varredura descer.
+        """
+        with self._lock, app.app_context():
+            try:
+                st = os.stat(self.absoluto(rel))
+            except OSError:
+                if rel:
+                    self._apagar_arvore(rel)
+                    db.session.commit()
+                    self._avisar([("arvore_removida", rel, 0, None)])
+                return []
+
+            linha = ItemBiblioteca.query.filter_by(caminho=rel).first()
+            if not forcar and linha and linha.mtime == st.st_mtime:
+                return [c for (c,) in db.session.query(ItemBiblioteca.caminho)
+                        .filter_by(pasta=rel, tipo='pasta')]
+
+            no_disco = {}
+            with os.scandir(self.absoluto(rel)) as it:
+                for e in it:
+                    if item_oculto(e.name):
+                        continue
+                    try:
+                        if e.is_dir():
+                            no_disco[e.name] = ('pasta', 0, None)
+                        else:
+                            s = e.stat()
+                            no_disco[e.name] = ('arquivo', s.st_size, s.st_mtime)
+                    except OSError as err:
+                        print(f"⚠️ Erro ao ler item {e.name}: {err}")
+
+            mudancas = []
+            existentes = {r.nome: r for r in ItemBiblioteca.query.filter_by(pasta=rel)}
+            for nome, r in existentes.items():
+                atual = no_disco.get(nome)
+                if atual is None or atual[0] != r.tipo:
+                    if r.tipo == 'pasta':
+                        self._apagar_arvore(r.caminho)
+                        mudancas.append(("arvore_removida", r.caminho, 0, None))
+                    else:
+                        db.session.delete(r)
+                        mudancas.append(("removido", r.caminho, 0, None))
+                elif r.tipo == 'arquivo' and (r.tamanho != atual[1] or r.mtime != atual[2]):
+                    r.tamanho, r.mtime = atual[1], atual[2]
+                    mudancas.append(("arquivo", r.caminho, r.tamanho, r.mtime))
+            db.session.flush()   # deletes antes dos inserts (nome que trocou de tipo)
+
+            for nome, (tipo, tamanho, mtime) in no_disco.items():
+                r = existentes.get(nome)
+                if r is not None and r.tipo == tipo:
+                    continue
+                caminho = f"{rel}/{nome}" if rel else nome
+                db.session.add(ItemBiblioteca(
+                    caminho=caminho, pasta=rel, nome=nome,
+                    tipo=tipo, tamanho=tamanho, mtime=mtime))
+                if tipo == 'arquivo':
+                    mudancas.append(("arquivo", caminho, tamanho, mtime))
+
+            if linha is None:
+                linha = ItemBiblioteca(caminho=rel, pasta=self._pai(rel) if rel else None,
+                                       nome=rel.rsplit('/', 1)[-1], tipo='pasta', tamanho=0)
+                db.session.add(linha)
+            linha.mtime = st.st_mtime
+            db.session.commit()
+            self.stats["pastas_relistadas"] += 1
+            self._avisar(mudancas)
+
+            return [f"{rel}/{n}" if rel else n for n, v in no_disco.items() if v[0] == 'pasta']
+
+    def atualizar_arquivo(self, rel):
+        """Evento de um arquivo só: upsert/delete da linha, sem relistar a pasta."""
+        with self._lock, app.app_context():
+            pai = self._pai(rel)
+            if not ItemBiblioteca.query.filter(ItemBiblioteca.caminho == pai,
+                                               ItemBiblioteca.mtime.isnot(None)).first():
+                return      # pasta ainda não indexada: a varredura pega
+            try:
+                st = os.stat(self.absoluto(rel))
+            except OSError:
+                st = None
+            r = ItemBiblioteca.query.filter_by(caminho=rel).first()
+            nome = rel.rsplit('/', 1)[-1]
+            if st is None or item_oculto(nome):
+                if not r:
+                    return
+                db.session.delete(r)
+                mudanca = ("removido", rel, 0, None)
+            elif r is None:
+                db.session.add(ItemBiblioteca(caminho=rel, pasta=pai, nome=nome, tipo='arquivo',
+                                              tamanho=st.st_size, mtime=st.st_mtime))
+                mudanca = ("arquivo", rel, st.st_size, st.st_mtime)
+            else:
+                r.tamanho, r.mtime = st.st_size, st.st_mtime
+                mudanca = ("arquivo", rel, st.st_size, st.st_mtime)
+            db.session.commit()
+            self._avisar([mudanca])
+
+    def varrer(self, rel='', forcar=False):
+        inicio = time.time()
+        pendentes = [rel]
+        while pendentes:
+            atual = pendentes.pop()
+            try:
+                pendentes.extend(self.sincronizar_pasta(atual, forcar))
+            except Exception as e:
+                print(f"⚠️ Índice da biblioteca: falha em '{atual}': {e}")
+        if rel == '':
+            self.stats["varreduras"] += 1
+            self.stats["ultima_varredura_s"] = round(time.time() - inicio, 2)
+            self._avisar([("varredura_concluida", '', 0, None)])
+
+    # --- eventos do vigia (thread do inotify só enfileira) ---
+    def ao_evento(self, evento, caminho_abs):
+        rel = self.relativo(caminho_abs)
+        if rel is not None:
+            self._eventos.put((evento, rel))
+
+    def _aplicar_evento(self, evento, rel):
+        self.stats["eventos"] += 1
+        if evento == "overflow":
+            self.varrer(forcar=True)
+        elif evento == "pasta":
+            self.sincronizar_pasta(self._pai(rel), forcar=True)
+            if os.path.isdir(self.absoluto(rel)):
+                self.varrer(rel, forcar=True)
+        else:
+            self.atualizar_arquivo(rel)
+
+    def _loop(self):
+        ciclo = 0
+        while True:
+            try:
+                self.varrer(forcar=(ciclo % BIBLIOTECA_PROFUNDA_A_CADA == 0))
+            except Exception as e:
+                print(f"🚨 Falha na varredura da biblioteca: {e}")
+            ciclo += 1
+
+            intervalo = BIBLIOTECA_INTERVALO if PRONTIDAO.ativo else BIBLIOTECA_INTERVALO_SEM_VIGIA
+            limite = time.time() + intervalo
+            while True:
+                restante = limite - time.time()
+                if restante <= 0:
+                    break
+                try:
+                    evento, rel = self._eventos.get(timeout=restante)
+                except Exception:
+                    break
+                try:
+                    self._aplicar_evento(evento, rel)
+                except Exception as e:
+                    print(f"⚠️ Índice da biblioteca: evento {evento} '{rel}' falhou: {e}")
+
+    def iniciar(self):
+        if self._thread or not os.path.isdir(self.raiz):
+            return
+        PRONTIDAO.ouvir(self.ao_evento)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        print(f"📚 Indexador da biblioteca iniciado em {self.raiz}")
+
+    # --- leitura ---
+    def pasta_indexada(self, rel):
+        return ItemBiblioteca.query.filter(ItemBiblioteca.caminho == rel,
+                                           ItemBiblioteca.tipo == 'pasta',
+                                           ItemBiblioteca.mtime.isnot(None)).first() is not None
+
+    def estatisticas(self):
+        with app.app_context():
+            total = db.session.query(db.func.count(ItemBiblioteca.id)).scalar()
+        return {**self.stats, "itens": total, "rodando": self._thread is not None}
+
+BIBLIOTECA = IndiceBiblioteca(PASTA_RAIZ)
+
+ORDENS_BIBLIOTECA = {
+    "nome": ItemBiblioteca.nome,
+    "tamanho": ItemBiblioteca.tamanho,
+    "mtime": ItemBiblioteca.mtime,
+}
+
+
+@app.route('/api/biblioteca_stats')
+def biblioteca_stats():
+    """Itens indexados e custo da última varredura da PASTA_RAIZ"""
+    return jsonify({**BIBLIOTECA.estatisticas(), "busca": BUSCA_BIBLIOTECA.estatisticas()})
+
+
 @app.route('/navegar', methods=['POST'])
 def navegar():
     try:
@@ -1250,66 +4409,1099 @@ def navegar():
         if not alvo_abs.startswith(raiz_abs):
             return jsonify({"error": "Acesso Negado: Tentativa de sair da raiz"}), 403
 
-        # 4. Listagem dos itens
-        if not os.path.exists(alvo_abs):
-            return jsonify({"atual": subpasta, "pastas": [], "arquivos": [], "msg": "Pasta não encontrada"}), 200
+        rel = BIBLIOTECA.relativo(alvo_abs)
+        if rel is None:
+            return jsonify({"error": "Acesso Negado: Tentativa de sair da raiz"}), 403
 
-        itens = os.listdir(alvo_abs)
-        pastas, arquivos = [], []
+        # 4. Pasta ainda não indexada (1ª abertura / indexador rodando): lista agora e já grava
+        if not BIBLIOTECA.pasta_indexada(rel):
+            if not os.path.isdir(alvo_abs):
+                return jsonify({"atual": subpasta, "pastas": [], "arquivos": [], "msg": "Pasta não encontrada"}), 200
+            BIBLIOTECA.stats["fallback_navegar"] += 1
+            BIBLIOTECA.sincronizar_pasta(rel, forcar=True)
 
-        for nome in itens:
-            if nome.startswith('.') or nome in ['Thumbs.db', '.DS_Store']:
-                continue
-            
-            full_path = os.path.join(alvo_abs, nome)
-            
-            try:
-                if os.path.isdir(full_path):
-                    pastas.append({"nome": nome, "tipo": "pasta"})
-                else:
-                    # Tenta pegar o tamanho do arquivo
-                    tamanho_bytes = os.path.getsize(full_path)
-                    tamanho_mb = round(tamanho_bytes / (1024 * 1024), 1)
-                    arquivos.append({
-                        "nome": nome, 
-                        "tipo": "arquivo", 
-                        "tamanho": f"{tamanho_mb} MB"
-                    })
-            except Exception as e:
-                print(f"⚠️ Erro ao ler item {nome}: {e}")
-                continue # Pula arquivos problemáticos
+        # 5. Ordenação e paginação (sem 'limite' devolve tudo, como antes)
+        ordem = ORDENS_BIBLIOTECA.get(dados.get('ordem') or 'nome', ItemBiblioteca.nome)
+        decrescente = str(dados.get('direcao') or 'asc').lower() == 'desc'
+        try:
+            pagina = max(int(dados.get('pagina') or 1), 1)
+            limite = dados.get('limite')
+            limite = min(max(int(limite), 1), BIBLIOTECA_POR_PAGINA_MAX) if limite else None
+        except (TypeError, ValueError, OverflowError):
+            return jsonify({"error": "'pagina' e 'limite' precisam ser números inteiros"}), 400
+
+        pastas = [{"nome": n, "tipo": "pasta"} for (n,) in
+                  db.session.query(ItemBiblioteca.nome)
+                  .filter_by(pasta=rel, tipo='pasta')
+                  .order_by(ItemBiblioteca.nome)]
+
+        q = ItemBiblioteca.query.filter_by(pasta=rel, tipo='arquivo')
+        total_arquivos = q.count()
+        q = q.order_by(ordem.desc() if decrescente else ordem.asc(), ItemBiblioteca.nome)
+        if limite:
+            q = q.offset((pagina - 1) * limite).limit(limite)
+
+        arquivos = [{
+            "nome": r.nome,
+            "tipo": "arquivo",
+            "tamanho": formatar_tamanho_mb(r.tamanho),
+            "bytes": r.tamanho,
+            "mtime": r.mtime,
+            "miniatura": url_miniatura_biblioteca(r.caminho, r.tamanho, r.mtime)
+                         if r.nome.lower().endswith('.gcode') else None,
+        } for r in q]
 
         return jsonify({
             "atual": subpasta,
-            "pastas": sorted(pastas, key=lambda x: x['nome']),
-            "arquivos": sorted(arquivos, key=lambda x: x['nome'])
+            "pastas": pastas,
+            "arquivos": arquivos,
+            "total_arquivos": total_arquivos,
+            "pagina": pagina,
+            "paginas": (-(-total_arquivos // limite) or 1) if limite else 1,
         })
 
     except Exception as e:
         # Se chegar aqui, o erro será exibido no JSON em vez de dar tela de erro 500
         print(f"🚨 Falha na Rota Navegar: {str(e)}")
         return jsonify({"error": f"Erro interno no servidor: {str(e)}"}), 500
+
+
+# ==========================================================================
+# 🔎 BUSCA NA BIBLIOTECA (índice em memória)
+# ==========================================================================
+# Índice invertido de tokens (lista ordenada → prefixo por bisect) + uma
+# string única com todos os caminhos normalizados (substring via str.find,
+# em C). Carrega do ItemBiblioteca na 1ª busca e depois segue os avisos do
+# indexador, então não relê o disco nem o banco.
+
+BUSCA_LIMITE_PADRAO = 50
+BUSCA_MAX_CANDIDATOS = 1000         # teto de itens pontuados por consulta
+BUSCA_TOKENS_IGNORADOS = {"gcode", "bgcode"}
+
+def normalizar_busca(texto):
+    """minúsculo e sem acento: 'Suporte_Câmera' → 'suporte_camera'"""
+    return unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode().lower()
+
+def tokens_busca(texto_normalizado):
+    return [t for t in re.findall(r"[a-z0-9]+", texto_normalizado) if t not in BUSCA_TOKENS_IGNORADOS]
+
+class BuscaBiblioteca:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._carregado = False
+        self._docs = {}            # id -> (caminho, nome, tamanho, mtime, caminho_norm, nome_norm, tokens_nome)
+        self._por_caminho = {}     # caminho -> id
+        self._proximo_id = 0
+        self._postings = {}        # token -> set(ids)
+        self._tokens = []          # ordenada (prefixo por bisect)
+        self._tokens_palavra = set()   # tokens não numéricos (universo do fuzzy)
+        self._texto = ""           # "\n".join dos caminhos normalizados (+ removidos até a limpeza)
+        self._inicios = []         # offset de cada doc dentro de _texto
+        self._ids_texto = []
+        self._texto_sujo = True
+
+    # --- manutenção ---
+    def _adicionar(self, caminho, tamanho, mtime, ordenar=True):
+        self._remover(caminho)
+        nome = caminho.rsplit('/', 1)[-1]
+        caminho_norm, nome_norm = normalizar_busca(caminho), normalizar_busca(nome)
+        doc_id = self._proximo_id
+        self._proximo_id += 1
+        self._docs[doc_id] = (caminho, nome, tamanho, mtime, caminho_norm, nome_norm, set(tokens_busca(nome_norm)))
+        self._por_caminho[caminho] = doc_id
+        for t in set(tokens_busca(caminho_norm)):
+            ids = self._postings.get(t)
+            if ids is None:
+                ids = self._postings[t] = set()
+                if ordenar:
+                    bisect.insort(self._tokens, t)
+                if not t.isdigit():
+                    self._tokens_palavra.add(t)
+            ids.add(doc_id)
+        if self._carregado and not self._texto_sujo:
+            # novo caminho vai para o fim do texto (sem refazer tudo)
+            self._inicios.append(len(self._texto) + 1 if self._texto else 0)
+            self._ids_texto.append(doc_id)
+            self._texto = f"{self._texto}\n{caminho_norm}" if self._texto else caminho_norm
+
+    def _remover(self, caminho):
+        doc_id = self._por_caminho.pop(caminho, None)
+        if doc_id is None:
+            return
+        doc = self._docs.pop(doc_id)
+        for t in set(tokens_busca(doc[4])):
+            ids = self._postings.get(t)
+            if ids is None:
+                continue
+            ids.discard(doc_id)
+            if not ids:
+                del self._postings[t]
+                self._tokens_palavra.discard(t)
+                i = bisect.bisect_left(self._tokens, t)
+                if i < len(self._tokens) and self._tokens[i] == t:
+                    self._tokens.pop(i)
+        # o trecho removido fica no texto (hits de id morto são ignorados) até acumular lixo
+        if len(self._ids_texto) > 2 * len(self._docs) + 1000:
+            self._texto_sujo = True
+
+    def ao_mudar(self, evento, caminho, tamanho, mtime):
+        """Ouvinte do IndiceBiblioteca (roda depois do commit)."""
+        with self._lock:
+            if evento == "varredura_concluida":
+                self._garantir_carregado()  # aquece fora do caminho da 1ª busca
+                return
+            if not self._carregado:
+                return                      # a carga inicial já vai ler do banco
+            if evento == "arquivo":
+                self._adicionar(caminho, tamanho, mtime)
+            elif evento == "removido":
+                self._remover(caminho)
+            elif evento == "arvore_removida":
+                prefixo = caminho + "/"
+                for c in [c for c in self._por_caminho if c == caminho or c.startswith(prefixo)]:
+                    self._remover(c)
+
+    def _garantir_carregado(self):
+        if self._carregado:
+            return
+        with app.app_context():
+            linhas = (db.session.query(ItemBiblioteca.caminho, ItemBiblioteca.tamanho, ItemBiblioteca.mtime)
+                      .filter_by(tipo='arquivo').all())
+        for caminho, tamanho, mtime in linhas:
+            self._adicionar(caminho, tamanho, mtime, ordenar=False)
+        self._tokens = sorted(self._postings)
+        self._reconstruir_texto()
+        self._carregado = True
+        print(f"🔎 Índice de busca carregado: {len(self._docs)} arquivos")
+
+    def _reconstruir_texto(self):
+        partes, inicios, ids, pos = [], [], [], 0
+        for doc_id, doc in self._docs.items():
+            inicios.append(pos)
+            ids.append(doc_id)
+            partes.append(doc[4])
+            pos += len(doc[4]) + 1
+        self._texto = "\n".join(partes)
+        self._inicios, self._ids_texto = inicios, ids
+        self._texto_sujo = False
+
+    # --- consulta ---
+    def _por_prefixo(self, termo, limite=None):
+        ids = set()
+        i = bisect.bisect_left(self._tokens, termo)
+        while (i < len(self._tokens) and self._tokens[i].startswith(termo)
+               and (limite is None or len(ids) < limite)):
+            ids |= self._postings[self._tokens[i]]
+            i += 1
+        return ids
+
+    def _por_substring(self, trecho, limite):
+        if self._texto_sujo:
+            self._reconstruir_texto()
+        ids, pos = set(), self._texto.find(trecho)
+        while pos != -1 and len(ids) < limite:
+            k = bisect.bisect_right(self._inicios, pos) - 1
+            ids.add(self._ids_texto[k])
+            # pula para o próximo caminho (um hit por documento)
+            prox = self._inicios[k + 1] if k + 1 < len(self._inicios) else len(self._texto)
+            pos = self._texto.find(trecho, prox)
+        return ids
+
+    def _parecidos(self, termo):
+        """Tokens a 1-2 letras de distância (só palavras; números não têm 'erro de digitação')."""
+        if len(termo) < 3 or termo.isdigit():
+            return []
+        universo = [t for t in self._tokens_palavra if abs(len(t) - len(termo)) <= 2]
+        return difflib.get_close_matches(termo, universo, n=3, cutoff=0.75)
+
+    def _pontuar(self, doc, q, termos):
+        caminho, nome, tamanho, mtime, caminho_norm, nome_norm, tokens_nome = doc
+        base = nome_norm.rsplit('.', 1)[0]
+        if base == q or nome_norm == q:
+            score = 100
+        elif nome_norm.startswith(q):
+            score = 80
+        elif q in nome_norm:
+            score = 60
+        elif q in caminho_norm:
+            score = 40
+        else:
+            score = 0
+        for t in termos:
+            if t in tokens_nome:
+                score += 10
+            elif any(tn.startswith(t) for tn in tokens_nome):
+                score += 6
+            elif t in nome_norm:
+                score += 3
+        # nome curto e arquivo recente desempatam
+        return score - len(nome_norm) * 0.01 + (mtime or 0) * 1e-12
+
+    def _candidatos(self, q, termos):
+        """
+        Conjuntos em ordem de relevância: token exato > prefixo de token >
+        substring > aproximado. Só o necessário para BUSCA_MAX_CANDIDATOS é
+        pontuado, então termo genérico ('cam') não pontua a biblioteca toda.
+        """
+        escolhidos = {}            # dict preserva a ordem de chegada (= relevância)
+
+        def juntar(ids):
+            for i in ids:
+                if len(escolhidos) >= BUSCA_MAX_CANDIDATOS:
+                    return True
+                if i in self._docs:
+                    escolhidos.setdefault(i, None)
+            return len(escolhidos) >= BUSCA_MAX_CANDIDATOS
+
+        exatos = prefixos = None
+        limite_prefixo = BUSCA_MAX_CANDIDATOS if len(termos) == 1 else None   # com 1 termo não há interseção
+        for t in termos:
+            ex = self._postings.get(t, set())
+            pre = self._por_prefixo(t, limite_prefixo)
+            exatos = ex if exatos is None else exatos & ex
+            prefixos = pre if prefixos is None else prefixos & pre
+        if juntar(exatos or ()) or juntar(prefixos or ()):
+            return list(escolhidos), False
+        if len(q) >= 2 and juntar(self._por_substring(q, BUSCA_MAX_CANDIDATOS - len(escolhidos))):
+            return list(escolhidos), False
+        if escolhidos or not termos:
+            return list(escolhidos), False
+
+        aproximados = None
+        for t in termos:
+            ids = set()
+            for parecido in self._parecidos(t):
+                ids |= self._postings[parecido]
+            aproximados = ids if aproximados is None else aproximados & ids
+            if not aproximados:
+                break
+        juntar(aproximados or ())
+        return list(escolhidos), True
+
+    def buscar(self, consulta, limite=BUSCA_LIMITE_PADRAO):
+        q = normalizar_busca(consulta).strip()
+        termos = tokens_busca(q)
+        if not q:
+            return []
+
+        with self._lock:
+            self._garantir_carregado()
+            ids, fuzzy = self._candidatos(q, termos)
+            docs = [self._docs[i] for i in ids]
+
+        melhores = heapq.nlargest(limite, docs, key=lambda d: self._pontuar(d, q, termos))
+        return [{
+            "caminho": d[0],
+            "nome": d[1],
+            "pasta": d[0].rsplit('/', 1)[0] if '/' in d[0] else '',
+            "tamanho": formatar_tamanho_mb(d[2]),
+            "bytes": d[2],
+            "mtime": d[3],
+            "miniatura": url_miniatura_biblioteca(d[0], d[2], d[3]) if d[1].lower().endswith('.gcode') else None,
+            "aproximado": fuzzy,
+        } for d in melhores]
+
+    def estatisticas(self):
+        with self._lock:
+            return {"carregado": self._carregado, "arquivos": len(self._docs), "tokens": len(self._tokens)}
+
+BUSCA_BIBLIOTECA = BuscaBiblioteca()
+BIBLIOTECA.ouvir(BUSCA_BIBLIOTECA.ao_mudar)
+
+
+@app.route('/api/buscar_gcode')
+def buscar_gcode():
+    """Busca por nome/caminho em toda a PASTA_RAIZ (prefixo, substring e tokens, ranqueada)."""
+    q = (request.args.get('q') or '').strip()
+    # type=int: valor inválido (?limite=x) cai no padrão em vez de estourar 500
+    limite = min(max(request.args.get('limite', BUSCA_LIMITE_PADRAO, type=int), 1), 200)
+    if not q:
+        return jsonify({"q": q, "resultados": [], "ms": 0})
+
+    inicio = time.perf_counter()
+    resultados = BUSCA_BIBLIOTECA.buscar(q, limite)
+    return jsonify({
+        "q": q,
+        "resultados": resultados,
+        "ms": round((time.perf_counter() - inicio) * 1000, 2),
+    })
     
+# ==========================================================================
+# 🖼️ MINIATURAS (thumbnails embutidas pelo slicer)
+# ==========================================================================
+# Prusa/Orca/Cura gravam PNG/JPG em base64 nos comentários do cabeçalho
+# ("; thumbnail begin WxH N" ... "; thumbnail end"). Lemos só o começo do
+# arquivo, em blocos, parando quando o G-code começa; o resultado fica num
+# cache em disco (LRU por acesso, com teto de MB) chaveado por
+# caminho+mtime+tamanho, então cada versão do arquivo é lida uma vez só.
+
+PASTA_MINIATURAS = os.path.join(BASE_DIR, "cache_miniaturas")
+MINIATURAS_MAX_MB = float(os.getenv("MINIATURAS_MAX_MB", "200"))
+MINIATURA_LEITURA_BLOCO = 64 * 1024
+MINIATURA_LEITURA_MAX = 4 * 1024 * 1024     # nunca lê mais que isso do cabeçalho
+MINIATURA_SOBREPOSICAO = 64                 # bytes revarridos do bloco anterior (marcador cortado)
+MINIATURA_CACHE_HTTP = "public, max-age=31536000, immutable"   # a URL leva ?v=mtime-tamanho
+
+RE_MINIATURA = re.compile(
+    rb"; (thumbnail(?:_JPG|_QOI)?) begin (\d+)x(\d+) \d+\r?\n(.*?); \1 end", re.S)
+RE_MARCA_MINIATURA = re.compile(rb"; thumbnail(?:_JPG|_QOI)? (begin|end)")
+RE_INICIO_GCODE = re.compile(rb"\n[GM]\d")
+TIPOS_MINIATURA = {b"thumbnail": "image/png", b"thumbnail_JPG": "image/jpeg"}   # QOI o navegador não abre
+
+def extrair_miniatura_gcode(caminho):
+    """(bytes, mimetype) da maior miniatura PNG/JPG do cabeçalho, ou None."""
+    buf = bytearray()
+    aberto = False      # último marcador visto foi um "begin"
+    ultima_marca = 0    # fim do último marcador visto
+    with open(caminho, "rb") as f:
+        while len(buf) < MINIATURA_LEITURA_MAX:
+            bloco = f.read(MINIATURA_LEITURA_BLOCO)
+            if not bloco:
+                break
+            # só o bloco novo (+ a sobra de um marcador cortado entre blocos) é varrido
+            inicio = max(len(buf) - MINIATURA_SOBREPOSICAO, 0)
+            buf += bloco
+            for m in RE_MARCA_MINIATURA.finditer(buf, inicio):
+                aberto = m.group(1) == b"begin"
+                ultima_marca = m.end()
+            if aberto:
+                continue    # bloco de miniatura ainda aberto → continua lendo
+            if RE_INICIO_GCODE.search(buf, max(ultima_marca, inicio)):
+                break       # G-code já começou e nenhum bloco pendente
+    return escolher_miniatura(bytes(buf))
+
+def escolher_miniatura(cabecalho):
+    melhor = None
+    for m in RE_MINIATURA.finditer(cabecalho):
+        tipo = TIPOS_MINIATURA.get(m.group(1))
+        if not tipo:
+            continue
+        area = int(m.group(2)) * int(m.group(3))
+        if melhor is None or area > melhor[0]:
+            melhor = (area, tipo, m.group(4))
+    if melhor is None:
+        return None
+    linhas = (l.strip().lstrip(b";").strip() for l in melhor[2].splitlines())
+    try:
+        return base64.b64decode(b"".join(linhas)), melhor[1]
+    except Exception:
+        return None
+
+class CacheMiniaturas:
+    """LRU em disco: <chave>.png/.jpg, ou <chave>.sem (arquivo sem miniatura)."""
+    EXTENSOES = {"image/png": ".png", "image/jpeg": ".jpg"}
+
+    def __init__(self, pasta, max_mb):
+        self.pasta = pasta
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._itens = {}       # nome_arquivo -> [tamanho, ultimo_acesso]
+        self._total = 0
+        self._carregado = False
+        self.stats = {"hits": 0, "misses": 0, "extraidas": 0, "despejadas": 0}
+
+    @staticmethod
+    def chave(*partes):
+        return hashlib.sha1("|".join(str(p) for p in partes).encode()).hexdigest()
+
+    def _carregar(self):
+        if self._carregado:
+            return
+        os.makedirs(self.pasta, exist_ok=True)
+        with os.scandir(self.pasta) as it:
+            for e in it:
+                if e.is_file():
+                    st = e.stat()
+                    self._itens[e.name] = [st.st_size, st.st_mtime]
+                    self._total += st.st_size
+        self._carregado = True
+
+    def obter(self, chave):
+        """(bytes, mimetype) | False (sabidamente sem miniatura) | None (não está no cache)"""
+        with self._lock:
+            self._carregar()
+            for ext, tipo in (( ".png", "image/png"), (".jpg", "image/jpeg"), (".sem", None)):
+                nome = chave + ext
+                if nome not in self._itens:
+                    continue
+                self._itens[nome][1] = time.time()
+                self.stats["hits"] += 1
+                if tipo is None:
+                    return False
+                try:
+                    with open(os.path.join(self.pasta, nome), "rb") as f:
+                        dados = f.read()
+                    os.utime(os.path.join(self.pasta, nome))   # LRU sobrevive a reinício
+                    return dados, tipo
+                except OSError:
+                    self._total -= self._itens.pop(nome)[0]
+                    return None
+            self.stats["misses"] += 1
+            return None
+
+    def guardar(self, chave, resultado):
+        nome = chave + (self.EXTENSOES[resultado[1]] if resultado else ".sem")
+        dados = resultado[0] if resultado else b""
+        with self._lock:
+            self._carregar()
+            tmp = os.path.join(self.pasta, nome + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write(dados)
+            os.replace(tmp, os.path.join(self.pasta, nome))
+            antigo = self._itens.get(nome)
+            if antigo:
+                self._total -= antigo[0]
+            self._itens[nome] = [len(dados), time.time()]
+            self._total += len(dados)
+            self.stats["extraidas"] += 1
+            self._despejar()
+
+    def _despejar(self):
+        if self._total <= self.max_bytes:
+            return
+        for nome, (tamanho, _) in sorted(self._itens.items(), key=lambda kv: kv[1][1]):
+            if self._total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.pasta, nome))
+            except OSError:
+                pass
+            del self._itens[nome]
+            self._total -= tamanho
+            self.stats["despejadas"] += 1
+
+    def estatisticas(self):
+        with self._lock:
+            self._carregar()
+            return {**self.stats, "itens": len(self._itens), "mb": round(self._total / 1048576, 2),
+                    "max_mb": round(self.max_bytes / 1048576, 2)}
+
+CACHE_MINIATURAS = CacheMiniaturas(PASTA_MINIATURAS, MINIATURAS_MAX_MB)
+
+def url_miniatura_biblioteca(rel, tamanho, mtime):
+    return (f"/api/miniatura/biblioteca?arquivo={urllib.parse.quote(rel)}"
+            f"&v={int(mtime or 0)}-{tamanho or 0}")
+
+def url_miniatura_impressora(ip, caminho, tamanho, modificado):
+    return (f"/api/miniatura/impressora/{ip}?arquivo={urllib.parse.quote(caminho)}"
+            f"&v={int(modificado or 0)}-{tamanho or 0}")
+
+def responder_miniatura(resultado, chave):
+    if not resultado:
+        resp = Response(status=404)
+        resp.headers["Cache-Control"] = "public, max-age=300"   # pode ganhar miniatura se reenviado
+        return resp
+    dados, tipo = resultado
+    resp = Response(dados, mimetype=tipo)
+    resp.headers["Cache-Control"] = MINIATURA_CACHE_HTTP
+    resp.set_etag(chave)
+    return resp.make_conditional(request)
+
+@app.route('/api/miniatura/biblioteca')
+def miniatura_biblioteca():
+    """Miniatura de um G-code da PASTA_RAIZ (lê só o cabeçalho, uma vez por versão do arquivo)"""
+    arquivo = (request.args.get('arquivo') or '').replace('\\', '/').lstrip('/')
+    caminho = os.path.abspath(os.path.join(PASTA_RAIZ, arquivo))
+    if BIBLIOTECA.relativo(caminho) in (None, ''):
+        return jsonify({"error": "Acesso Negado"}), 403
+    try:
+        st = os.stat(caminho)
+    except OSError:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+
+    chave = CacheMiniaturas.chave("lib", caminho, st.st_mtime_ns, st.st_size)
+    resultado = CACHE_MINIATURAS.obter(chave)
+    if resultado is None:
+        try:
+            resultado = extrair_miniatura_gcode(caminho)
+        except OSError as e:
+            print(f"⚠️ Miniatura: falha lendo {arquivo}: {e}")
+            return jsonify({"error": str(e)}), 500
+        CACHE_MINIATURAS.guardar(chave, resultado)
+    return responder_miniatura(resultado, chave)
+
+@app.route('/api/miniatura/impressora/<ip>')
+def miniatura_impressora(ip):
+    """
+    Miniatura de um arquivo interno da impressora: o Moonraker já extraiu as
+    thumbnails (metadata.thumbnails[].relative_path); baixamos a maior uma vez.
+    """
+    arquivo = (request.args.get('arquivo') or '').lstrip('/')
+    versao = request.args.get('v') or ''
+    if not arquivo:
+        return jsonify({"error": "arquivo obrigatório"}), 400
+
+    meta = None
+    if not versao:
+        meta = metadados_remotos(ip, arquivo)
+        if not meta:
+            return jsonify({"error": "Arquivo não encontrado na impressora"}), 404
+        versao = f"{int(meta.get('modified') or 0)}-{meta.get('size') or 0}"
+
+    chave = CacheMiniaturas.chave("imp", ip, arquivo, versao)
+    resultado = CACHE_MINIATURAS.obter(chave)
+    if resultado is None:
+        meta = meta or metadados_remotos(ip, arquivo)
+        if meta is None:
+            return jsonify({"error": "Impressora não respondeu"}), 502
+
+        thumbs = [t for t in (meta.get("thumbnails") or [])
+                  if isinstance(t, dict) and t.get("relative_path")]
+        if thumbs:
+            maior = max(thumbs, key=lambda t: (t.get("width") or 0) * (t.get("height") or 0))
+            pasta = arquivo.rsplit('/', 1)[0] + '/' if '/' in arquivo else ''
+            url = f"http://{ip}/server/files/gcodes/{urllib.parse.quote(pasta + maior['relative_path'])}"
+            try:
+                r = http_get(url, operacao="arquivos")
+                if r.status_code == 200 and r.content:
+                    tipo = "image/jpeg" if maior["relative_path"].lower().endswith((".jpg", ".jpeg")) else "image/png"
+                    resultado = (r.content, tipo)
+            except Exception as e:
+                log(ip, "MINIATURA_FAIL", str(e))
+                return jsonify({"error": str(e)}), 502
+        CACHE_MINIATURAS.guardar(chave, resultado or None)
+    return responder_miniatura(resultado, chave)
+
+@app.route('/api/miniaturas_stats')
+def miniaturas_stats():
+    """Ocupação e acertos do cache de miniaturas"""
+    return jsonify(CACHE_MINIATURAS.estatisticas())
+
+
+# ==========================================================================
+# 📐 ANÁLISE DE G-CODE (tempo, filamento, camadas, bbox)
+# ==========================================================================
+# Caminho rápido: os slicers gravam tempo/filamento/camadas em comentários
+# no começo ou no fim do arquivo. Sem isso (ou com ?completo=1) o arquivo é
+# lido via mmap em blocos grandes e tudo é feito em NumPy: tokens X/Y/Z/E/F
+# achados por máscara de bytes, números convertidos em lote (sem float() por
+# linha), posições por forward-fill e tempo por trapézio de aceleração com
+# velocidade de junção no modelo do Klipper (square_corner_velocity).
+# O resultado fica no SQLite por versão (tamanho + mtime) do arquivo.
+
+ANALISE_BLOCO = 32 * 1024 * 1024          # bytes por lote vetorizado
+ANALISE_CABECALHO = 64 * 1024             # lido do começo para o caminho rápido
+ANALISE_RODAPE = 512 * 1024               # Prusa/Orca gravam o resumo + config no fim
+ANALISE_ACELERACAO = float(os.getenv("ANALISE_ACELERACAO", "3000"))      # mm/s² sem M204
+ANALISE_VELOCIDADE_MAX = float(os.getenv("ANALISE_VELOCIDADE_MAX", "500"))
+ANALISE_SCV = float(os.getenv("ANALISE_SCV", "5"))                       # square_corner_velocity
+ANALISE_DIAMETRO = float(os.getenv("ANALISE_DIAMETRO", "1.75"))
+ANALISE_DENSIDADE = float(os.getenv("ANALISE_DENSIDADE", "1.24"))        # PLA g/cm³
+ANALISE_NUM_LARGURA = 12                  # caracteres lidos por número ("-1234.56789")
+ANALISE_THREADS = max(1, min(4, (os.cpu_count() or 1)))
+
+ANALISE_ESPERA_S = 2.0                    # a rota espera isso; depois responde 202 e a análise segue
+POOL_ANALISE = ThreadPoolExecutor(max_workers=1)   # uma por vez (cada uma já usa ANALISE_THREADS)
+ANALISES_EM_CURSO = {}                    # (caminho, completo) -> Future; sai quando termina
+ANALISES_GUARDA = threading.Lock()
+
+# --- resumo do slicer (cabeçalho / rodapé) ---
+RE_META_SLICER = {
+    "tempo": [rb"; estimated printing time \(normal mode\) = ([^\n]+)",
+              rb"total estimated time: ([^;\n]+)",
+              rb";TIME:(\d+)"],
+    "filamento_mm": [rb"; filament used \[mm\] = ([\d.]+)"],
+    "filamento_m": [rb";Filament used: ([\d.]+)m"],
+    "filamento_g": [rb"; filament used \[g\] = ([\d.]+)",
+                    rb"; total filament weight \[g\] : ([\d.]+)"],
+    "camadas": [rb"; total layers count = (\d+)",
+                rb"; total layer number: (\d+)",
+                rb";LAYER_COUNT:(\d+)"],
+    "diametro": [rb"; filament_diameter = ([\d.]+)"],
+    "densidade": [rb"; filament_density = ([\d.]+)"],
+}
+RE_CURA_BBOX = re.compile(rb";(MIN|MAX)([XYZ]):(-?[\d.]+)")
+
+def segundos_de_texto(txt):
+    """'1d 2h 3m 4s' / '3600' → segundos"""
+    txt = txt.strip()
+    if txt.isdigit():
+        return int(txt)
+    return sum(int(v) * {"d": 86400, "h": 3600, "m": 60, "s": 1}[u]
+               for v, u in re.findall(r"(\d+)\s*([dhms])", txt))
+
+def texto_de_segundos(seg):
+    seg = int(round(seg or 0))
+    h, resto = divmod(seg, 3600)
+    return f"{h}h {resto // 60:02d}m" if h else f"{resto // 60}m {resto % 60:02d}s"
+
+def resumo_slicer(mm):
+    """O que o slicer já calculou (None nos campos ausentes)."""
+    tamanho = len(mm)
+    trechos = [mm[:min(ANALISE_CABECALHO, tamanho)]]
+    if tamanho > ANALISE_CABECALHO:
+        trechos.append(mm[max(ANALISE_CABECALHO, tamanho - ANALISE_RODAPE):])
+
+    meta = {}
+    for campo, padroes in RE_META_SLICER.items():
+        for trecho in trechos:
+            for padrao in padroes:
+                m = re.search(padrao, trecho)
+                if m and campo not in meta:
+                    meta[campo] = m.group(1).decode(errors="ignore")
+
+    def num(campo, conv=float):
+        try:
+            return conv(meta[campo]) if campo in meta else None
+        except ValueError:
+            return None
+
+    bbox = {(m.group(1) + m.group(2)).decode().lower(): float(m.group(3))
+            for m in RE_CURA_BBOX.finditer(trechos[0])}
+    filamento_mm = num("filamento_mm")
+    if filamento_mm is None and num("filamento_m") is not None:
+        filamento_mm = num("filamento_m") * 1000
+    return {
+        "tempo_s": segundos_de_texto(meta["tempo"]) if "tempo" in meta else None,
+        "filamento_mm": filamento_mm,
+        "filamento_g": num("filamento_g"),
+        "camadas": num("camadas", int),
+        "diametro": num("diametro"),
+        "densidade": num("densidade"),
+        "bbox": bbox if len(bbox) == 6 else None,
+    }
+
+# --- tokenização vetorizada ---
+# Comando de cada linha: pula espaços/tabs e a palavra N (nº de linha), lê a
+# letra e o número (G1 = G01 = g1). Movimento = G0..G3 (arco conta como reta).
+# Parâmetros: qualquer X/Y/Z/E/F seguido de número depois do comando, com ou
+# sem espaço antes ("G1X10Y5E.5").
+CODIGOS_EVENTO_G = np.array([4, 90, 91, 92])
+CODIGOS_EVENTO_M = np.array([82, 83, 204])
+CHAVE_SET = (ord("S") << 16) | (ord("E") << 8) | ord("T")     # SET_VELOCITY_LIMIT
+ESPACO = np.zeros(256, dtype=bool)
+ESPACO[[32, 9]] = True
+DIGITO = np.zeros(256, dtype=bool)
+DIGITO[48:58] = True
+INICIO_NUMERO = DIGITO.copy()
+INICIO_NUMERO[[43, 45, 46]] = True       # '+', '-', '.'
+LETRA_EIXO = np.zeros(256, dtype=bool)
+INDICE_EIXO = np.zeros(256, dtype=np.int64)
+for _i, _c in enumerate(b"XYZEF"):
+    LETRA_EIXO[[_c, _c | 32]] = True
+    INDICE_EIXO[[_c, _c | 32]] = _i
+_POTENCIAS_10 = 10.0 ** np.arange(ANALISE_NUM_LARGURA + 1)
+_FOLGA = b"\0" * (ANALISE_NUM_LARGURA + 4)
+
+def _avancar(a, p, tabela, limite):
+    """Anda cada posição enquanto o byte estiver na tabela (até `limite` passos)."""
+    for _ in range(limite):
+        anda = tabela[a[p]]
+        if not anda.any():
+            break
+        p = p + anda
+    return p
+
+def comandos_das_linhas(a, inicios):
+    """(letra maiúscula, código, posição do comando, fim do código) de cada linha."""
+    p = _avancar(a, inicios, ESPACO, 64)
+    com_n = ((a[p] | 32) == ord("n")) & DIGITO[a[p + 1]]
+    p = _avancar(a, p + com_n, DIGITO, 12)
+    p = np.where(com_n, _avancar(a, p, ESPACO, 64), p)
+
+    letra = a[p] & np.uint8(0xDF)
+    codigo = np.zeros(len(p), np.int64)
+    digitos = np.zeros(len(p), np.int64)
+    vivo = np.ones(len(p), bool)
+    for j in range(4):
+        d = a[p + 1 + j] - np.uint8(48)
+        vivo &= d < 10
+        if not vivo.any():
+            break
+        codigo = np.where(vivo, codigo * 10 + d, codigo)
+        digitos += vivo
+    fim = p + 1 + digitos
+    # G1.1 e afins não são movimento
+    codigo[(digitos == 0) | (a[fim] == 46)] = -1
+    return letra, codigo, p, fim
+
+def numeros_em_lote(a, pos):
+    """
+    Converte de uma vez os números que começam em a[pos] ('-12.5', '.4', '300'):
+    Horner coluna a coluna sobre todos os tokens (sem float() por token).
+    `a` precisa de ANALISE_NUM_LARGURA bytes de folga depois do último número.
+    """
+    neg = a[pos] == 45
+    p = pos + (neg | (a[pos] == 43))
+    mantissa = np.zeros(len(pos), np.int64)
+    casas = np.zeros(len(pos), np.int8)
+    vivo = np.ones(len(pos), bool)
+    ponto = np.zeros(len(pos), bool)
+    for j in range(ANALISE_NUM_LARGURA):
+        ch = a[p + j]
+        d = ch - np.uint8(48)
+        dig = (d < 10) & vivo
+        eh_ponto = (ch == 46) & vivo & ~ponto
+        vivo = dig | eh_ponto
+        if not vivo.any():
+            break
+        mantissa *= np.where(dig, 10, 1)
+        mantissa += d * dig
+        casas += dig & ponto
+        ponto |= eh_ponto
+    valor = mantissa / _POTENCIAS_10[casas]
+    valor[neg] *= -1
+    return valor
+
+def tokenizar_bloco(bloco):
+    """
+    Bloco de linhas inteiras → (linhas_mov, vals[N, 5] X/Y/Z/E/F com NaN, eventos).
+    Eventos são as poucas linhas de modo/estado (G90/G91/G92/M82/M83/M204/...)
+    como (número da linha, texto), para o laço por segmento.
+    """
+    a = np.frombuffer(bloco + _FOLGA, dtype=np.uint8)
+    n = len(bloco)
+    fins = np.flatnonzero(a[:n] == 10)
+    if len(fins) == 0 or fins[-1] != n - 1:
+        fins = np.append(fins, n)
+    inicios = np.concatenate(([0], fins[:-1] + 1))
+
+    letra, codigo, pos_cmd, fim_cmd = comandos_das_linhas(a, inicios)
+    eh_g = letra == ord("G")
+    eh_mov = eh_g & (codigo >= 0) & (codigo <= 3)
+    eh_evento = ((eh_g & np.isin(codigo, CODIGOS_EVENTO_G))
+                 | ((letra == ord("M")) & np.isin(codigo, CODIGOS_EVENTO_M))
+                 | ((((a[pos_cmd].astype(np.int32) << 16) | (a[pos_cmd + 1].astype(np.int32) << 8)
+                      | a[pos_cmd + 2]) & 0xDFDFDF) == CHAVE_SET))
+
+    # comentário: tudo depois do 1º ';' da linha
+    fim_util = fins.copy()
+    semis = np.flatnonzero(a[:n] == 59)
+    if len(semis):
+        linhas, primeiro = np.unique(np.searchsorted(fins, semis), return_index=True)
+        fim_util[linhas] = semis[primeiro]
+
+    # tokens: letra de eixo seguida de número, depois do comando e antes do comentário
+    pos = np.flatnonzero(LETRA_EIXO[a[:n]])
+    pos = pos[INICIO_NUMERO[a[pos + 1]]]
+    linha_tok = np.searchsorted(fins, pos)
+    ok = eh_mov[linha_tok] & (pos >= fim_cmd[linha_tok]) & (pos < fim_util[linha_tok])
+    pos, linha_tok = pos[ok], linha_tok[ok]
+
+    linhas_mov = np.flatnonzero(eh_mov)
+    linha_para_mov = np.cumsum(eh_mov) - 1          # nº da linha → índice em linhas_mov
+    vals = np.full((len(linhas_mov), 5), np.nan)
+    if len(pos):
+        vals[linha_para_mov[linha_tok], INDICE_EIXO[a[pos]]] = numeros_em_lote(a, pos + 1)
+
+    eventos = [(int(i), bloco[pos_cmd[i]:fim_util[i]].decode(errors="ignore").strip())
+               for i in np.flatnonzero(eh_evento)]
+    return linhas_mov, vals, eventos
+
+RE_COMANDO_EVENTO = re.compile(r"([GgMm])0*(\d+)|[A-Za-z_]+")
+
+def _preencher(col, inicial, absoluto):
+    """Posição de cada linha: forward-fill (absoluto) ou soma acumulada (relativo)."""
+    if absoluto:
+        idx = np.where(np.isnan(col), -1, np.arange(len(col)))
+        np.maximum.accumulate(idx, out=idx)
+        return np.where(idx >= 0, col[np.maximum(idx, 0)], inicial)
+    return inicial + np.cumsum(np.nan_to_num(col))
+
+class AnalisadorGcode:
+    """Estado da máquina (modos, posição, aceleração) atravessando os blocos."""
+    def __init__(self):
+        self.pos = np.zeros(4)            # X Y Z E
+        self.f = 3000.0                   # mm/min
+        self.abs_coord = True             # G90/G91
+        self.abs_extrude = True           # M82/M83 (Klipper: E absoluto = os dois)
+        self.acel = ANALISE_ACELERACAO
+        self.vmax = ANALISE_VELOCIDADE_MAX
+        self.scv = ANALISE_SCV
+        self.dir_anterior = None          # vetor unitário do último movimento
+        self.v_anterior = 0.0
+        self.tempo = 0.0
+        self.filamento = 0.0
+        self.movimentos = 0
+        self.bb_min = np.full(3, np.inf)
+        self.bb_max = np.full(3, -np.inf)
+        self.alturas = set()
+
+    # --- linhas de estado ---
+    @staticmethod
+    def _params(texto):
+        return {m.group(1).upper(): float(m.group(2))
+                for m in re.finditer(r"([A-Za-z_]+)=?(-?\d*\.?\d+)", texto)}
+
+    def _evento(self, texto):
+        # G090 / g4P100 → "G90" / "G4P100": o resto do código indexa pelo tamanho do comando
+        m = RE_COMANDO_EVENTO.match(texto)
+        if not m:
+            return
+        cmd = (m.group(1) + m.group(2)).upper() if m.group(1) else m.group(0).upper()
+        texto = cmd + texto[m.end():]
+        if cmd == "G90":
+            self.abs_coord = True
+        elif cmd == "G91":
+            self.abs_coord = False
+        elif cmd == "M82":
+            self.abs_extrude = True
+        elif cmd == "M83":
+            self.abs_extrude = False
+        elif cmd == "G92":
+            p = self._params(texto[3:])
+            for i, eixo in enumerate("XYZE"):
+                if eixo in p:
+                    self.pos[i] = p[eixo]
+        elif cmd == "M204":
+            p = self._params(texto[4:])
+            if "S" in p:
+                self.acel = p["S"]
+            elif "P" in p or "T" in p:
+                self.acel = min(p.get("P", np.inf), p.get("T", np.inf))
+        elif cmd == "SET_VELOCITY_LIMIT":
+            p = self._params(texto[len(cmd):])
+            self.acel = p.get("ACCEL", self.acel)
+            self.vmax = p.get("VELOCITY", self.vmax)
+            self.scv = p.get("SQUARE_CORNER_VELOCITY", self.scv)
+        elif cmd == "G4":
+            p = self._params(texto[2:])
+            self.tempo += p.get("P", 0) / 1000.0 + p.get("S", 0)
+
+    # --- movimentos de um segmento sem troca de modo ---
+    def _segmento(self, vals):
+        if not len(vals):
+            return
+        self.movimentos += len(vals)
+        inicio = self.pos.copy()
+        xyz = np.column_stack([_preencher(vals[:, k], inicio[k], self.abs_coord) for k in range(3)])
+        e = _preencher(vals[:, 3], inicio[3], self.abs_coord and self.abs_extrude)
+        f = _preencher(vals[:, 4], self.f, True)
+        self.pos[:3], self.pos[3], self.f = xyz[-1], e[-1], f[-1]
+
+        delta = np.diff(np.vstack([inicio[:3], xyz]), axis=0)
+        de = np.diff(np.concatenate(([inicio[3]], e)))
+        dist = np.sqrt((delta ** 2).sum(axis=1))
+        v = np.clip(f / 60.0, 1e-3, self.vmax)
+        self.filamento += de.sum()
+
+        # só extrusão/retração (sem XYZ)
+        parado = dist < 1e-9
+        self.tempo += (np.abs(de[parado]) / v[parado]).sum()
+
+        mov = ~parado
+        if mov.any():
+            d, vm = dist[mov], v[mov]
+            u = delta[mov] / d[:, None]
+            a = max(self.acel, 1.0)
+
+            # velocidade de junção (Klipper): desvio derivado do square_corner_velocity
+            u_ant = np.vstack([self.dir_anterior if self.dir_anterior is not None else u[:1], u[:-1]])
+            v_ant = np.concatenate(([self.v_anterior if self.dir_anterior is not None else 0.0], vm[:-1]))
+            cos_j = np.clip(-(u_ant * u).sum(axis=1), -0.999999, 0.999999)
+            sen_meio = np.sqrt(0.5 * (1.0 - cos_j))
+            desvio = self.scv ** 2 * (np.sqrt(2.0) - 1.0) / a
+            vj2 = np.minimum(desvio * sen_meio / (1.0 - sen_meio) * a, np.minimum(v_ant, vm) ** 2)
+            if self.dir_anterior is None:
+                vj2[0] = 0.0
+            entrada2 = vj2
+            saida2 = np.append(vj2[1:], 0.0)
+
+            # trapézio (ou triângulo quando não dá tempo de chegar no cruzeiro)
+            d_acel = (vm ** 2 - entrada2) / (2 * a)
+            d_desacel = (vm ** 2 - saida2) / (2 * a)
+            cruzeiro = d_acel + d_desacel <= d
+            pico = np.sqrt(np.maximum((2 * a * d + entrada2 + saida2) / 2, np.maximum(entrada2, saida2)))
+            vp = np.where(cruzeiro, vm, pico)
+            t = (vp - np.sqrt(entrada2)) / a + (vp - np.sqrt(saida2)) / a
+            t += np.where(cruzeiro, (d - d_acel - d_desacel) / vm, 0.0)
+            self.tempo += np.maximum(t, d / vm).sum()
+
+            self.dir_anterior, self.v_anterior = u[-1], vm[-1]
+
+        # bbox e camadas: só onde extrudou andando
+        imprimindo = mov & (de > 0)
+        if imprimindo.any():
+            pontos = xyz[imprimindo]
+            self.bb_min = np.minimum(self.bb_min, pontos.min(axis=0))
+            self.bb_max = np.maximum(self.bb_max, pontos.max(axis=0))
+            z = np.round(pontos[:, 2], 3)
+            self.alturas.update(z[np.concatenate(([True], z[1:] != z[:-1]))].tolist())  # Z muda pouco
+
+    def aplicar(self, linhas_mov, vals, eventos):
+        """Resultado de tokenizar_bloco → segmentos entre as linhas de estado."""
+        inicio = 0
+        for linha, texto in eventos:
+            corte = np.searchsorted(linhas_mov, linha)
+            self._segmento(vals[inicio:corte])
+            self._evento(texto)
+            inicio = corte
+        self._segmento(vals[inicio:])
+
+    def resultado(self, diametro, densidade):
+        area = np.pi * (diametro / 2) ** 2
+        tem_bbox = np.isfinite(self.bb_min).all()
+        return {
+            "tempo_s": int(round(self.tempo)),
+            "filamento_mm": round(float(self.filamento), 1),
+            "filamento_g": round(float(self.filamento) * area * densidade / 1000.0, 2),
+            "camadas": len(self.alturas),
+            "bbox": {f"{lado}{eixo}": round(float(v[i]), 2)
+                     for lado, v in (("min", self.bb_min), ("max", self.bb_max))
+                     for i, eixo in enumerate("xyz")} if tem_bbox else None,
+            "movimentos": self.movimentos,
+        }
+
+def blocos_de_linhas(mm, tamanho):
+    """(início, fim) de ~ANALISE_BLOCO bytes, sempre cortando em fim de linha."""
+    pos = 0
+    while pos < tamanho:
+        fim = min(pos + ANALISE_BLOCO, tamanho)
+        if fim < tamanho:
+            quebra = mm.find(b"\n", fim)
+            fim = tamanho if quebra == -1 else quebra + 1
+        yield pos, fim
+        pos = fim
+
+def analisar_gcode(caminho, completo=False):
+    """Resumo do slicer (rápido) e, se faltar ou se pedido, a análise completa."""
+    inicio = time.perf_counter()
+    with open(caminho, "rb") as f:
+        tamanho = os.fstat(f.fileno()).st_size
+        if tamanho == 0:
+            return {"slicer": None, "calculado": None, "nao_analisado": True, "analise_s": 0}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            slicer = resumo_slicer(mm)
+            tem_resumo = slicer["tempo_s"] is not None and slicer["filamento_mm"] is not None
+
+            calculado = None
+            nao_analisado = False
+            if completo or not tem_resumo:
+                # tokenização (NumPy solta o GIL) em paralelo; estado aplicado em ordem
+                an = AnalisadorGcode()
+                with ThreadPoolExecutor(max_workers=ANALISE_THREADS) as pool:
+                    pendentes = deque()
+                    for ini, fim in blocos_de_linhas(mm, tamanho):
+                        pendentes.append(pool.submit(tokenizar_bloco, mm[ini:fim]))
+                        if len(pendentes) > ANALISE_THREADS:
+                            an.aplicar(*pendentes.popleft().result())
+                    while pendentes:
+                        an.aplicar(*pendentes.popleft().result())
+                if an.movimentos:
+                    calculado = an.resultado(slicer["diametro"] or ANALISE_DIAMETRO,
+                                             slicer["densidade"] or ANALISE_DENSIDADE)
+                else:
+                    # nada reconhecido: melhor "não analisado" que 0 s / 0 mm
+                    nao_analisado = True
+
+    return {
+        "slicer": slicer if any(v is not None for v in slicer.values()) else None,
+        "calculado": calculado,
+        "nao_analisado": nao_analisado,
+        "analise_s": round(time.perf_counter() - inicio, 3),
+    }
+
+def executar_analise(caminho, rel, st, completo):
+    """Roda no POOL_ANALISE: analisa e grava o resultado por versão do arquivo."""
+    with app.app_context():
+        dados = analise_em_cache(rel, st, completo)
+        if dados is not None:
+            return dados
+        dados = analisar_gcode(caminho, completo=completo)
+        print(f"📐 Análise de {rel}: {dados['analise_s']}s "
+              f"({'completa' if dados['calculado'] else 'não analisado' if dados['nao_analisado'] else 'resumo do slicer'})")
+        try:
+            item = AnaliseGcode.query.filter_by(caminho=rel).first() or AnaliseGcode(caminho=rel)
+            item.tamanho, item.mtime = st.st_size, st.st_mtime
+            item.completo = dados["calculado"] is not None or dados["nao_analisado"]
+            item.dados = json.dumps(dados)
+            item.calculado_em = datetime.utcnow()
+            db.session.add(item)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ Análise: não gravou cache de {rel}: {e}")
+        return dados
+
+def iniciar_analise(caminho, rel, st, completo):
+    """Future da análise; pedidos simultâneos do mesmo arquivo recebem o mesmo."""
+    chave = (caminho, completo)
+    with ANALISES_GUARDA:
+        futuro = ANALISES_EM_CURSO.get(chave)
+        if futuro is not None:
+            return futuro
+        futuro = ANALISES_EM_CURSO[chave] = POOL_ANALISE.submit(executar_analise, caminho, rel, st, completo)
+
+    def _terminou(f):
+        with ANALISES_GUARDA:
+            if ANALISES_EM_CURSO.get(chave) is f:
+                del ANALISES_EM_CURSO[chave]
+    futuro.add_done_callback(_terminou)
+    return futuro
+
+def analise_em_cache(rel, st, completo):
+    item = AnaliseGcode.query.filter_by(caminho=rel).first()
+    if item and item.tamanho == st.st_size and item.mtime == st.st_mtime and (item.completo or not completo):
+        return json.loads(item.dados)
+    return None
+
+def montar_resposta_analise(rel, dados):
+    """Campos do topo: calculado quando existe, senão o que o slicer declarou."""
+    slicer, calculado = dados.get("slicer") or {}, dados.get("calculado") or {}
+    fonte = "calculado" if calculado else ("slicer" if slicer else None)
+    base = calculado or slicer
+    tempo = base.get("tempo_s")
+    return {
+        "arquivo": rel,
+        "fonte": fonte,
+        "tempo_s": tempo,
+        "tempo_txt": texto_de_segundos(tempo) if tempo is not None else None,
+        "filamento_mm": base.get("filamento_mm"),
+        "filamento_g": base.get("filamento_g"),
+        "camadas": base.get("camadas"),
+        "bbox": base.get("bbox"),
+        "nao_analisado": bool(dados.get("nao_analisado")),
+        "slicer": dados.get("slicer"),
+        "calculado": dados.get("calculado"),
+        "analise_s": dados.get("analise_s"),
+    }
+
+@app.route('/api/analise_gcode')
+def analise_gcode():
+    """
+    Estimativa de tempo, filamento, camadas e bbox de um G-code da biblioteca.
+    ?completo=1 força a simulação completa mesmo com resumo do slicer.
+    Análise demorada responde 202 {"status": "analisando"}: repetir o pedido.
+    """
+    arquivo = (request.args.get('arquivo') or '').replace('\\', '/').lstrip('/')
+    completo = request.args.get('completo') in ('1', 'true', 'sim')
+    caminho = os.path.abspath(os.path.join(PASTA_RAIZ, arquivo))
+    rel = BIBLIOTECA.relativo(caminho)
+    if rel in (None, ''):
+        return jsonify({"error": "Acesso Negado"}), 403
+    if not rel.lower().endswith('.gcode'):
+        return jsonify({"error": "Somente arquivos .gcode"}), 400
+    try:
+        st = os.stat(caminho)
+    except OSError:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+
+    dados = analise_em_cache(rel, st, completo)
+    if dados is None:
+        # arquivo grande não prende a requisição: 202 e o cliente pergunta de novo
+        try:
+            dados = iniciar_analise(caminho, rel, st, completo).result(timeout=ANALISE_ESPERA_S)
+        except FuturoAtrasado:
+            return jsonify({"arquivo": rel, "status": "analisando"}), 202
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Análise: falha em {rel}: {e}")
+            return jsonify({"error": str(e)}), 500
+    return jsonify(montar_resposta_analise(rel, dados))
+
+
 @app.route('/api/arquivos_internos/<ip>')
 def arquivos_internos(ip):
     """Busca a lista de arquivos gcodes salvos dentro da impressora"""
     try:
-        url = f"http://{ip}/server/files/list?root=gcodes"
-        resp = http_get(url, timeout=3.0)
-
-        if resp.status_code != 200:
-            log(ip, "ARQ_INT_HTTP", f"HTTP {resp.status_code}")
-            return jsonify({"error": f"Erro {resp.status_code} na impressora"}), resp.status_code
+        arquivos_ordenados, status = ARQUIVOS_IMPRESSORAS.listar(ip)
+        if arquivos_ordenados is None:
+            log(ip, "ARQ_INT_HTTP", f"HTTP {status}")
+            return jsonify({"error": f"Erro {status} na impressora"}), status
 
-        dados = resp.json()
-        lista_arquivos = extrair_lista_arquivos_moonraker(dados)
-
-        arquivos_ordenados = sorted(
-            [a for a in lista_arquivos if isinstance(a, dict)],
-            key=lambda x: x.get('modified', 0) or 0,
-            reverse=True
-        )
-        return jsonify(arquivos_ordenados)
+        return jsonify([
+            dict(a, miniatura=url_miniatura_impressora(ip, a['path'], a.get('size'), a.get('modified')))
+            for a in arquivos_ordenados
+        ])
 
     except Exception as e:
         log(ip, "ARQ_INT_FAIL", str(e))
@@ -1327,9 +5519,14 @@ def remover_impressora():
         if maquina:
             db.session.delete(maquina)
             db.session.commit()
+            REGISTRO_MAQUINAS.invalidar()
             # Limpa da memória de monitoramento em tempo real
-            if ip in IMPRESSORAS_ENCONTRADAS:
-                del IMPRESSORAS_ENCONTRADAS[ip]
+            parar_assinatura(ip)
+            remover_status(ip)
+            CLIENTES.descartar(ip)
+            esquecer_arquivo_remoto(ip)
+            ARQUIVOS_IMPRESSORAS.descartar(ip)
+            TELEMETRIA.esquecer(ip)
             return jsonify({"success": True})
         return jsonify({"success": False, "message": "Impressora não encontrada"})
     except Exception as e:
@@ -1350,6 +5547,8 @@ def carregar_producao_24h():
         
         # Reconstrói o dicionário de itens para manter a compatibilidade com o seu JavaScript
         itens = {r.nome_peca: r.quantidade for r in registros}
+        for nome, n in PRODUCAO.pendentes_do_dia(hoje).items():
+            itens[nome] = itens.get(nome, 0) + n
         
         return {
             "data": hoje.strftime("%Y-%m-%d"),
@@ -1366,6 +5565,450 @@ def dados_producao_diaria():
     """Envia os dados de contagem para o widget 'Concluídos (24h)'"""
     return jsonify(carregar_producao_24h())
 
+# ==========================================================================
+# 📊 RELATÓRIOS DE PRODUÇÃO (lidos do ResumoProducao)
+# ==========================================================================
+PERIODOS_RESUMO = ("dia", "semana", "mes")
+AGRUPAMENTOS_RESUMO = {
+    "peca": ResumoProducao.nome_peca,
+    "maquina": ResumoProducao.ip,
+}
+
+def filtros_relatorio_producao(args):
+    """Valida ?de=&ate=&agrupar=&por=&peca=&ip= (padrão: últimos 30 dias, por dia)."""
+    hoje = datetime.now(timezone.utc).date()
+    try:
+        ate = datetime.strptime(args['ate'], "%Y-%m-%d").date() if args.get('ate') else hoje
+        de = datetime.strptime(args['de'], "%Y-%m-%d").date() if args.get('de') else ate - timedelta(days=29)
+    except ValueError:
+        raise ValueError("datas no formato AAAA-MM-DD")
+    if de > ate:
+        raise ValueError("'de' depois de 'ate'")
+    agrupar = args.get('agrupar') or 'dia'
+    if agrupar not in PERIODOS_RESUMO:
+        raise ValueError(f"agrupar deve ser {', '.join(PERIODOS_RESUMO)}")
+    por = args.get('por') or 'total'
+    if por not in ('total', *AGRUPAMENTOS_RESUMO):
+        raise ValueError("por deve ser total, peca ou maquina")
+    return {"de": de, "ate": ate, "agrupar": agrupar, "por": por,
+            "peca": args.get('peca') or None, "ip": args.get('ip') or None}
+
+def consulta_resumo_producao(f, colunas):
+    # períodos inteiros: a semana/mês que contém 'de' entra completa
+    q = (db.session.query(*colunas)
+         .filter(ResumoProducao.periodo == f["agrupar"],
+                 ResumoProducao.inicio >= inicio_do_periodo(f["de"], f["agrupar"]),
+                 ResumoProducao.inicio <= f["ate"]))
+    if f["peca"]:
+        q = q.filter(ResumoProducao.nome_peca == f["peca"])
+    if f["ip"]:
+        q = q.filter(ResumoProducao.ip == f["ip"])
+    return q
+
+@app.route('/api/relatorio_producao')
+def relatorio_producao():
+    """Produção por dia/semana/mês, total ou por peça/máquina, num intervalo qualquer"""
+    inicio = time.perf_counter()
+    try:
+        f = filtros_relatorio_producao(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    chave = AGRUPAMENTOS_RESUMO.get(f["por"])
+    colunas = [ResumoProducao.inicio, db.func.sum(ResumoProducao.quantidade), db.func.sum(ResumoProducao.segundos)]
+    if chave is not None:
+        colunas.insert(1, chave)
+    q = consulta_resumo_producao(f, colunas)
+    q = q.group_by(*colunas[:len(colunas) - 2]).order_by(ResumoProducao.inicio)
+
+    nomes = {m['ip']: m['nome'] for m in carregar_maquinas()}
+    serie, totais = [], {}
+    for linha in q:
+        periodo, *grupo, quantidade, segundos = linha
+        item = {"periodo": periodo.isoformat(), "quantidade": int(quantidade or 0),
+                "horas": round((segundos or 0) / 3600, 2)}
+        if grupo:
+            item[f["por"]] = grupo[0]
+            if f["por"] == "maquina":
+                item["nome"] = nomes.get(grupo[0], grupo[0] or "sem impressora")
+        serie.append(item)
+        k = grupo[0] if grupo else "total"
+        totais[k] = totais.get(k, 0) + item["quantidade"]
+
+    return jsonify({
+        "de": f["de"].isoformat(), "ate": f["ate"].isoformat(),
+        "agrupar": f["agrupar"], "por": f["por"],
+        "serie": serie,
+        "totais": totais,
+        "ms": round((time.perf_counter() - inicio) * 1000, 1),
+    })
+
+@app.route('/api/relatorio_producao.csv')
+def relatorio_producao_csv():
+    """CSV do intervalo inteiro (período × máquina × peça), gerado em streaming"""
+    try:
+        f = filtros_relatorio_producao(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    nomes = {m['ip']: m['nome'] for m in carregar_maquinas()}
+    q = (consulta_resumo_producao(f, [ResumoProducao.inicio, ResumoProducao.ip, ResumoProducao.nome_peca,
+                                      ResumoProducao.quantidade, ResumoProducao.segundos])
+         .order_by(ResumoProducao.inicio, ResumoProducao.ip, ResumoProducao.nome_peca)
+         .execution_options(yield_per=2000))
+
+    def gerar():
+        buf = io.StringIO()
+        w = csv.writer(buf, delimiter=';')
+        w.writerow([f["agrupar"], "ip", "impressora", "peca", "quantidade", "horas"])
+        for n, (inicio, ip, peca, quantidade, segundos) in enumerate(q, 1):
+            w.writerow([inicio.isoformat(), ip, nomes.get(ip, ""), peca, quantidade,
+                        f"{(segundos or 0) / 3600:.2f}".replace('.', ',')])
+            if n % 1000 == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    nome = f"producao_{f['agrupar']}_{f['de']}_{f['ate']}.csv"
+    return Response(stream_with_context(gerar()), mimetype='text/csv',
+                    headers={"Content-Disposition": f'attachment; filename="{nome}"'})
+
+@app.route('/api/producao_stats')
+def producao_stats():
+    """Eventos de conclusão aguardando gravação e lotes gravados/falhos"""
+    return jsonify(PRODUCAO.estatisticas())
+
+# ==========================================================================
+# 🌡️ TELEMETRIA (temperaturas e progresso em anéis de float32)
+# ==========================================================================
+# Cada consulta/delta trazia temperatura e progresso e jogava fora. Agora
+# cada impressora tem 3 anéis de tamanho fixo (array('f'), sem dict por
+# amostra): 1 s por 1 hora, 1 min por 2 dias e 15 min por 6 semanas. Os
+# níveis maiores são médias das amostras do bucket. O slot de cada bucket
+# é bucket % capacidade e o nº do bucket fica em array('I') ao lado, então
+# slot velho ou vazio é reconhecido sem timestamp por amostra.
+# ~250 KB por impressora (25 MB para 100), salvo em telemetria/<ip>.tlm.
+TELEMETRIA_CANAIS = ("extrusora", "extrusora_alvo", "mesa", "mesa_alvo", "progresso")
+TELEMETRIA_NIVEIS = (("1s", 1, 3600), ("1min", 60, 2880), ("15min", 900, 4032))  # nome, passo (s), slots
+TELEMETRIA_SALVAR_S = 300
+TELEMETRIA_MAX_VALORES = 500_000     # teto de valores por resposta (pontos × canais × impressoras)
+PASTA_TELEMETRIA = os.path.join(BASE_DIR, "telemetria")
+TELEMETRIA_MAGICO = b"TLM1"
+
+class AnelTelemetria:
+    __slots__ = ("passo", "capacidade", "buckets", "valores")
+
+    def __init__(self, passo, capacidade):
+        self.passo = passo
+        self.capacidade = capacidade
+        self.buckets = array('I', [0]) * capacidade                      # 0 = slot vazio
+        self.valores = array('f', [math.nan]) * (capacidade * len(TELEMETRIA_CANAIS))
+
+    def gravar(self, bucket, vals):
+        n = len(TELEMETRIA_CANAIS)
+        i = bucket % self.capacidade
+        self.buckets[i] = bucket
+        self.valores[i * n:(i + 1) * n] = array('f', vals)
+
+    def ler(self, b_ini, b_fim):
+        """[(bucket, valores)] em ordem; buckets fora da janela do anel não existem mais."""
+        n = len(TELEMETRIA_CANAIS)
+        for b in range(max(b_ini, b_fim - self.capacidade + 1, 1), b_fim + 1):
+            i = b % self.capacidade
+            if self.buckets[i] == b:
+                yield b, self.valores[i * n:(i + 1) * n]
+
+    def nbytes(self):
+        return (self.buckets.itemsize * len(self.buckets) + self.valores.itemsize * len(self.valores))
+
+
+class SerieImpressora:
+    """Os 3 níveis de uma impressora + o acumulador do bucket aberto de cada nível agregado."""
+    def __init__(self):
+        self.aneis = [AnelTelemetria(passo, cap) for _, passo, cap in TELEMETRIA_NIVEIS]
+        n = len(TELEMETRIA_CANAIS)
+        self._abertos = [[None, [0.0] * n, [0] * n] for _ in self.aneis[1:]]   # bucket, somas, contagens
+
+    def registrar(self, t, vals):
+        self.aneis[0].gravar(int(t) // self.aneis[0].passo, vals)
+        for anel, acc in zip(self.aneis[1:], self._abertos):
+            bucket = int(t) // anel.passo
+            if acc[0] is not None and bucket != acc[0]:
+                self._fechar(anel, acc)
+            acc[0] = bucket
+            for k, v in enumerate(vals):
+                if not math.isnan(v):
+                    acc[1][k] += v
+                    acc[2][k] += 1
+
+    @staticmethod
+    def _fechar(anel, acc):
+        anel.gravar(acc[0], [s / c if c else math.nan for s, c in zip(acc[1], acc[2])])
+        acc[1] = [0.0] * len(acc[1])
+        acc[2] = [0] * len(acc[2])
+        acc[0] = None
+
+    def ler(self, nivel, b_ini, b_fim):
+        anel = self.aneis[nivel]
+        dados = dict(anel.ler(b_ini, b_fim))
+        if nivel:
+            acc = self._abertos[nivel - 1]    # bucket ainda aberto entra como média parcial
+            if acc[0] is not None and b_ini <= acc[0] <= b_fim:
+                dados[acc[0]] = [s / c if c else math.nan for s, c in zip(acc[1], acc[2])]
+        return dados
+
+    # ---------- disco ----------
+    def instantaneo(self):
+        """
+        Cabeçalho + arrays crus em bytes (chamado com o lock; a escrita em disco
+        fica para depois, sem ele). O bucket aberto de cada nível agregado vai
+        como média parcial só na cópia: o anel em memória não é tocado, e o
+        _fechar desse bucket grava a média completa normalmente.
+        Se o processo reiniciar dentro do mesmo bucket, o acumulador recomeça
+        vazio e o _fechar sobrescreve a média parcial salva com a das amostras
+        novas: de propósito, o slot nunca mistura duas médias.
+        """
+        n = len(TELEMETRIA_CANAIS)
+        partes = [struct.pack("<4sHH", TELEMETRIA_MAGICO, len(self.aneis), n)]
+        for nivel, anel in enumerate(self.aneis):
+            buckets, valores = anel.buckets.tobytes(), anel.valores.tobytes()
+            acc = self._abertos[nivel - 1] if nivel else None
+            if acc and acc[0] is not None:
+                i = acc[0] % anel.capacidade
+                tam_b, tam_v = anel.buckets.itemsize, anel.valores.itemsize * n
+                buckets = bytearray(buckets)
+                buckets[i * tam_b:(i + 1) * tam_b] = array('I', [acc[0]]).tobytes()
+                valores = bytearray(valores)
+                valores[i * tam_v:(i + 1) * tam_v] = array(
+                    'f', [s / c if c else math.nan for s, c in zip(acc[1], acc[2])]).tobytes()
+            partes += [struct.pack("<II", anel.passo, anel.capacidade), buckets, valores]
+        return partes
+
+    @staticmethod
+    def salvar(caminho, partes):
+        """Grava um instantaneo() em .tmp e troca (arquivo nunca fica pela metade)."""
+        tmp = caminho + ".tmp"
+        with open(tmp, "wb") as f:
+            for parte in partes:
+                f.write(parte)
+        os.replace(tmp, caminho)
+
+    @classmethod
+    def carregar(cls, caminho):
+        serie = cls()
+        with open(caminho, "rb") as f:
+            magico, niveis, canais = struct.unpack("<4sHH", f.read(8))
+            if magico != TELEMETRIA_MAGICO or canais != len(TELEMETRIA_CANAIS):
+                raise ValueError("formato de telemetria desconhecido")
+            for anel in serie.aneis[:niveis]:
+                passo, cap = struct.unpack("<II", f.read(8))
+                if (passo, cap) != (anel.passo, anel.capacidade):
+                    raise ValueError(f"nível {passo}s/{cap} não bate com a configuração atual")
+                anel.buckets = array('I')
+                anel.buckets.fromfile(f, cap)
+                anel.valores = array('f')
+                anel.valores.fromfile(f, cap * canais)
+        return serie
+
+
+class Telemetria:
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self._series = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.amostras = 0
+
+    def iniciar(self):
+        os.makedirs(self.pasta, exist_ok=True)
+        carregadas = 0
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith(".tlm"):
+                continue
+            try:
+                serie = SerieImpressora.carregar(os.path.join(self.pasta, nome))
+            except (OSError, ValueError, struct.error, EOFError) as e:
+                print(f"⚠️ Telemetria: ignorando {nome}: {e}")
+                continue
+            with self._lock:
+                self._series.setdefault(urllib.parse.unquote(nome[:-4]), serie)
+            carregadas += 1
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.salvar)
+        print(f"🌡️ Telemetria: histórico de {carregadas} impressora(s) carregado")
+
+    def _loop(self):
+        while True:
+            time.sleep(TELEMETRIA_SALVAR_S)
+            self.salvar()
+
+    def salvar(self):
+        os.makedirs(self.pasta, exist_ok=True)
+        with self._lock:
+            series = list(self._series.items())
+        for ip, serie in series:
+            # só a cópia é feita com o lock: registrar() roda nos websockets e no
+            # poller e não pode esperar o disco
+            with self._lock:
+                partes = serie.instantaneo()
+            try:
+                SerieImpressora.salvar(os.path.join(self.pasta, urllib.parse.quote(ip, safe='') + ".tlm"), partes)
+            except OSError as e:
+                print(f"⚠️ Telemetria: falha salvando {ip}: {e}")
+
+    def registrar(self, ip, dados, t=None):
+        """dados = status do Klipper (mesmo dict do aplicar_status_klipper)."""
+        extrusora = dados.get('extruder') or {}
+        mesa = dados.get('heater_bed') or {}
+        progresso = (dados.get('display_status') or {}).get('progress')
+
+        def num(v):
+            return float(v) if isinstance(v, (int, float)) else math.nan
+
+        vals = (num(extrusora.get('temperature')), num(extrusora.get('target')),
+                num(mesa.get('temperature')), num(mesa.get('target')),
+                num(progresso) * 100 if progresso is not None else math.nan)
+        if all(math.isnan(v) for v in vals):
+            return
+        with self._lock:
+            serie = self._series.get(ip)
+            if serie is None:
+                serie = self._series[ip] = SerieImpressora()
+            serie.registrar(t or time.time(), vals)
+            self.amostras += 1
+
+    def esquecer(self, ip):
+        with self._lock:
+            self._series.pop(ip, None)
+        try:
+            os.remove(os.path.join(self.pasta, urllib.parse.quote(ip, safe='') + ".tlm"))
+        except OSError:
+            pass
+
+    @staticmethod
+    def nivel_para(janela_s, resolucao=None):
+        nomes = [n for n, _, _ in TELEMETRIA_NIVEIS]
+        if resolucao in nomes:
+            return nomes.index(resolucao)
+        # o nível mais fino que cobre a janela inteira
+        for i, (_, passo, cap) in enumerate(TELEMETRIA_NIVEIS):
+            if janela_s <= passo * cap:
+                return i
+        return len(TELEMETRIA_NIVEIS) - 1
+
+    def consultar(self, ips, desde, ate, nivel, canais=TELEMETRIA_CANAIS):
+        """{ip: {bucket: valores}} já recortado na janela."""
+        passo = TELEMETRIA_NIVEIS[nivel][1]
+        b_ini, b_fim = int(desde) // passo, int(ate) // passo
+        with self._lock:
+            alvos = [(ip, self._series[ip]) for ip in ips if ip in self._series] if ips is not None \
+                else list(self._series.items())
+            return {ip: serie.ler(nivel, b_ini, b_fim) for ip, serie in alvos}, b_ini, b_fim, passo
+
+    def estatisticas(self):
+        with self._lock:
+            n = len(self._series)
+            nbytes = sum(a.nbytes() for s in self._series.values() for a in s.aneis)
+        return {"impressoras": n, "amostras": self.amostras, "memoria_mb": round(nbytes / 1024 / 1024, 1),
+                "niveis": [{"nome": nome, "passo_s": p, "retencao_h": round(p * c / 3600, 1)}
+                           for nome, p, c in TELEMETRIA_NIVEIS]}
+
+TELEMETRIA = Telemetria(PASTA_TELEMETRIA)
+
+
+def janela_telemetria(args, series=1):
+    """
+    ?janela=<s> (padrão 1 h) ou ?desde=&ate= em epoch; ?resolucao=1s|1min|15min; ?canais=a,b.
+    A janela é recortada na retenção do nível (passo × slots): antes disso o
+    anel não tem nada, e uma janela enorme viraria uma lista enorme de null.
+    `series` = quantas séries vão na resposta, para o teto de valores.
+    """
+    agora = time.time()
+    ate = min(float(args.get('ate') or agora), agora)
+    desde = float(args.get('desde') or (ate - float(args.get('janela') or 3600)))
+    if not (math.isfinite(desde) and math.isfinite(ate)) or desde >= ate:
+        raise ValueError("'desde' precisa ser antes de 'ate'")
+    canais = [c for c in (args.get('canais') or '').split(',') if c] or list(TELEMETRIA_CANAIS)
+    if any(c not in TELEMETRIA_CANAIS for c in canais):
+        raise ValueError(f"canais válidos: {', '.join(TELEMETRIA_CANAIS)}")
+
+    nivel = Telemetria.nivel_para(ate - desde, args.get('resolucao'))
+    nome, passo, cap = TELEMETRIA_NIVEIS[nivel]
+    desde = max(desde, agora - passo * cap)
+    if desde >= ate:
+        raise ValueError(f"janela fora da retenção de {nome} ({round(passo * cap / 3600, 1)} h)")
+    pontos = int(ate) // passo - int(desde) // passo + 1
+    if pontos * len(canais) * max(series, 1) > TELEMETRIA_MAX_VALORES:
+        raise ValueError("resposta grande demais: use janela menor, resolução maior ou menos canais")
+    return desde, ate, nivel, canais
+
+def valor_json(v):
+    return None if v is None or math.isnan(v) else round(v, 1)
+
+@app.route('/api/telemetria/<ip>')
+def telemetria_impressora(ip):
+    """Série pronta para gráfico: {"t": [epoch...], "<canal>": [valor|null...]} de uma impressora"""
+    try:
+        desde, ate, nivel, canais = janela_telemetria(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    dados, b_ini, b_fim, passo = TELEMETRIA.consultar([ip], desde, ate, nivel)
+    serie = dados.get(ip, {})
+    indices = [TELEMETRIA_CANAIS.index(c) for c in canais]
+    buckets = range(b_ini, b_fim + 1)
+    resposta = {"ip": ip, "resolucao": TELEMETRIA_NIVEIS[nivel][0], "passo_s": passo,
+                "t": [b * passo for b in buckets]}
+    for c, k in zip(canais, indices):
+        resposta[c] = [valor_json(serie[b][k]) if b in serie else None for b in buckets]
+    return jsonify(resposta)
+
+@app.route('/api/telemetria')
+def telemetria_farm():
+    """
+    Farm inteira: média de cada canal por instante + quantas impressoras
+    reportaram. ?por_impressora=1 devolve também a série de cada uma.
+    """
+    por_impressora = request.args.get('por_impressora') in ('1', 'true', 'sim')
+    try:
+        series = 1 + (TELEMETRIA.estatisticas()["impressoras"] if por_impressora else 0)
+        desde, ate, nivel, canais = janela_telemetria(request.args, series)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    dados, b_ini, b_fim, passo = TELEMETRIA.consultar(None, desde, ate, nivel)
+    indices = [TELEMETRIA_CANAIS.index(c) for c in canais]
+    n = b_fim - b_ini + 1
+    somas = {c: [0.0] * n for c in canais}
+    contagens = {c: [0] * n for c in canais}
+    reportando = [0] * n
+    for serie in dados.values():
+        for b, vals in serie.items():
+            j = b - b_ini
+            reportando[j] += 1
+            for c, k in zip(canais, indices):
+                v = vals[k]
+                if not math.isnan(v):
+                    somas[c][j] += v
+                    contagens[c][j] += 1
+
+    resposta = {"resolucao": TELEMETRIA_NIVEIS[nivel][0], "passo_s": passo,
+                "t": [(b_ini + j) * passo for j in range(n)], "impressoras": reportando}
+    for c in canais:
+        resposta[c] = [round(s / q, 1) if q else None for s, q in zip(somas[c], contagens[c])]
+    if por_impressora:
+        resposta["por_impressora"] = {
+            ip: {c: [valor_json(serie[b][k]) if b in serie else None for b in range(b_ini, b_fim + 1)]
+                 for c, k in zip(canais, indices)}
+            for ip, serie in dados.items()
+        }
+    return jsonify(resposta)
+
+@app.route('/api/telemetria_stats')
+def telemetria_stats():
+    """Impressoras com série, amostras recebidas e memória ocupada pelos anéis"""
+    return jsonify(TELEMETRIA.estatisticas())
+
 """Ações em massa"""
 @app.route('/api/comando_gcode_em_massa', methods=['POST'])
 def comando_gcode_em_massa():
@@ -1382,7 +6025,7 @@ def comando_gcode_em_massa():
             elif comando == "RESUME": url = f"http://{ip}/printer/print/resume"
             elif comando == "CANCEL": url = f"http://{ip}/printer/print/cancel"
             else: url = f"http://{ip}/printer/gcode/script?script={urllib.parse.quote(comando)}"
-            requests.post(url, timeout=5.0)
+            http_post(url, operacao="comando")
             return True
         except:
             return False
@@ -1409,8 +6052,11 @@ def imprimir_em_massa():
     if not os.path.exists(caminho):
         return jsonify({"success": False, "message": f"Arquivo não encontrado: {arquivo}"}), 404
 
+    # ✅ Um único buffer para o lote: o NAS é lido uma vez, não uma vez por impressora
+    ips = list(dict.fromkeys(ips))
+    lote = ArquivoCompartilhado(caminho, referencias=len(ips))
     for ip in ips:
-        enfileirar_impressao(ip, caminho, arquivo_label=os.path.basename(caminho))
+        enfileirar_impressao(ip, caminho, arquivo_label=os.path.basename(caminho), lote=lote)
 
     return jsonify({"success": True, "queued": True, "total": len(ips)})
 
@@ -1426,6 +6072,22 @@ if __name__ == '__main__':
     t.start()
     print("🚀 Motor de monitoramento iniciado em Betim!")
 
-    # 3. Rodamos o servidor Flask
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    # 2.1 Vigia da pasta de G-codes (dispensa a espera de estabilidade)
+    PRONTIDAO.iniciar()
+
+    # 2.2 Índice da biblioteca (o /navegar responde do SQLite)
+    BIBLIOTECA.iniciar()
+
+    # 2.3 Fila persistente: jobs interrompidos pelo último desligamento voltam a rodar
+    FILA_JOBS.retomar()
+    DESPACHANTE.iniciar()
+
+    # 2.4 Telemetria: anéis de temperatura/progresso voltam do disco
+    TELEMETRIA.iniciar()
+
+    # 2.5 Token Bling: renovação em segundo plano antes de vencer
+    TOKENS_BLING.iniciar()
+
+    # 3. Rodamos o servidor Flask (via SocketIO para o push de status)
+    socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
 # --- Fim Bloco de Inicializacao ---
\ No newline at end of file
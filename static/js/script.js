@@ -12,9 +12,11 @@
 ========================================================= */
 let impressoraSelecionada = '';
 let pastaAtual = '';
+const ARQUIVOS_POR_PAGINA = 200; // /navegar pagina pelo índice do servidor
 let uploadsAtivos = {};
 let isPollingPaused = false;
 let pollingDeep = null;
+let cursorConsole = null;   // último seq de console recebido (null = painel recém-aberto)
 let passoAtual = 1;
 let nomeImpressoraSelecionada = ''; // Para usar na confirmação de exclusão
 /* =========================================================
@@ -23,77 +25,130 @@ let nomeImpressoraSelecionada = ''; // Para usar na confirmação de exclusão
 
 
 /* =========================================================
-   1) MONITORAMENTO GERAL (GRID + WIDGETS) - VERSÃO LIMPA
+   1) MONITORAMENTO GERAL (GRID + WIDGETS) - PUSH VIA SOCKET.IO
+   - O servidor manda a foto completa ao conectar e depois só
+     o card que mudou. Polling de 3s fica só como fallback.
    ========================================================= */
-function atualizarStatusInstantaneo() {
-    if (isPollingPaused) return;
+let socketFarm = null;
+let estadoFarm = {};       // ip -> dados do card (espelho do servidor)
+let versaoFarm = 0;        // última versão do estado que este dashboard viu
+let bootFarm = '';         // identifica o processo do servidor (versão zera no restart)
+let pollingStatus = null;
+let pollingProducao = null;
+
+/** Atualiza UM card (cor, texto e barra de progresso) */
+function aplicarStatusCard(ip, dados) {
+    // Tenta encontrar o card pelo ID único ou pelo seletor de IP
+    const idLimpo = ip.split('.').join('-');
+    const card = document.getElementById(`card-${idLimpo}`) || 
+                 document.querySelector(`.card-pro[onclick*="${ip}"]`);
+    
+    if (!card) return; 
 
-    // 1. Busca o sinal de estado atualizado do servidor Python
-    fetch('/status_atualizado')
-        .then(r => r.json())
-        .then(data => {
-            // Atualiza o contador de máquinas prontas no widget superior
-            const countDispEl = document.getElementById('countDisp');
-            if (countDispEl) {
-                countDispEl.innerText = data.total_disponiveis;
-            }
+    // Ajusta a cor do card (ready, printing, offline) e o texto de status
+    card.className = `card-pro ${dados.cor}`;
+    const statusTxt = card.querySelector('.status-text');
+    if (statusTxt) {
+        statusTxt.innerText = dados.msg;
+    }
 
-            const listaAtiva = document.getElementById('listaProducaoAtiva');
-            let htmlListaAtiva = '';
-            let temAlguemImprimindo = false;
+    // Gerencia a exibição da barra de progresso em tempo real
+    const progressArea = card.querySelector('.progress-area');
+    if (progressArea) {
+        if (['printing', 'paused'].includes(dados.status)) {
+            progressArea.style.display = 'block';
+            
+            const fill = card.querySelector('.barra-progresso');
+            const pctVal = card.querySelector('.pct-val');
+            
+            if (fill) fill.style.width = dados.progresso + '%';
+            if (pctVal) pctVal.innerText = dados.progresso + '%';
+        } else {
+            progressArea.style.display = 'none';
+        }
+    }
+}
 
-            // Percorre cada impressora enviada pelo sinal do servidor
-            Object.entries(data.impressoras || {}).forEach(([ip, dados]) => {
-                // Tenta encontrar o card pelo ID único ou pelo seletor de IP
-                const idLimpo = ip.split('.').join('-');
-                const card = document.getElementById(`card-${idLimpo}`) || 
-                             document.querySelector(`.card-pro[onclick*="${ip}"]`);
-                
-                if (!card) return; 
-
-                // Ajusta a cor do card (ready, printing, offline) e o texto de status
-                card.className = `card-pro ${dados.cor}`;
-                const statusTxt = card.querySelector('.status-text');
-                if (statusTxt) {
-                    statusTxt.innerText = dados.msg;
-                }
+/** Widget 'Linha de Produção' montado a partir do espelho local */
+function renderizarListaAtiva() {
+    const listaAtiva = document.getElementById('listaProducaoAtiva');
+    if (!listaAtiva) return;
+
+    let htmlListaAtiva = '';
+    Object.values(estadoFarm).forEach(dados => {
+        if (!['printing', 'paused'].includes(dados.status)) return;
+
+        const nomeLimpo = (dados.arquivo || '').replace('.gcode', '').replace('.bgcode', '');
+        htmlListaAtiva += `
+            <li>
+                <span class="printer-name">${dados.nome}</span>
+                <span class="file-name">${nomeLimpo}</span>
+            </li>`;
+    });
 
-                // Gerencia a exibição da barra de progresso em tempo real
-                const progressArea = card.querySelector('.progress-area');
-                if (progressArea) {
-                    if (['printing', 'paused'].includes(dados.status)) {
-                        progressArea.style.display = 'block';
-                        
-                        const fill = card.querySelector('.barra-progresso');
-                        const pctVal = card.querySelector('.pct-val');
-                        
-                        if (fill) fill.style.width = dados.progresso + '%';
-                        if (pctVal) pctVal.innerText = dados.progresso + '%';
-                        
-                        // Alimenta a lista da 'Linha de Produção'
-                        temAlguemImprimindo = true;
-                        const nomeLimpo = (dados.arquivo || '').replace('.gcode', '').replace('.bgcode', '');
-                        htmlListaAtiva += `
-                            <li>
-                                <span class="printer-name">${dados.nome}</span>
-                                <span class="file-name">${nomeLimpo}</span>
-                            </li>`;
-                    } else {
-                        progressArea.style.display = 'none';
-                    }
-                }
-            });
+    listaAtiva.innerHTML = htmlListaAtiva || '<li class="empty-msg">Nenhuma colmeia em produção</li>';
+}
+
+function atualizarContadorDisponiveis(total) {
+    // Atualiza o contador de máquinas prontas no widget superior
+    const countDispEl = document.getElementById('countDisp');
+    if (countDispEl && total !== undefined) {
+        countDispEl.innerText = total;
+    }
+}
+
+/** Redesenha a farm inteira (snapshot do socket ou resposta do polling) */
+function renderizarFarm(impressoras, totalDisponiveis) {
+    estadoFarm = impressoras || {};
+    atualizarContadorDisponiveis(totalDisponiveis);
+    Object.entries(estadoFarm).forEach(([ip, dados]) => aplicarStatusCard(ip, dados));
+    renderizarListaAtiva();
+}
+
+/** Aplica um card vindo do servidor, ignorando versão mais velha que a local */
+function aplicarMudancaFarm(ip, dados) {
+    const atual = estadoFarm[ip];
+    if (atual && atual.versao >= dados.versao) return;
+    estadoFarm[ip] = dados;
+    aplicarStatusCard(ip, dados);
+}
+
+function registrarVersaoFarm(data) {
+    if (data.boot) bootFarm = data.boot;
+    if (typeof data.versao === 'number') versaoFarm = Math.max(versaoFarm, data.versao);
+}
+
+/** Fallback: polling do estado completo (sem socket ou socket caído) */
+function atualizarStatusInstantaneo() {
+    if (isPollingPaused) return;
+
+    // 1. Busca só o que mudou desde a última versão vista (ou tudo, no 1º ciclo)
+    const url = bootFarm
+        ? `/status_atualizado?since=${versaoFarm}&boot=${bootFarm}`
+        : '/status_atualizado';
 
-            // Renderiza a lista de produção no widget
-            if (listaAtiva) {
-                listaAtiva.innerHTML = temAlguemImprimindo 
-                    ? htmlListaAtiva 
-                    : '<li class="empty-msg">Nenhuma colmeia em produção</li>';
+    fetch(url)
+        .then(r => r.json())
+        .then(data => {
+            if (data.completo === false) {
+                Object.entries(data.impressoras || {}).forEach(([ip, dados]) => aplicarMudancaFarm(ip, dados));
+                (data.removidas || []).forEach(ip => delete estadoFarm[ip]);
+                renderizarListaAtiva();
+                atualizarContadorDisponiveis(data.total_disponiveis);
+            } else {
+                // servidor reiniciou ou primeira carga: foto completa
+                versaoFarm = 0;
+                renderizarFarm(data.impressoras, data.total_disponiveis);
             }
+            registrarVersaoFarm(data);
         })
         .catch(() => {}); // Falha silenciosa para produção
 
-    // 2. Busca o resumo da produção diária (Concluídos 24h)
+    atualizarProducaoDiaria();
+}
+
+/** Busca o resumo da produção diária (Concluídos 24h) */
+function atualizarProducaoDiaria() {
     fetch('/dados_producao_diaria')
         .then(r => r.json())
         .then(producao => {
@@ -114,6 +169,58 @@ function atualizarStatusInstantaneo() {
         .catch(() => {});
 }
 
+function iniciarPollingStatus() {
+    if (pollingStatus) return;
+    pollingStatus = setInterval(atualizarStatusInstantaneo, 3000);
+    atualizarStatusInstantaneo();
+}
+
+function pararPollingStatus() {
+    if (pollingStatus) clearInterval(pollingStatus);
+    pollingStatus = null;
+}
+
+/** Liga o canal de push; se a lib do socket não carregou, fica no polling */
+function iniciarPushStatus() {
+    if (typeof io === 'undefined') {
+        iniciarPollingStatus();
+        return;
+    }
+
+    socketFarm = io({ transports: ['websocket', 'polling'] });
+
+    socketFarm.on('connect', () => pararPollingStatus());
+    socketFarm.on('disconnect', () => iniciarPollingStatus());
+
+    socketFarm.on('snapshot_status', data => {
+        versaoFarm = 0;
+        registrarVersaoFarm(data);
+        renderizarFarm(data.impressoras, data.total_disponiveis);
+    });
+
+    socketFarm.on('status_impressora', ev => {
+        registrarVersaoFarm(ev);
+        if (isPollingPaused) return;
+        aplicarMudancaFarm(ev.ip, ev.dados);
+        renderizarListaAtiva();
+        atualizarContadorDisponiveis(ev.total_disponiveis);
+    });
+
+    socketFarm.on('impressora_removida', ev => {
+        registrarVersaoFarm(ev);
+        delete estadoFarm[ev.ip];
+        renderizarListaAtiva();
+        atualizarContadorDisponiveis(ev.total_disponiveis);
+    });
+
+    // Produção diária muda pouco: não precisa do ritmo do status
+    pollingProducao = setInterval(atualizarProducaoDiaria, 15000);
+    atualizarProducaoDiaria();
+}
+/* =========================================================
+   /1) MONITORAMENTO GERAL (GRID + WIDGETS)
+   ========================================================= */
+
 
 /* =========================================================
    2) COMMAND CENTER (TABS / MODAL / DEEP POLLING)
@@ -284,7 +391,10 @@ function removerImpressora(ip, nome) {
 function deepPollingCC() {
     if (!impressoraSelecionada) return;
 
-    fetch(`/api/detalhes_profundos/${impressoraSelecionada}`)
+    const ipConsulta = impressoraSelecionada;
+    const params = (cursorConsole === null) ? '' : `?cursor=${cursorConsole}`;
+
+    fetch(`/api/detalhes_profundos/${ipConsulta}${params}`)
         .then(r => r.json())
         .then(data => {
             // Atualiza temperaturas (com validação)
@@ -300,14 +410,26 @@ function deepPollingCC() {
                 if (bedTar) bedTar.innerText = Math.round(data.status.heater_bed.target) || 0;
             }
 
-            // Atualiza console
+            // Trocou de impressora no meio da requisição: descarta
+            if (ipConsulta !== impressoraSelecionada) return;
+
+            // Atualiza console (servidor manda só as linhas novas desde o cursor)
             const log = document.getElementById('cc-console-log');
             if (data.console && log) {
-                log.innerHTML = data.console
+                const html = data.console
                     .map(line => `<div class="console-line"><span>></span> ${line.message}</div>`)
                     .join('');
-                log.scrollTop = log.scrollHeight;
+
+                if (data.reset) {
+                    log.innerHTML = html;
+                } else if (html) {
+                    log.insertAdjacentHTML('beforeend', html);
+                    // mantém o DOM leve em sessões longas
+                    while (log.children.length > 200) log.removeChild(log.firstChild);
+                }
+                if (data.reset || html) log.scrollTop = log.scrollHeight;
             }
+            if (typeof data.cursor === 'number') cursorConsole = data.cursor;
         })
         .catch(err => console.error("Erro no Deep Polling:", err));
 }
@@ -355,6 +477,7 @@ function abrirModal(ip, nome) {
     carregarArquivosInternos();
 
     if (pollingDeep) clearInterval(pollingDeep);
+    cursorConsole = null;
     pollingDeep = setInterval(deepPollingCC, 2000);
 }
 
@@ -379,16 +502,16 @@ function fecharModal() {
 /* =========================================================
    3) BIBLIOTECA CENTRAL - NAVEGAÇÃO COM ESTILO UNIFICADO
    ========================================================= */
-function carregarPasta(caminho) {
+function carregarPasta(caminho, pagina = 1) {
     const ul = document.getElementById('listaGcodes');
     if (!ul) return;
 
-    ul.innerHTML = '<li class="loading-state">Lendo arquivos do servidor...</li>';
+    if (pagina === 1) ul.innerHTML = '<li class="loading-state">Lendo arquivos do servidor...</li>';
 
     fetch('/navegar', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ pasta: caminho })
+        body: JSON.stringify({ pasta: caminho, pagina: pagina, limite: ARQUIVOS_POR_PAGINA })
     })
     .then(r => r.json())
     .then(dados => {
@@ -399,7 +522,9 @@ function carregarPasta(caminho) {
         }
 
         pastaAtual = dados.atual || '';
-        ul.innerHTML = '';
+        const btnMais = ul.querySelector('.carregar-mais');
+        if (btnMais) btnMais.remove();
+        if (pagina === 1) ul.innerHTML = '';
 
         const caminhoEl = document.getElementById('caminhoAtual');
         if (caminhoEl) caminhoEl.innerText = pastaAtual || 'Raiz';
@@ -407,8 +532,8 @@ function carregarPasta(caminho) {
         const btnVoltar = document.getElementById('btnVoltar');
         if (btnVoltar) btnVoltar.disabled = (pastaAtual === '');
 
-        // 1. Renderiza Pastas (Estilo Klipper)
-        dados.pastas.forEach(p => {
+        // 1. Renderiza Pastas (Estilo Klipper) - só na primeira página
+        if (pagina === 1) dados.pastas.forEach(p => {
             const li = document.createElement('li');
             li.className = 'internal-file-item';
             li.innerHTML = `
@@ -429,6 +554,7 @@ function carregarPasta(caminho) {
             const li = document.createElement('li');
             li.className = 'internal-file-item';
             li.innerHTML = `
+                ${htmlMiniatura(f.miniatura)}
                 <div class="file-info">
                     <strong class="file-name-text">${f.nome}</strong>
                     <small class="file-size-tag">${f.tamanho}</small>
@@ -442,7 +568,12 @@ function carregarPasta(caminho) {
             ul.appendChild(li);
         });
 
-        if (dados.pastas.length === 0 && dados.arquivos.length === 0) {
+        // 3. Próxima página sob demanda (pastas com milhares de G-codes)
+        if ((dados.pagina || 1) < (dados.paginas || 1)) {
+            ul.appendChild(criarItemCarregarMais(dados, () => carregarPasta(pastaAtual, pagina + 1)));
+        }
+
+        if (pagina === 1 && dados.pastas.length === 0 && dados.arquivos.length === 0) {
             ul.innerHTML = '<li class="empty-msg">Nenhum arquivo nesta pasta.</li>';
         }
     })
@@ -451,6 +582,30 @@ function carregarPasta(caminho) {
     });
 }
 
+/* Miniatura do slicer (servida com cache longo; some se o G-code não tiver) */
+function htmlMiniatura(url) {
+    if (!url) return '';
+    return `<img class="gcode-thumb" src="${url}" loading="lazy" alt="" onerror="this.remove()">`;
+}
+
+function criarItemCarregarMais(dados, aoClicar) {
+    const mostrados = Math.min(dados.pagina * ARQUIVOS_POR_PAGINA, dados.total_arquivos);
+    const li = document.createElement('li');
+    li.className = 'internal-file-item carregar-mais';
+    li.innerHTML = `
+        <div class="file-info">
+            <small class="file-size-tag">${mostrados} de ${dados.total_arquivos} arquivos</small>
+        </div>
+        <button class="btn-print-internal">CARREGAR MAIS</button>
+    `;
+    li.querySelector('button').onclick = (e) => {
+        e.stopPropagation();
+        e.target.disabled = true;
+        aoClicar();
+    };
+    return li;
+}
+
 /* No módulo 3 (ARQUIVOS) */
 function selecionarArquivo(el, nome) {
     document.querySelectorAll('.item-file').forEach(i => i.classList.remove('selected'));
@@ -504,6 +659,7 @@ function carregarArquivosInternos() {
 
                 return `
                     <li class="internal-file-item">
+                        ${htmlMiniatura(f.miniatura)}
                         <div class="file-info">
                             <strong class="file-name-text">${nomeArquivo}</strong>
                             <small class="file-size-tag">${tamanhoMB} MB</small>
@@ -648,6 +804,8 @@ function finalizarVisualUpload(idLimpo) {
 function cadastrarNovaImpressora() {
     const nome = (document.getElementById('nomeImpressora') || {}).value;
     const ip = (document.getElementById('novoIpImpressora') || {}).value;
+    const grupoRede = (document.getElementById('grupoRedeImpressora') || {}).value || '';
+    const tags = (document.getElementById('tagsImpressora') || {}).value || '';
 
     if (!nome || !ip) {
         alert("⚠️ Por favor, preencha o Nome e o IP da impressora.");
@@ -659,7 +817,7 @@ function cadastrarNovaImpressora() {
     fetch('/cadastrar_impressora', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ nome: nome, ip: ip })
+        body: JSON.stringify({ nome: nome, ip: ip, grupo_rede: grupoRede, tags: tags })
     })
     .then(response => {
         if (response.ok) {
@@ -684,6 +842,21 @@ function enviarComandoCC(cmd, params = '') {
     });
 }
 
+/** Peça retirada: a impressora sai de CONCLUÍDA e volta para a fila global */
+function liberarMesa() {
+    if (!impressoraSelecionada) return;
+    fetch('/api/mesa_liberada', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({ ip: impressoraSelecionada })
+    })
+    .then(res => res.json())
+    .then(data => {
+        if (!data.success) alert("❌ Não foi possível liberar a mesa: " + (data.message || ''));
+    })
+    .catch(err => alert("🚨 Erro de rede: " + err));
+}
+
 /** Clique no botão de enviar (produção) - ligado quando DOM estiver pronto */
 function configurarBotaoEnviar() {
     const btn = document.getElementById('btnEnviar');
@@ -899,9 +1072,21 @@ function carregarEstoqueBling() {
     fetch('/api/estoque_bling')
         .then(res => res.json())
         .then(res => {
+            if (res.error) {
+                grid.innerHTML = `<p class="loading">⚠️ ${res.error}: ${res.details || ''}</p>`;
+                return;
+            }
             grid.innerHTML = '';
             const produtos = res.data || [];
 
+            // Catálogo velho na tela enquanto o servidor recarrega: busca de novo em seguida
+            if (res.atualizando) {
+                setTimeout(() => {
+                    const secao = document.getElementById('secao-estoque');
+                    if (secao && secao.style.display !== 'none') carregarEstoqueBling();
+                }, 5000);
+            }
+
             produtos.forEach(prod => {
                 const saldo = (prod.estoque && prod.estoque.saldoVirtualTotal !== undefined)
                     ? Math.floor(prod.estoque.saldoVirtualTotal)
@@ -1123,16 +1308,16 @@ function renderMassaParams() {
     }
 }
 
-function carregarPastaMassa(caminho) {
+function carregarPastaMassa(caminho, pagina = 1) {
     const ul = document.getElementById('listaArquivosMassa');
     if (!ul) return;
 
-    ul.innerHTML = '<li class="loading-state" style="padding:15px; opacity:0.6; font-size:13px;">Buscando gcodes...</li>';
+    if (pagina === 1) ul.innerHTML = '<li class="loading-state" style="padding:15px; opacity:0.6; font-size:13px;">Buscando gcodes...</li>';
 
     fetch('/navegar', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ pasta: caminho })
+        body: JSON.stringify({ pasta: caminho, pagina: pagina, limite: ARQUIVOS_POR_PAGINA })
     })
     .then(r => r.json())
     .then(data => {
@@ -1140,10 +1325,12 @@ function carregarPastaMassa(caminho) {
         document.getElementById('caminhoMassa').innerText = pastaAtualMassa || "Raiz";
         document.getElementById('btnVoltarMassa').disabled = (pastaAtualMassa === "");
         
-        ul.innerHTML = "";
+        const btnMais = ul.querySelector('.carregar-mais');
+        if (btnMais) btnMais.remove();
+        if (pagina === 1) ul.innerHTML = "";
 
-        // 1. Renderiza Pastas
-        data.pastas.forEach(p => {
+        // 1. Renderiza Pastas (só na primeira página)
+        if (pagina === 1) data.pastas.forEach(p => {
             const li = document.createElement('li');
             li.className = 'internal-file-item';
             li.innerHTML = `
@@ -1168,6 +1355,7 @@ function carregarPastaMassa(caminho) {
             if (massaArquivoSelecionado === rel) li.classList.add('selected-massa');
 
             li.innerHTML = `
+                ${htmlMiniatura(f.miniatura)}
                 <div class="file-info">
                     <strong class="file-name-text">${f.nome}</strong>
                     <small class="file-size-tag">${f.tamanho}</small>
@@ -1177,24 +1365,19 @@ function carregarPastaMassa(caminho) {
                 </button>
             `;
 
-            li.onclick = (e) => {
+            li.onclick = () => {
                 if (!isGcode) return;
-                
-                // Salva a seleção global
-                massaArquivoSelecionado = rel;
-                
-                // Atualiza o painel de feedback
-                document.getElementById('selecaoAtualMassa').style.display = "block";
-                document.getElementById('nomeArquivoMassa').innerText = f.nome;
-                
-                // Feedback visual: remove de todos e coloca no clicado
-                document.querySelectorAll('#listaArquivosMassa li').forEach(el => el.classList.remove('selected-massa'));
-                li.classList.add('selected-massa');
+                selecionarArquivoMassa(li, rel, f.nome);
             };
             ul.appendChild(li);
         });
 
-        if (data.pastas.length === 0 && data.arquivos.length === 0) {
+        // 3. Próxima página sob demanda
+        if ((data.pagina || 1) < (data.paginas || 1)) {
+            ul.appendChild(criarItemCarregarMais(data, () => carregarPastaMassa(pastaAtualMassa, pagina + 1)));
+        }
+
+        if (pagina === 1 && data.pastas.length === 0 && data.arquivos.length === 0) {
             ul.innerHTML = '<li class="empty-msg" style="padding:20px; text-align:center; opacity:0.5;">Pasta vazia</li>';
         }
     })
@@ -1203,6 +1386,77 @@ function carregarPastaMassa(caminho) {
     });
 }
 
+function selecionarArquivoMassa(li, rel, nome) {
+    // Salva a seleção global
+    massaArquivoSelecionado = rel;
+
+    // Atualiza o painel de feedback
+    document.getElementById('selecaoAtualMassa').style.display = "block";
+    document.getElementById('nomeArquivoMassa').innerText = nome;
+
+    // Feedback visual: remove de todos e coloca no clicado
+    document.querySelectorAll('#listaArquivosMassa li').forEach(el => el.classList.remove('selected-massa'));
+    li.classList.add('selected-massa');
+}
+
+/* Busca em toda a biblioteca (índice do servidor) em vez de abrir pasta por pasta */
+let timerBuscaMassa = null;
+let seqBuscaMassa = 0;
+
+function buscarGcodeMassa(texto) {
+    clearTimeout(timerBuscaMassa);
+    timerBuscaMassa = setTimeout(() => executarBuscaMassa(texto.trim()), 200);
+}
+
+function executarBuscaMassa(q) {
+    const ul = document.getElementById('listaArquivosMassa');
+    if (!ul) return;
+
+    // Campo vazio: volta para a navegação normal
+    if (!q) {
+        document.getElementById('btnVoltarMassa').disabled = (pastaAtualMassa === "");
+        carregarPastaMassa(pastaAtualMassa);
+        return;
+    }
+
+    const seq = ++seqBuscaMassa;
+    fetch(`/api/buscar_gcode?q=${encodeURIComponent(q)}&limite=100`)
+    .then(r => r.json())
+    .then(data => {
+        if (seq !== seqBuscaMassa) return; // resposta de uma digitação antiga
+
+        document.getElementById('caminhoMassa').innerText = `Busca: "${q}"`;
+        document.getElementById('btnVoltarMassa').disabled = true;
+        ul.innerHTML = "";
+
+        (data.resultados || []).forEach(f => {
+            const li = document.createElement('li');
+            li.className = 'internal-file-item';
+            if (massaArquivoSelecionado === f.caminho) li.classList.add('selected-massa');
+
+            li.innerHTML = `
+                ${htmlMiniatura(f.miniatura)}
+                <div class="file-info">
+                    <strong class="file-name-text">${f.nome}</strong>
+                    <small class="file-size-tag">📁 ${f.pasta || 'Raiz'} · ${f.tamanho}</small>
+                </div>
+                <button class="btn-massa-select">SELECIONAR</button>
+            `;
+            li.onclick = () => selecionarArquivoMassa(li, f.caminho, f.nome);
+            ul.appendChild(li);
+        });
+
+        if (!data.resultados || data.resultados.length === 0) {
+            ul.innerHTML = '<li class="empty-msg" style="padding:20px; text-align:center; opacity:0.5;">Nenhum G-code encontrado</li>';
+        } else if (data.resultados[0].aproximado) {
+            ul.insertAdjacentHTML('afterbegin', '<li class="empty-msg" style="padding:8px; opacity:0.6; font-size:12px;">Nada exato — mostrando nomes parecidos</li>');
+        }
+    })
+    .catch(() => {
+        if (seq === seqBuscaMassa) ul.innerHTML = '<li class="error-msg">Erro na busca.</li>';
+    });
+}
+
 function voltarPastaMassa() {
     let partes = pastaAtualMassa.split('/');
     partes.pop();
@@ -1257,6 +1511,8 @@ function executarAcaoMassa() {
             });
 
             massaArquivoSelecionado = ""; 
+            const campoBusca = document.getElementById('buscaGcodeMassa');
+            if (campoBusca) campoBusca.value = "";
         })
         .catch(err => alert("❌ Falha no envio em massa: " + err.message));
 
@@ -1320,9 +1576,8 @@ function initDashboard() {
     // 2) liga botão "Enviar" com segurança após DOM
     configurarBotaoEnviar();
 
-    // 3) inicia polling do dashboard
-    setInterval(atualizarStatusInstantaneo, 3000);
-    atualizarStatusInstantaneo();
+    // 3) inicia push de status do dashboard (fallback: polling)
+    iniciarPushStatus();
 }
 
 window.addEventListener('load', initDashboard);